@@ -1,5 +1,16 @@
+#include <ctype.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <math.h>
+#include <pthread.h>
+#include <stdint.h>
 #include <stdio.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <time.h>
+#include <unistd.h>
 
 #include <Python.h>
 
@@ -36,7 +47,16 @@ int install_control_block(lua_State *L, size_t max_memory,
     (control->memory).memory_limit = max_memory;
     (control->memory).old_allocf = old_allocf;
     (control->memory).old_ud = old_ud;
+    (control->memory).charge_python = 0;
+    (control->memory).python_used = 0;
     (control->runtime).enabled = 0;
+    control->tenant = NULL;
+    (control->owners).blocks = NULL;
+    (control->owners).owners = NULL;
+    (control->owners).capacity = 0;
+    (control->owners).count = 0;
+    control->main_thread = L;
+    control->task_thread = NULL;
 
     // our python refcounting strategy is to add python objects here. when we
     // have objects in here, we're signalling that python can't clean them up.
@@ -73,6 +93,9 @@ void wrapped_lua_close(lua_State *L) {
 
     lua_close(L);
 
+    // that freed every block without telling their tenants
+    free_owners(&control->owners);
+
     free(control);
 }
 
@@ -123,6 +146,12 @@ static void time_limiting_hook(lua_State *L, lua_Debug *_ar) {
         return;
     }
 
+    check_runtime_quota(L, control);
+}
+
+
+static void check_runtime_quota(lua_State *L, lua_control_block* control) {
+    // raise a Lua error if the runtime limiter's time is up
     clock_t now = clock();
 
     if(now>(control->runtime).expires) {
@@ -163,23 +192,70 @@ void* l_alloc_restricted(lua_control_block* control,
         // only if we're trying to grow (lua panics if we return NULL when
         // shrinking)
         && new_total>(control->memory).memory_used
-        // we're using more than the limit
-        && new_total>(control->memory).memory_limit;
+        // we're using more than the limit (including anything charged for
+        // Python objects)
+        && new_total+(control->memory).python_used>(control->memory).memory_limit;
+
+    /*
+     * Tenants have their own budgets too. A tenant is charged for the blocks
+     * that are allocated while it's running until they're freed, whoever is
+     * running by then (often nobody, since the collector does it). Blocks that
+     * it owns stay its own when they're resized, while anything else that's
+     * resized is only charged to the VM
+     */
+    tenant_owners* owners = &control->owners;
+    lua_tenant* owner = NULL;
+    lua_tenant* charged = NULL;
+
+    if(ptr != NULL && owners->count) {
+        owner = charged = find_owner(owners, ptr);
+    } else if(ptr == NULL) {
+        charged = control->tenant;
+    }
+
+    if(!kick_in && charged
+       && (control->memory).enabled
+       && charged->memory_limit
+       && new_size>old_size
+       && charged->memory_used+(new_size-old_size)>charged->memory_limit) {
+        charged->refused = charged->memory_used+(new_size-old_size);
+        kick_in = 1;
+    }
+
+    // there's no failing once we've allocated, so make room to record the
+    // owner of a new block first
+    if(!kick_in && charged && !owner && new_size && !reserve_owner(owners)) {
+        kick_in = 1;
+    }
 
     if (kick_in) {
         /* too much memory in use */
         return NULL;
     }
 
-    ptr = (control->memory).old_allocf((control->memory).old_ud,
-                                       ptr, o_old_size, new_size);
+    void* new_ptr = (control->memory).old_allocf((control->memory).old_ud,
+                                                 ptr, o_old_size, new_size);
 
-    if (ptr || new_size==0) {
+    if (new_ptr || new_size==0) {
         /* reallocation successful (free is always successful) */
         (control->memory).memory_used = new_total;
+
+        if(owner) {
+            remove_owner(owners, ptr);
+            owner->memory_used -= old_size;
+        }
+        if(charged && new_size) {
+            set_owner(owners, new_ptr, charged);
+            charged->memory_used += new_size;
+            __sync_add_and_fetch(&charged->refcount, 1);
+        }
+        if(owner) {
+            // last, since this may be the last thing keeping it around
+            release_tenant(owner);
+        }
     }
 
-    return ptr;
+    return new_ptr;
 }
 
 
@@ -255,10 +331,10 @@ int memory_safe_pcallk(lua_State *L, int nargs, int nresults, int _msgh) {
 
 
 int call_python_function_from_lua(lua_State *L) {
-    // we're only willing to call functions of 0 arguments so that we don't have
-    // to do argument handling here in C. LuaValue._from_python will wrap the
-    // real Python function in one that does argument handling and give that one
-    // to us
+    // most calls take the fast path in call_python_fast, converting the
+    // arguments and the result here in C. Capsules with raw_lua_args or
+    // returns_future go through executor.py:_callable_wrapper instead, which
+    // takes its arguments from the stack and leaves its result there
 
     lua_control_block *control = NULL;
     (void*)lua_getallocf(L, (void*)&control);
@@ -274,6 +350,27 @@ int call_python_function_from_lua(lua_State *L) {
     PyObject* executor = lua_touserdata(L, lua_upvalueindex(2));
     luaL_argcheck(L, executor != NULL, -1, "upvalue missing?");
 
+    PyObject* to_python_fallback = lua_touserdata(L, lua_upvalueindex(3));
+    luaL_argcheck(L, to_python_fallback != NULL, -1, "upvalue missing?");
+
+    PyObject* push_fallback = lua_touserdata(L, lua_upvalueindex(4));
+    luaL_argcheck(L, push_fallback != NULL, -1, "upvalue missing?");
+
+    // everything but the capsule itself
+    int nargs = lua_gettop(L) - 1;
+
+    // if the function hands back a future and we're running as a Task, we
+    // suspend the calling script until it's done instead of blocking on it.
+    // A coroutine that the task's script made itself would yield the future
+    // to the script rather than to the scheduler, so those block too
+    int awaiting = capsule->returns_future
+                   && L == control->task_thread
+                   && can_yield(L, 1);
+
+    // Python only ever talks to the main thread's stack, so if we're being
+    // called from a coroutine we lend it our arguments for the duration
+    lua_State* PL = python_stack(L, control, nargs); // can longjmp out
+
     // once we hold the GIL it's vital that we turn off the allocation checking
     // because any allocation failure will longjmp out and we'll have no chance
     // to release it
@@ -282,12 +379,32 @@ int call_python_function_from_lua(lua_State *L) {
     PyGILState_STATE gstate;
     gstate = PyGILState_Ensure();
 
-    PyObject* ret = PyObject_CallFunction(call_proxy, "OOi",
-                                          executor,
-                                          capsule->val,
-                                          capsule->raw_lua_args);
+    // if Python raises, whatever it didn't consume of our arguments is
+    // stranded on PL, which doesn't get unwound with us
+    int pl_top = lua_gettop(PL);
+    if(PL != L) {
+        lua_xmove(L, PL, nargs);
+    }
+
+    PyObject* ret;
+
+    if(capsule->raw_lua_args || capsule->returns_future) {
+        ret = PyObject_CallFunction(call_proxy, "OOiiii",
+                                    executor,
+                                    capsule->val,
+                                    capsule->raw_lua_args,
+                                    nargs,
+                                    capsule->returns_future,
+                                    awaiting);
+    } else {
+        ret = call_python_fast(PL, capsule->val, nargs,
+                               to_python_fallback, push_fallback, executor);
+    }
 
     if(ret == NULL) {
+        if(PL != L) {
+            lua_settop(PL, pl_top);
+        }
         // fixes the memory limiter and the GIL too
         return translate_python_exception(L, gstate);
     }
@@ -295,6 +412,10 @@ int call_python_function_from_lua(lua_State *L) {
     // otherwise we were successful and the return value is now at the top
     // of the stack
 
+    if(PL != L) {
+        lua_xmove(PL, L, 1);
+    }
+
     Py_DECREF(ret);
     PyGILState_Release(gstate);
     enable_limit_memory(L);
@@ -305,10 +426,212 @@ int call_python_function_from_lua(lua_State *L) {
         time_limiting_hook(L, NULL); // may not return
     }
 
+#if LUA_VERSION_NUM >= 502
+    if(awaiting) {
+        // what the wrapper left is the future for the scheduler to wait on.
+        // finish_awaited_call takes it from here once we're resumed
+        int base = lua_gettop(L) - 1;
+#if LUA_VERSION_NUM >= 503
+        return lua_yieldk(L, 1, (lua_KContext)base, finish_awaited_call_k);
+#elif LUA_VERSION_NUM == 502
+        return lua_yieldk(L, 1, base, finish_awaited_call_k);
+#endif
+    }
+#endif
+
     return 1; // one return value that the wrapper left on the stack
 }
 
 
+static PyObject* call_python_fast(lua_State *L, PyObject* fn, int nargs,
+                                  PyObject* to_python_fallback,
+                                  PyObject* push_fallback,
+                                  PyObject* executor) {
+    /*
+     * Call fn with the top nargs values on the stack, converted into a tuple
+     * like call_py's results, and push what it returns straight back if
+     * push_python_flat can. Anything else is handed to
+     * push_fallback(executor, ret) to push. Like _callable_wrapper, returns a
+     * new reference with the result on the top of the stack, or NULL with a
+     * Python exception set. The arguments are popped either way
+     */
+    PyObject* args = pop_python_tuple(L, nargs, to_python_fallback, executor);
+    if(args == NULL) {
+        return NULL;
+    }
+
+    PyObject* ret = PyObject_Call(fn, args, NULL);
+    Py_DECREF(args);
+    if(ret == NULL) {
+        return NULL;
+    }
+
+    if(!lua_checkstack(L, 3)) {
+        Py_DECREF(ret);
+        PyErr_SetString(PyExc_MemoryError, "call_python_fast.checkstack");
+        return NULL;
+    }
+
+    if(push_python_flat(L, ret)) {
+        return ret;
+    }
+
+    PyObject* pushed = PyObject_CallFunctionObjArgs(push_fallback, executor,
+                                                    ret, NULL);
+    Py_DECREF(ret);
+    return pushed;
+}
+
+
+static int push_python_flat(lua_State *L, PyObject* val) {
+    /*
+     * Push a callback's return value without going through
+     * LuaValue.from_python, if it's simple enough: None, anything that
+     * push_python_key can push, or a plain dict, list or tuple of those.
+     * Returns 0 (pushing nothing) for anything else. The caller makes room
+     * for 3 values on the stack
+     */
+    Py_ssize_t i;
+
+    if(val == Py_None) {
+        lua_pushnil(L);
+        return 1;
+
+    } else if(PyDict_CheckExact(val)) {
+        Py_ssize_t pos = 0;
+        PyObject *key, *value;
+
+        lua_createtable(L, 0, (int)PyDict_Size(val));
+
+        while(PyDict_Next(val, &pos, &key, &value)) {
+            if(PyFloat_Check(key) && Py_IS_NAN(PyFloat_AS_DOUBLE(key))) {
+                // not a valid table key, so let from_python complain about it
+                lua_pop(L, 1);
+                return 0;
+            }
+            if(!push_python_key(L, key)) {
+                lua_pop(L, 1); // the table
+                return 0;
+            }
+            if(value == Py_None) {
+                // from_python would set it to nil, which is a no-op
+                lua_pop(L, 1);
+                continue;
+            }
+            if(!push_python_key(L, value)) {
+                lua_pop(L, 2); // the key and the table
+                return 0;
+            }
+            lua_rawset(L, -3);
+        }
+
+        return 1;
+
+    } else if(PyList_CheckExact(val) || PyTuple_CheckExact(val)) {
+        Py_ssize_t n = PySequence_Fast_GET_SIZE(val);
+        PyObject** items = PySequence_Fast_ITEMS(val);
+
+        lua_createtable(L, (int)n, 0);
+
+        for(i=0; i<n; i++) {
+            if(items[i] == Py_None) {
+                continue;
+            }
+            if(!push_python_key(L, items[i])) {
+                lua_pop(L, 1); // the table
+                return 0;
+            }
+            lua_rawseti(L, -2, (int)(i+1));
+        }
+
+        return 1;
+    }
+
+    return push_python_key(L, val);
+}
+
+
+static lua_State* python_stack(lua_State *L, lua_control_block* control,
+                               int needed) {
+    /*
+     * The stack that the Python side does its work on. This is always the
+     * main thread, even if L is a coroutine, because that's the only one that
+     * LuaValues know about. Raises a Lua error if it can't fit `needed` more
+     * values and a little working room
+     */
+    lua_State* PL = control->main_thread;
+
+    if(PL != L && !lua_checkstack(PL, needed + LUA_MINSTACK)) {
+        luaL_error(L, "main thread stack overflow");
+    }
+
+    return PL;
+}
+
+
+static int can_yield(lua_State *L, int level) {
+    /*
+     * Whether L can yield back to executor.py:Task right now. `level` is the
+     * first stack level that we care about: 0 from a hook, or 1 from a C
+     * function that wants to yield on behalf of its Lua caller
+     */
+#if LUA_VERSION_NUM >= 503
+    return lua_isyieldable(L);
+#elif LUA_VERSION_NUM == 502
+    // 5.2 has no lua_isyieldable, and yielding across a C call boundary (like
+    // a table.sort comparator) raises an error. So be conservative and only
+    // yield if there are no C functions anywhere on this thread's stack
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+    lua_Debug ar;
+
+    if(L == control->main_thread) {
+        // not a coroutine at all
+        return 0;
+    }
+
+    for(; lua_getstack(L, level, &ar); level++) {
+        if(!lua_getinfo(L, "S", &ar) || ar.what[0] == 'C') {
+            return 0;
+        }
+    }
+
+    return 1;
+#else
+    // luajit can't run the scheduler anyway
+    return 0;
+#endif
+}
+
+
+static int finish_awaited_call(lua_State *L, int base) {
+    /*
+     * call_python_function_from_lua yielded a future to the scheduler, which
+     * resumes us with (true, result) or (false, error) once it completes.
+     * `base` is how much of our stack was ours before those arrived
+     */
+    if(!lua_toboolean(L, base+1)) {
+        lua_pushvalue(L, base+2);
+        return lua_error(L);
+    }
+
+    return lua_gettop(L) - base - 1; // everything above the flag
+}
+
+
+#if LUA_VERSION_NUM >= 503
+static int finish_awaited_call_k(lua_State *L, int status, lua_KContext ctx) {
+    return finish_awaited_call(L, (int)ctx);
+}
+#elif LUA_VERSION_NUM == 502
+static int finish_awaited_call_k(lua_State *L) {
+    int ctx = 0;
+    lua_getctx(L, &ctx);
+    return finish_awaited_call(L, ctx);
+}
+#endif
+
+
 static int translate_python_exception(lua_State *L, PyGILState_STATE gstate) {
     // there will be a Python exception on the stack. Translate it into a
     // Lua exception and clear it
@@ -319,7 +642,8 @@ static int translate_python_exception(lua_State *L, PyGILState_STATE gstate) {
     PyErr_Clear();
 
     // make a capsule so we can safely get it back to Python land
-    store_python_capsule(L, pvalue, 0, 0, 0);
+    // this one is never refused, or we'd have no way to report the error
+    store_capsule(L, pvalue, 0, 0, 0, 0, 0);
 
     Py_XDECREF(ptype);
     Py_XDECREF(pvalue);
@@ -336,19 +660,59 @@ static int translate_python_exception(lua_State *L, PyGILState_STATE gstate) {
 }
 
 
-void store_python_capsule(lua_State *L,
-                          PyObject* val,
-                          int should_cache,
-                          int recursive,
-                          int raw_lua_args) {
+int store_python_capsule(lua_State *L,
+                         PyObject* val,
+                         int should_cache,
+                         int recursive,
+                         int raw_lua_args,
+                         int returns_future) {
+    /*
+     * Push a capsule holding val. Returns 0 without pushing anything if
+     * charging for val would take the VM over its memory limit (see
+     * set_charge_python)
+     */
+    return store_capsule(L, val, should_cache, recursive, raw_lua_args,
+                         returns_future, 1);
+}
+
+
+static int store_capsule(lua_State *L,
+                         PyObject* val,
+                         int should_cache,
+                         int recursive,
+                         int raw_lua_args,
+                         int returns_future,
+                         int enforce) {
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
+    size_t charge = 0;
+
+    if((control->memory).charge_python) {
+        charge = estimate_python_size(val);
+
+        if(enforce
+           && (control->memory).memory_limit
+           && ((control->memory).memory_used
+               + (control->memory).python_used
+               + charge) > (control->memory).memory_limit) {
+            return 0;
+        }
+    }
+
     lua_capsule* capsule =
-        (lua_capsule*)lua_newuserdata(L, sizeof(lua_capsule));
+        (lua_capsule*)executor_newuserdata(L, sizeof(lua_capsule));
+
+    capsule->charged = charge;
+    capsule->charged_to = &(control->memory).python_used;
+    (control->memory).python_used += charge;
 
     capsule->val = val;
     capsule->cache_ref = LUA_REFNIL; // cache is populated lazily
     capsule->cache = should_cache;
     capsule->recursive = recursive;
     capsule->raw_lua_args = raw_lua_args;
+    capsule->returns_future = returns_future;
 
     // assign the metatable of the userdata to get the methods
     lua_getfield(L, LUA_REGISTRYINDEX, EXECUTOR_LUA_CAPSULE_KEY);
@@ -357,17 +721,63 @@ void store_python_capsule(lua_State *L,
     // we don't do explicit refcounting. instead we rely on our references dict
     // to keep us live and free_python_capsule cleans it up. See
     // executor.py:Lua.__init__ for details
+    add_python_reference(control->references, val);
+    // we never owned val
+
+    return 1;
+}
+
+
+static size_t estimate_python_size(PyObject* val) {
+    // roughly sys.getsizeof(val), which doesn't include anything that val
+    // refers to, plus our own overhead
+    size_t size = EXECUTOR_PYTHON_REFERENCE_OVERHEAD;
+
+    PyObject* sizeof_ret = PyObject_CallMethod(val, "__sizeof__", NULL);
+    Py_ssize_t val_size = -1;
+
+    if(sizeof_ret != NULL) {
+        val_size = PyNumber_AsSsize_t(sizeof_ret, NULL);
+        Py_DECREF(sizeof_ret);
+    }
+
+    if(val_size < 0) {
+        // classes and other oddballs
+        PyErr_Clear();
+        val_size = Py_TYPE(val)->tp_basicsize;
+    }
+
+    return size + (size_t)val_size;
+}
+
+
+void set_charge_python(lua_State *L, int charge_python) {
     lua_control_block *control = NULL;
     (void*)lua_getallocf(L, (void*)&control);
-    PyObject* references = control->references;
 
-    // from here on out we must escape through error below
+    (control->memory).charge_python = charge_python;
+}
+
+
+size_t get_python_memory_used(lua_State *L) {
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
+    return (control->memory).python_used;
+}
+
+
+static int add_python_reference(PyObject* references, PyObject* val) {
     // this is all equivalent to references.setdefault(id(val), []).append(val)
+    // and returns -1 with a Python exception set if that fails
 
     // this is how cpython derives the builtin `id` function
     // https://github.com/python/cpython/blob/29500737d45cbca9604d9ce845fb2acc3f531401/Python/bltinmodule.c#L1207
     PyObject* cycle_key = PyLong_FromVoidPtr(val);
     PyObject* list = NULL;
+    int ret = -1;
+
+    // from here on out we must escape through error below
 
     if(cycle_key == NULL) {
         goto error;
@@ -376,7 +786,7 @@ void store_python_capsule(lua_State *L,
     list = PyDict_GetItem(references, cycle_key);
     // list is now a borrowed reference or NULL
     if(list == NULL) {
-        list = PyList_New(1); // now we own list
+        list = PyList_New(0); // now we own list
         if(list == NULL) {
             // couldn't allocate
             goto error;
@@ -392,10 +802,12 @@ void store_python_capsule(lua_State *L,
         goto error;
     }
 
+    ret = 0;
+
 error:
     Py_XDECREF(cycle_key);
     Py_XDECREF(list);
-    // we never owned val
+    return ret;
 }
 
 
@@ -418,17 +830,30 @@ int free_python_capsule(lua_State *L) {
         luaL_unref(L, LUA_REGISTRYINDEX, capsule->cache_ref);
     }
 
+    // refund whatever we were charged
+    *(capsule->charged_to) -= capsule->charged;
+
     PyGILState_STATE gstate;
     gstate = PyGILState_Ensure();
 
+    remove_python_reference(references, capsule->val);
+
+    PyGILState_Release(gstate);
+    return 0; // number of return values
+}
+
+
+static void remove_python_reference(PyObject* references, PyObject* val) {
+    // the inverse of add_python_reference. The caller must hold the GIL
+
     // from here on out we must escape through error below
 
     PyObject *list=NULL, *key=NULL, *popped=NULL;
 
     // this is how cpython derives the builtin `id` function
-    key = PyLong_FromVoidPtr(capsule->val);
+    key = PyLong_FromVoidPtr(val);
     if(key == NULL) {
-        PyErr_WarnEx(NULL, "free_python_capsule couldn't make key", 0);
+        PyErr_WarnEx(NULL, "remove_python_reference couldn't make key", 0);
         PyErr_Print(); // we can't really raise exceptions here
         goto error;
     }
@@ -438,20 +863,20 @@ int free_python_capsule(lua_State *L) {
     // we can't really raise exceptions here. if one of these is happening
     // we're probably leaking memory
     if(list == NULL) {
-        PyErr_WarnEx(NULL, "free_python_capsule dangling reference (not found)", 0);
+        PyErr_WarnEx(NULL, "remove_python_reference dangling reference (not found)", 0);
         goto error;
     } else if(!PyList_Check(list)) {
-        PyErr_WarnEx(NULL, "free_python_capsule dangling reference (not a list)", 0);
+        PyErr_WarnEx(NULL, "remove_python_reference dangling reference (not a list)", 0);
         goto error;
     } else if(PyList_GET_SIZE(list)==0) {
-        PyErr_WarnEx(NULL, "free_python_capsule dangling reference (empty list)", 0);
+        PyErr_WarnEx(NULL, "remove_python_reference dangling reference (empty list)", 0);
         goto error;
     }
 
     // it doesn't really matter which reference we pop
     popped = PyObject_CallMethod(list, "pop", NULL);
     if(popped == NULL) {
-        PyErr_WarnEx(NULL, "free_python_capsule couldn't pop", 0);
+        PyErr_WarnEx(NULL, "remove_python_reference couldn't pop", 0);
         PyErr_Print(); // we can't really raise exceptions here
         goto error;
     }
@@ -460,7 +885,7 @@ int free_python_capsule(lua_State *L) {
         // we emptied it out, so remove the entry entirely
         int del_ret = PyDict_DelItem(references, key);
         if(del_ret==-1) {
-            PyErr_WarnEx(NULL, "free_python_capsule couldn't delitem", 0);
+            PyErr_WarnEx(NULL, "remove_python_reference couldn't delitem", 0);
             PyErr_Print(); // we can't really raise exceptions here
             goto error;
         }
@@ -472,9 +897,6 @@ error:
     // freed)
     Py_XDECREF(key);
     Py_XDECREF(popped);
-
-    PyGILState_Release(gstate);
-    return 0; // number of return values
 }
 
 
@@ -486,6 +908,9 @@ PyObject* decapsule(lua_capsule* capsule) {
 
 
 int lazy_capsule_index(lua_State *L) {
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
     lua_capsule *capsule =
         (lua_capsule*)luaL_checkudata(L, 1, EXECUTOR_LUA_CAPSULE_KEY);
     luaL_argcheck(L, capsule != NULL, 1, "python capsule expected"); // can longjmp out
@@ -503,6 +928,9 @@ int lazy_capsule_index(lua_State *L) {
 
     // stack is [key]
 
+    // see call_python_function_from_lua
+    lua_State* PL = python_stack(L, control, 1); // can longjmp out
+
     disable_limit_memory(L);
     // with the memory limiter disabled, we must now exit through finish_no_gil
 
@@ -520,6 +948,10 @@ int lazy_capsule_index(lua_State *L) {
     // stack is [key]
 
     lua_pushvalue(L, key_idx); // he'll consume this and leave the return value for us
+    int pl_top = lua_gettop(PL);
+    if(PL != L) {
+        lua_xmove(L, PL, 1);
+    }
     PyObject* ret = PyObject_CallFunction(index_proxy, "OOii",
                                           executor,
                                           capsule->val,
@@ -528,9 +960,16 @@ int lazy_capsule_index(lua_State *L) {
     // he either raises an exception or leaves the result at the top of the Lua
     // stack
     if(ret == NULL) {
+        if(PL != L) {
+            // see call_python_function_from_lua
+            lua_settop(PL, pl_top);
+        }
         // fixes the memory limiter and the GIL too
         return translate_python_exception(L, gstate);
     }
+    if(PL != L) {
+        lua_xmove(PL, L, 1);
+    }
     Py_DECREF(ret);
     PyGILState_Release(gstate);
 
@@ -650,85 +1089,4470 @@ PyObject* lua_string_to_python_buffer(lua_State* L, int idx) {
 }
 
 
-static int add_int_constant(PyObject* module, char* name, int value) {
-    PyObject *as_int = PyInt_FromLong(value);
-    if(as_int == NULL) {
-        return -1;
+static size_t typed_array_itemsize(int kind) {
+    switch(kind) {
+        case EXECUTOR_ARRAY_FLOAT64:
+            return sizeof(double);
+        case EXECUTOR_ARRAY_INT64:
+            return sizeof(int64_t);
+        case EXECUTOR_ARRAY_INT32:
+            return sizeof(int32_t);
     }
+    return 0;
+}
 
-    if(PyModule_AddObject(module, name, as_int) == 1) {
-        return -1;
-    }
 
-    return 0;
+static const char* typed_array_kind_name(int kind) {
+    switch(kind) {
+        case EXECUTOR_ARRAY_FLOAT64:
+            return "float64";
+        case EXECUTOR_ARRAY_INT64:
+            return "int64";
+        case EXECUTOR_ARRAY_INT32:
+            return "int32";
+    }
+    return "unknown";
 }
 
 
-static int add_str_constant(PyObject* module, char* name, char* value) {
-    PyObject *as_str = PyString_FromString(value);
-    if(as_str == NULL) {
-        return -1;
+int store_typed_array(lua_State *L, PyObject* owner, int kind) {
+    /*
+     * Wrap the memory behind `owner`'s buffer interface in a typed array
+     * userdata without copying it, and leave that on the top of the stack.
+     * Called from Python with the GIL held. On failure returns 0 with a
+     * Python exception set and leaves the stack as it was
+     */
+
+    size_t itemsize = typed_array_itemsize(kind);
+    if(itemsize == 0) {
+        PyErr_Format(PyExc_ValueError, "unknown typed array kind %d", kind);
+        return 0;
     }
 
-    if(PyModule_AddObject(module, name, as_str) == 1) {
-        return -1;
+    lua_typed_array* arr =
+        (lua_typed_array*)executor_newuserdata(L, sizeof(lua_typed_array));
+
+    // stack is [arr]. it doesn't have a metatable yet, so if we bail out
+    // before we set it, its __gc won't try to clean up anything we haven't
+    // built
+
+    arr->owner = owner;
+    arr->kind = kind;
+    arr->readonly = 0;
+    arr->has_view = 0;
+
+    Py_ssize_t size = 0;
+
+    if(PyObject_CheckBuffer(owner)) {
+        // new-style buffers let us pin the memory so the owner can't be
+        // resized out from under us while Lua can still see it
+        if(PyObject_GetBuffer(owner, &arr->view,
+                              PyBUF_SIMPLE|PyBUF_WRITABLE) == -1) {
+            PyErr_Clear();
+            if(PyObject_GetBuffer(owner, &arr->view, PyBUF_SIMPLE) == -1) {
+                goto error;
+            }
+            arr->readonly = 1;
+        }
+        arr->has_view = 1;
+        arr->data = (char*)arr->view.buf;
+        size = arr->view.len;
+    } else {
+        // old-style buffers (like array.array on Python 2) can't be pinned, so
+        // it's up to the caller not to resize them while Lua holds them
+        void* data = NULL;
+        if(PyObject_AsWriteBuffer(owner, &data, &size) == -1) {
+            PyErr_Clear();
+            const void* rdata = NULL;
+            if(PyObject_AsReadBuffer(owner, &rdata, &size) == -1) {
+                goto error;
+            }
+            data = (void*)rdata;
+            arr->readonly = 1;
+        }
+        arr->data = (char*)data;
+    }
+
+    if(size % itemsize != 0) {
+        PyErr_Format(PyExc_ValueError,
+                     "buffer of %zd bytes isn't a whole number of %s items",
+                     size, typed_array_kind_name(kind));
+        goto error;
+    }
+
+    arr->length = size / itemsize;
+
+    // we use the same reference strategy as capsules. See
+    // executor.py:Lua.__init__ for details
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+    if(add_python_reference(control->references, owner) == -1) {
+        goto error;
     }
 
+    // now that it's completely built, it's safe to give it its methods
+    lua_getfield(L, LUA_REGISTRYINDEX, EXECUTOR_LUA_ARRAY_KEY);
+    lua_setmetatable(L, -2);
+
+    return 1;
+
+error:
+    if(arr->has_view) {
+        PyBuffer_Release(&arr->view);
+    }
+    lua_pop(L, 1);
     return 0;
 }
 
 
-PyMODINIT_FUNC init_executor(void) {
-    // initialise the module
+int free_typed_array(lua_State *L) {
+    lua_typed_array* arr =
+        (lua_typed_array*)luaL_checkudata(L, 1, EXECUTOR_LUA_ARRAY_KEY);
 
-    PyObject* module = NULL;
+    // like free_python_capsule, we may run after the control block is gone
+    // so references comes from our upvalue
+    PyObject* references = lua_touserdata(L, lua_upvalueindex(1));
+    luaL_argcheck(L, references != NULL, -1, "upvalue missing?");
 
-    module = Py_InitModule3("lua_sandbox._executor",
-        NULL, /* no functions of our own */
-        "C portion that implements the Lua-Python bridge");
-    if (module == NULL) {
-        /* exception raised in preparing */
-        return;
+    PyGILState_STATE gstate;
+    gstate = PyGILState_Ensure();
+
+    if(arr->has_view) {
+        PyBuffer_Release(&arr->view);
+        arr->has_view = 0;
     }
 
-    /*
-        Lua keeps a bunch of really important constants in #defines so they
-        aren't accessible at runtime from ctypes. This just attempts to copy
-        them into the module's namespace so they are accessible at runtime
-    */
+    remove_python_reference(references, arr->owner);
 
-    if(add_int_constant(module, "LUA_REGISTRYINDEX", LUA_REGISTRYINDEX)==-1)
-        goto error;
+    PyGILState_Release(gstate);
 
-#ifdef LUA_GLOBALSINDEX
-    if(add_int_constant(module, "LUA_GLOBALSINDEX", LUA_GLOBALSINDEX)==-1)
-        goto error;
-#endif
+    arr->data = NULL;
+    arr->length = 0;
 
-    if(add_int_constant(module, "LUA_TNIL", LUA_TNIL)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TBOOLEAN", LUA_TBOOLEAN)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TLIGHTUSERDATA", LUA_TLIGHTUSERDATA)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TNUMBER", LUA_TNUMBER)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TSTRING", LUA_TSTRING)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TTABLE", LUA_TTABLE)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TFUNCTION", LUA_TFUNCTION)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TUSERDATA", LUA_TUSERDATA)==-1)
-        goto error;
-    if(add_int_constant(module, "LUA_TTHREAD", LUA_TTHREAD)==-1)
-        goto error;
+    return 0;
+}
 
-    if(add_int_constant(module, "LUA_MULTRET", LUA_MULTRET)==-1)
-        goto error;
 
-    if(add_int_constant(module, "LUA_OK", LUA_OK)==-1)
-        goto error;
+PyObject* typed_array_owner(lua_typed_array* arr) {
+    PyObject* ret = arr->owner;
+    Py_INCREF(ret); // the caller gets a new reference
+    return ret;
+}
+
+
+static lua_typed_array* check_typed_array(lua_State *L, int idx) {
+    // can longjmp out
+    return (lua_typed_array*)luaL_checkudata(L, idx, EXECUTOR_LUA_ARRAY_KEY);
+}
+
+
+static int typed_array_position(lua_State *L, lua_typed_array* arr,
+                                int key_idx, size_t* position) {
+    /*
+     * If the key at key_idx is an integer within the (1-indexed) bounds of
+     * the array, put its 0-indexed position into `position` and return true
+     */
+    if(lua_type(L, key_idx) != LUA_TNUMBER) {
+        return 0;
+    }
+
+    lua_Number n = lua_tonumber(L, key_idx);
+
+    if(n != floor(n) || n < 1 || n > (lua_Number)arr->length) {
+        return 0;
+    }
+
+    *position = (size_t)n - 1;
+    return 1;
+}
+
+
+static lua_Number typed_array_get_number(lua_typed_array* arr, size_t i) {
+    double d;
+    int64_t i64;
+    int32_t i32;
+
+    switch(arr->kind) {
+        case EXECUTOR_ARRAY_FLOAT64:
+            // the buffer isn't necessarily aligned, so always memcpy
+            memcpy(&d, arr->data + i*sizeof(d), sizeof(d));
+            return (lua_Number)d;
+        case EXECUTOR_ARRAY_INT64:
+            memcpy(&i64, arr->data + i*sizeof(i64), sizeof(i64));
+            return (lua_Number)i64;
+        case EXECUTOR_ARRAY_INT32:
+        default:
+            memcpy(&i32, arr->data + i*sizeof(i32), sizeof(i32));
+            return (lua_Number)i32;
+    }
+}
+
+
+static int64_t typed_array_get_integer(lua_typed_array* arr, size_t i) {
+    int64_t i64;
+    int32_t i32;
+
+    if(arr->kind == EXECUTOR_ARRAY_INT64) {
+        memcpy(&i64, arr->data + i*sizeof(i64), sizeof(i64));
+        return i64;
+    }
+
+    memcpy(&i32, arr->data + i*sizeof(i32), sizeof(i32));
+    return (int64_t)i32;
+}
+
+
+static void push_typed_array_item(lua_State *L, lua_typed_array* arr,
+                                  size_t i) {
+    if(arr->kind == EXECUTOR_ARRAY_FLOAT64) {
+        lua_pushnumber(L, typed_array_get_number(arr, i));
+    } else {
+        lua_pushinteger(L, (lua_Integer)typed_array_get_integer(arr, i));
+    }
+}
+
+
+static int64_t check_typed_array_integer(lua_State *L, int kind, int idx) {
+    /*
+     * Get the number at idx as an integer that fits in an array of the given
+     * kind, raising a Lua error if it won't
+     */
+
+    int64_t ret;
+
+#if LUA_VERSION_NUM >= 503
+    if(lua_isinteger(L, idx)) {
+        ret = (int64_t)lua_tointeger(L, idx);
+    } else
+#endif
+    {
+        lua_Number n = luaL_checknumber(L, idx);
+        // 2**63 is exactly representable so this is an exact bounds check
+        if(n != floor(n) || n < -9223372036854775808.0
+           || n >= 9223372036854775808.0) {
+            return luaL_error(L, "%f doesn't fit in a %s array",
+                              n, typed_array_kind_name(kind));
+        }
+        ret = (int64_t)n;
+    }
+
+    if(kind == EXECUTOR_ARRAY_INT32 && (ret < INT32_MIN || ret > INT32_MAX)) {
+        return luaL_error(L, "%f doesn't fit in a %s array",
+                          (lua_Number)ret, typed_array_kind_name(kind));
+    }
+
+    return ret;
+}
+
+
+static void set_typed_array_item(lua_State *L, lua_typed_array* arr,
+                                 size_t i, int value_idx) {
+    double d;
+    int64_t i64;
+    int32_t i32;
+
+    switch(arr->kind) {
+        case EXECUTOR_ARRAY_FLOAT64:
+            d = (double)luaL_checknumber(L, value_idx);
+            memcpy(arr->data + i*sizeof(d), &d, sizeof(d));
+            break;
+        case EXECUTOR_ARRAY_INT64:
+            i64 = check_typed_array_integer(L, arr->kind, value_idx);
+            memcpy(arr->data + i*sizeof(i64), &i64, sizeof(i64));
+            break;
+        case EXECUTOR_ARRAY_INT32:
+            i32 = (int32_t)check_typed_array_integer(L, arr->kind, value_idx);
+            memcpy(arr->data + i*sizeof(i32), &i32, sizeof(i32));
+            break;
+    }
+}
+
+
+int typed_array_index(lua_State *L) {
+    // none of the typed array methods need the GIL. They only touch the raw
+    // memory that the owner is keeping alive for us
+    lua_typed_array* arr = check_typed_array(L, 1);
+    size_t position;
+
+    if(!typed_array_position(L, arr, 2, &position)) {
+        // we follow the Lua convention of returning nil for non-present keys,
+        // which also keeps ipairs working
+        lua_pushnil(L);
+        return 1;
+    }
+
+    push_typed_array_item(L, arr, position);
+    return 1;
+}
+
+
+int typed_array_newindex(lua_State *L) {
+    lua_typed_array* arr = check_typed_array(L, 1);
+    size_t position;
+
+    if(arr->readonly) {
+        return luaL_error(L, "typed array is read-only");
+    }
+
+    if(!typed_array_position(L, arr, 2, &position)) {
+        // unlike tables these can't grow
+        return luaL_error(L, "typed array index out of bounds (length %d)",
+                          (int)arr->length);
+    }
+
+    set_typed_array_item(L, arr, position, 3);
+    return 0;
+}
+
+
+int typed_array_len(lua_State *L) {
+    lua_typed_array* arr = check_typed_array(L, 1);
+    lua_pushinteger(L, (lua_Integer)arr->length);
+    return 1;
+}
+
+
+static int int64_add(int64_t a, int64_t b, int64_t* out) {
+    // a+b into out, or return 0 if it would overflow (which is undefined for
+    // signed integers, so we have to check before we do it)
+    if((b > 0 && a > INT64_MAX - b) || (b < 0 && a < INT64_MIN - b)) {
+        return 0;
+    }
+    *out = a + b;
+    return 1;
+}
+
+
+static int int64_mul(int64_t a, int64_t b, int64_t* out) {
+    // like int64_add, for a*b
+    if(a > 0) {
+        if(b > 0 ? a > INT64_MAX / b : b < INT64_MIN / a) {
+            return 0;
+        }
+    } else if(a < 0) {
+        if(b > 0 ? a < INT64_MIN / b : b < INT64_MAX / a) {
+            return 0;
+        }
+    }
+    *out = a * b;
+    return 1;
+}
+
+
+static int typed_array_sum(lua_State *L) {
+    lua_typed_array* arr = check_typed_array(L, 1);
+    size_t i;
+
+    if(arr->kind == EXECUTOR_ARRAY_FLOAT64) {
+        lua_Number total = 0;
+        for(i=0; i<arr->length; i++) {
+            total += typed_array_get_number(arr, i);
+        }
+        lua_pushnumber(L, total);
+    } else {
+        int64_t total = 0;
+        for(i=0; i<arr->length; i++) {
+            if(!int64_add(total, typed_array_get_integer(arr, i), &total)) {
+                return luaL_error(L, "sum overflowed an int64");
+            }
+        }
+        lua_pushinteger(L, (lua_Integer)total);
+    }
+
+    return 1;
+}
+
+
+static int typed_array_dot(lua_State *L) {
+    lua_typed_array* a = check_typed_array(L, 1);
+    lua_typed_array* b = check_typed_array(L, 2);
+    size_t i;
+
+    luaL_argcheck(L, a->length == b->length, 2, "array lengths differ");
+
+    lua_Number total = 0;
+    for(i=0; i<a->length; i++) {
+        total += typed_array_get_number(a, i) * typed_array_get_number(b, i);
+    }
+    lua_pushnumber(L, total);
+
+    return 1;
+}
+
+
+static int typed_array_extreme(lua_State *L, int want_max) {
+    lua_typed_array* arr = check_typed_array(L, 1);
+    size_t i;
+
+    if(arr->length == 0) {
+        lua_pushnil(L);
+        return 1;
+    }
+
+    if(arr->kind == EXECUTOR_ARRAY_FLOAT64) {
+        lua_Number found = typed_array_get_number(arr, 0);
+        for(i=1; i<arr->length; i++) {
+            lua_Number n = typed_array_get_number(arr, i);
+            if(want_max ? n > found : n < found) {
+                found = n;
+            }
+        }
+        lua_pushnumber(L, found);
+    } else {
+        int64_t found = typed_array_get_integer(arr, 0);
+        for(i=1; i<arr->length; i++) {
+            int64_t n = typed_array_get_integer(arr, i);
+            if(want_max ? n > found : n < found) {
+                found = n;
+            }
+        }
+        lua_pushinteger(L, (lua_Integer)found);
+    }
+
+    return 1;
+}
+
+
+static int typed_array_min(lua_State *L) {
+    return typed_array_extreme(L, 0);
+}
+
+
+static int typed_array_max(lua_State *L) {
+    return typed_array_extreme(L, 1);
+}
+
+
+static int typed_array_scale(lua_State *L) {
+    // multiply every item in place by the factor, returning the array
+    lua_typed_array* arr = check_typed_array(L, 1);
+    size_t i;
+
+    if(arr->readonly) {
+        return luaL_error(L, "typed array is read-only");
+    }
+
+    if(arr->kind == EXECUTOR_ARRAY_FLOAT64) {
+        double factor = (double)luaL_checknumber(L, 2);
+        for(i=0; i<arr->length; i++) {
+            double d = (double)typed_array_get_number(arr, i) * factor;
+            memcpy(arr->data + i*sizeof(d), &d, sizeof(d));
+        }
+    } else {
+        // only integer factors can keep an integer array integral
+        int64_t factor = check_typed_array_integer(L, EXECUTOR_ARRAY_INT64, 2);
+        int64_t i64;
+
+        // check every item before we write any of them so that an overflow
+        // doesn't leave the array half-scaled
+        for(i=0; i<arr->length; i++) {
+            if(!int64_mul(typed_array_get_integer(arr, i), factor, &i64)
+               || (arr->kind == EXECUTOR_ARRAY_INT32
+                   && (i64 < INT32_MIN || i64 > INT32_MAX))) {
+                return luaL_error(L, "scale overflowed a %s array",
+                                  typed_array_kind_name(arr->kind));
+            }
+        }
+
+        for(i=0; i<arr->length; i++) {
+            i64 = typed_array_get_integer(arr, i) * factor;
+            if(arr->kind == EXECUTOR_ARRAY_INT64) {
+                memcpy(arr->data + i*sizeof(i64), &i64, sizeof(i64));
+            } else {
+                int32_t i32 = (int32_t)i64;
+                memcpy(arr->data + i*sizeof(i32), &i32, sizeof(i32));
+            }
+        }
+    }
+
+    lua_pushvalue(L, 1);
+    return 1;
+}
+
+
+static const luaL_Reg typed_array_lib[] = {
+    {"dot", typed_array_dot},
+    {"max", typed_array_max},
+    {"min", typed_array_min},
+    {"scale", typed_array_scale},
+    {"sum", typed_array_sum},
+    {NULL, NULL}
+};
+
+
+static void set_functions(lua_State *L, const luaL_Reg* funcs) {
+    // like luaL_setfuncs without upvalues, which luajit doesn't have. Sets
+    // every function into the table at the top of the stack
+    for(; funcs->name != NULL; funcs++) {
+        lua_pushcclosure(L, funcs->func, 0);
+        lua_setfield(L, -2, funcs->name);
+    }
+}
+
+
+void install_typed_array(lua_State *L, PyObject* references) {
+    /*
+     * Install the metatable that typed arrays get, and the global `array`
+     * library of helpers that operate on them
+     */
+    luaL_newmetatable(L, EXECUTOR_LUA_ARRAY_KEY);
+
+    // free_typed_array needs his own copy of references for the same reasons
+    // as free_python_capsule
+    lua_pushlightuserdata(L, references);
+    lua_pushcclosure(L, free_typed_array, 1);
+    lua_setfield(L, -2, "__gc");
+
+    lua_pushcclosure(L, typed_array_index, 0);
+    lua_setfield(L, -2, "__index");
+
+    lua_pushcclosure(L, typed_array_newindex, 0);
+    lua_setfield(L, -2, "__newindex");
+
+    lua_pushcclosure(L, typed_array_len, 0);
+    lua_setfield(L, -2, "__len");
+
+    // so we can identify it
+    lua_pushstring(L, "typedarray");
+    lua_setfield(L, -2, "typedarray");
+
+    lua_pop(L, 1); // the metatable
+
+    lua_createtable(L, 0, sizeof(typed_array_lib)/sizeof(luaL_Reg) - 1);
+    set_functions(L, typed_array_lib);
+    lua_setglobal(L, "array");
+}
+
+
+Py_ssize_t lua_sequence_length(lua_State *L, int idx) {
+    /*
+     * Make sure that the value at idx is a table and return its length, or -1
+     * with a Python exception set if it isn't. Whether it's really a sequence
+     * is checked as it's converted (see sequence_next)
+     */
+    idx = abs_index(L, idx);
+
+    if(lua_type(L, idx) != LUA_TTABLE) {
+        PyErr_Format(PyExc_TypeError, "expected a table, not %s",
+                     luaL_typename(L, idx));
+        return -1;
+    }
+
+    return (Py_ssize_t)executor_rawlen(L, idx);
+}
+
+
+static int sequence_next(lua_State *L, int idx, Py_ssize_t n,
+                         Py_ssize_t* position) {
+    /*
+     * One step of a lua_next traversal (so the previous key must be on the
+     * top of the stack) over the table at idx, which claims to be a sequence
+     * of n numbers. Returns 1 and leaves [key, value] on the stack with the
+     * 0-indexed position of the item in `position`, 0 when there's nothing
+     * left, or -1 with a Python exception set and the stack back how it was
+     * before the traversal if the table isn't a sequence of numbers.
+     *
+     * Since every key has to be unique and in 1..n, a traversal that sees n
+     * of them has seen the whole sequence. That lets the converters check and
+     * fill in a single pass instead of counting the keys first
+     */
+    if(lua_next(L, idx) == 0) {
+        return 0;
+    }
+
+    lua_Number k = lua_type(L, -2) == LUA_TNUMBER ? lua_tonumber(L, -2) : 0;
+
+    if(k != floor(k) || k < 1 || k > (lua_Number)n) {
+        PyErr_Format(PyExc_ValueError,
+                     "table isn't a sequence (length %zd but has key %s)",
+                     n, lua_type(L, -2) == LUA_TNUMBER
+                        ? lua_tostring(L, -2) : luaL_typename(L, -2));
+        lua_pop(L, 2);
+        return -1;
+    }
+
+    if(lua_type(L, -1) != LUA_TNUMBER) {
+        PyErr_Format(PyExc_ValueError,
+                     "item %zd is a %s, not a number",
+                     (Py_ssize_t)k, luaL_typename(L, -1));
+        lua_pop(L, 2);
+        return -1;
+    }
+
+    *position = (Py_ssize_t)k - 1;
+    return 1;
+}
+
+
+static int check_sequence_count(Py_ssize_t n, Py_ssize_t count) {
+    // after a traversal, make sure that we saw all n of the items
+    if(count != n) {
+        PyErr_Format(PyExc_ValueError,
+                     "table isn't a sequence (length %zd but %zd keys)",
+                     n, count);
+        return 0;
+    }
+    return 1;
+}
+
+
+static int sequence_integer(lua_State *L, int kind, Py_ssize_t position,
+                            int64_t* out) {
+    /*
+     * Get the number on the top of the stack into out as an integer that fits
+     * in an array of the given kind, or return 0 with a Python exception set.
+     * On 5.3+ integers are taken as they are rather than through lua_Number,
+     * which can't hold every int64
+     */
+    int64_t ret;
+
+#if LUA_VERSION_NUM >= 503
+    if(lua_isinteger(L, -1)) {
+        ret = (int64_t)lua_tointeger(L, -1);
+    } else
+#endif
+    {
+        lua_Number num = lua_tonumber(L, -1);
+        if(num != floor(num) || num < -9223372036854775808.0
+           || num >= 9223372036854775808.0) {
+            PyErr_Format(PyExc_ValueError,
+                         "item %zd (%s) doesn't fit in a %s array",
+                         position+1, lua_tostring(L, -1),
+                         typed_array_kind_name(kind));
+            return 0;
+        }
+        ret = (int64_t)num;
+    }
+
+    if(kind == EXECUTOR_ARRAY_INT32 && (ret < INT32_MIN || ret > INT32_MAX)) {
+        PyErr_Format(PyExc_ValueError,
+                     "item %zd (%lld) doesn't fit in a %s array",
+                     position+1, (long long)ret, typed_array_kind_name(kind));
+        return 0;
+    }
+
+    *out = ret;
+    return 1;
+}
+
+
+int lua_sequence_to_buffer(lua_State *L, int idx, PyObject* out, int kind) {
+    /*
+     * Copy the numeric sequence at idx into the writable buffer `out`, which
+     * must already be exactly the right size (see lua_sequence_length).
+     * Returns 0 with a Python exception set on failure
+     */
+    idx = abs_index(L, idx);
+
+    Py_ssize_t n = lua_sequence_length(L, idx);
+    if(n == -1) {
+        return 0;
+    }
+
+    size_t itemsize = typed_array_itemsize(kind);
+    if(itemsize == 0) {
+        PyErr_Format(PyExc_ValueError, "unknown typed array kind %d", kind);
+        return 0;
+    }
+
+    void* data = NULL;
+    Py_ssize_t size = 0;
+    if(PyObject_AsWriteBuffer(out, &data, &size) == -1) {
+        return 0;
+    }
+
+    if((size_t)size != n*itemsize) {
+        PyErr_Format(PyExc_ValueError,
+                     "buffer is %zd bytes but %zd %s items need %zu",
+                     size, n, typed_array_kind_name(kind), n*itemsize);
+        return 0;
+    }
+
+    char* cdata = (char*)data;
+    Py_ssize_t count = 0;
+    Py_ssize_t position;
+    int found;
+
+    lua_pushnil(L);
+    while((found = sequence_next(L, idx, n, &position)) == 1) {
+        count++;
+
+        if(kind == EXECUTOR_ARRAY_FLOAT64) {
+            double d = (double)lua_tonumber(L, -1);
+            memcpy(cdata + position*sizeof(d), &d, sizeof(d));
+        } else {
+            int64_t i64;
+            if(!sequence_integer(L, kind, position, &i64)) {
+                lua_pop(L, 2); // the key and value
+                return 0;
+            }
+
+            if(kind == EXECUTOR_ARRAY_INT64) {
+                memcpy(cdata + position*sizeof(i64), &i64, sizeof(i64));
+            } else {
+                int32_t i32 = (int32_t)i64;
+                memcpy(cdata + position*sizeof(i32), &i32, sizeof(i32));
+            }
+        }
+
+        lua_pop(L, 1); // removes value, leaves key for next iteration
+    }
+
+    return found == 0 && check_sequence_count(n, count);
+}
+
+
+static PyObject* lua_number_to_python(lua_State *L, int idx) {
+    /*
+     * The number at idx as a Python float, or on 5.3+ as an int if it's a Lua
+     * integer
+     */
+#if LUA_VERSION_NUM >= 503
+    if(lua_isinteger(L, idx)) {
+        lua_Integer i = lua_tointeger(L, idx);
+        if(i >= LONG_MIN && i <= LONG_MAX) {
+            return PyInt_FromLong((long)i);
+        }
+        return PyLong_FromLongLong((PY_LONG_LONG)i);
+    }
+#endif
+    return PyFloat_FromDouble((double)lua_tonumber(L, idx));
+}
+
+
+PyObject* lua_sequence_to_list(lua_State *L, int idx) {
+    /*
+     * Build a Python list out of the numeric sequence at idx, converting its
+     * items like to_python does. Returns NULL with a Python exception set on
+     * failure
+     */
+    idx = abs_index(L, idx);
+
+    Py_ssize_t n = lua_sequence_length(L, idx);
+    if(n == -1) {
+        return NULL;
+    }
+
+    // its items start out NULL, which it knows how to clean up if we fail
+    // before we've filled them all in
+    PyObject* ret = PyList_New(n);
+    if(ret == NULL) {
+        return NULL;
+    }
+
+    Py_ssize_t count = 0;
+    Py_ssize_t position;
+    int found;
+
+    lua_pushnil(L);
+    while((found = sequence_next(L, idx, n, &position)) == 1) {
+        count++;
+
+        PyObject* item = lua_number_to_python(L, -1);
+        if(item == NULL) {
+            lua_pop(L, 2); // the key and value
+            Py_DECREF(ret);
+            return NULL;
+        }
+        PyList_SET_ITEM(ret, position, item); // steals the reference
+
+        lua_pop(L, 1); // removes value, leaves key for next iteration
+    }
+
+    if(found == -1 || !check_sequence_count(n, count)) {
+        Py_DECREF(ret);
+        return NULL;
+    }
+
+    return ret;
+}
+
+
+static void* test_userdata(lua_State *L, int idx, const char* key) {
+    /*
+     * Like luaL_testudata (which luajit doesn't have): return the userdata at
+     * idx if its metatable is the one registered under key, otherwise NULL.
+     * Never raises
+     */
+    void* p = lua_touserdata(L, idx);
+
+    if(p == NULL || !lua_getmetatable(L, idx)) {
+        return NULL;
+    }
+
+    lua_getfield(L, LUA_REGISTRYINDEX, key);
+    if(!lua_rawequal(L, -1, -2)) {
+        p = NULL;
+    }
+    lua_pop(L, 2); // both metatables
+
+    return p;
+}
+
+
+static PyObject* to_python_recursive(lua_State *L, int idx,
+                                     PyObject* fallback, PyObject* executor,
+                                     int depth) {
+    /*
+     * The C equivalent of LuaValue._to_python. Returns a new reference or
+     * NULL with a Python exception set, and leaves the stack as it found it.
+     * Anything we don't know how to convert natively (like functions) is
+     * pushed and handed to `fallback(executor)`, which must consume it
+     */
+    idx = abs_index(L, idx);
+
+    int kind = lua_type(L, idx);
+    void* ud;
+
+    switch(kind) {
+        case LUA_TNIL:
+            Py_RETURN_NONE;
+
+        case LUA_TBOOLEAN:
+            return PyBool_FromLong(lua_toboolean(L, idx));
+
+        case LUA_TNUMBER:
+            return lua_number_to_python(L, idx);
+
+        case LUA_TSTRING: {
+            size_t size = 0;
+            const char* str = lua_tolstring(L, idx, &size);
+            // since that's a ptr into Lua state this copies it out
+            return PyString_FromStringAndSize(str, size);
+        }
+
+        case LUA_TTABLE:
+            break;
+
+        case LUA_TUSERDATA:
+            if((ud = test_userdata(L, idx, EXECUTOR_LUA_CAPSULE_KEY))) {
+                return decapsule((lua_capsule*)ud);
+            }
+            if((ud = test_userdata(L, idx, EXECUTOR_LUA_ARRAY_KEY))) {
+                return typed_array_owner((lua_typed_array*)ud);
+            }
+            // fallthrough
+
+        default:
+            lua_pushvalue(L, idx);
+            return PyObject_CallFunctionObjArgs(fallback, executor, NULL);
+    }
+
+    // only tables make it down here
+
+    if(depth > EXECUTOR_MAX_CONVERSION_DEPTH) {
+        PyErr_Format(PyExc_ValueError, "recursed too much (%d>%d)",
+                     depth, EXECUTOR_MAX_CONVERSION_DEPTH);
+        return NULL;
+    }
+
+    if(!lua_checkstack(L, 3)) {
+        PyErr_SetString(PyExc_MemoryError, "to_python.checkstack");
+        return NULL;
+    }
+
+    PyObject* ret = PyDict_New();
+    if(ret == NULL) {
+        return NULL;
+    }
+
+    lua_pushnil(L); // first key
+    while(lua_next(L, idx) != 0) {
+        // `key' is at index -2 and `value' at index -1
+        PyObject* value = to_python_recursive(L, -1, fallback, executor,
+                                              depth+1);
+        PyObject* key = value ? to_python_recursive(L, -2, fallback,
+                                                    executor, depth+1)
+                              : NULL;
+
+        int failed = key == NULL || PyDict_SetItem(ret, key, value) == -1;
+
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+
+        if(failed) {
+            lua_pop(L, 2); // the key and the value
+            Py_DECREF(ret);
+            return NULL;
+        }
+
+        // removes value, leaves key for next iteration
+        lua_pop(L, 1);
+    }
+
+    return ret;
+}
+
+
+PyObject* lua_to_python(lua_State *L, int idx,
+                        PyObject* fallback, PyObject* executor) {
+    return to_python_recursive(L, idx, fallback, executor, 0);
+}
+
+
+PyObject* pop_python_tuple(lua_State *L, int n,
+                           PyObject* fallback, PyObject* executor) {
+    /*
+     * Convert the top n values on the stack into a tuple and pop them, whether
+     * or not that succeeds
+     */
+    int first = lua_gettop(L) - n + 1;
+    int i;
+
+    PyObject* ret = PyTuple_New(n);
+
+    for(i=0; ret != NULL && i<n; i++) {
+        PyObject* item = to_python_recursive(L, first+i, fallback, executor, 0);
+        if(item == NULL) {
+            Py_CLEAR(ret);
+            break;
+        }
+        PyTuple_SET_ITEM(ret, i, item); // steals the reference
+    }
+
+    lua_pop(L, n);
+
+    return ret;
+}
+
+
+static int push_python_key(lua_State *L, PyObject* key) {
+    /*
+     * Push the handful of Python types that make sense as table keys without
+     * going through LuaValue.from_python. Returns 0 (pushing nothing) for
+     * anything else
+     */
+    if(PyString_Check(key)) {
+        lua_pushlstring(L, PyString_AS_STRING(key), PyString_GET_SIZE(key));
+        return 1;
+
+    } else if(PyUnicode_Check(key)) {
+        PyObject* encoded = PyUnicode_AsUTF8String(key);
+        if(encoded == NULL) {
+            PyErr_Clear();
+            return 0;
+        }
+        lua_pushlstring(L, PyString_AS_STRING(encoded),
+                        PyString_GET_SIZE(encoded));
+        Py_DECREF(encoded);
+        return 1;
+
+    } else if(PyBool_Check(key)) {
+        lua_pushboolean(L, key == Py_True);
+        return 1;
+
+    } else if(PyInt_Check(key) || PyLong_Check(key)) {
+#if LUA_VERSION_NUM >= 503
+        int overflow = 0;
+        PY_LONG_LONG i = PyLong_AsLongLongAndOverflow(key, &overflow);
+        if(i == -1 && PyErr_Occurred()) {
+            PyErr_Clear();
+            return 0;
+        }
+        if(!overflow && i >= LUA_MININTEGER && i <= LUA_MAXINTEGER) {
+            lua_pushinteger(L, (lua_Integer)i);
+            return 1;
+        }
+#endif
+        double d = PyFloat_AsDouble(key);
+        if(d == -1.0 && PyErr_Occurred()) {
+            PyErr_Clear();
+            return 0;
+        }
+        lua_pushnumber(L, (lua_Number)d);
+        return 1;
+
+    } else if(PyFloat_Check(key)) {
+        lua_pushnumber(L, (lua_Number)PyFloat_AS_DOUBLE(key));
+        return 1;
+    }
+
+    return 0;
+}
+
+
+static PyObject* table_view_value(lua_State *L, int idx,
+                                  PyObject* wrap, PyObject* executor) {
+    /*
+     * Like to_python_recursive, but tables aren't walked. They're pushed and
+     * handed to `wrap(executor)` like anything else we can't convert natively
+     */
+    if(lua_type(L, idx) == LUA_TTABLE) {
+        lua_pushvalue(L, idx);
+        return PyObject_CallFunctionObjArgs(wrap, executor, NULL);
+    }
+    return to_python_recursive(L, idx, wrap, executor, 0);
+}
+
+
+PyObject* table_view_get(lua_State *L, int idx, PyObject* key,
+                         PyObject* wrap, PyObject* executor) {
+    /*
+     * One field of the table at idx for LuaTableView, raising KeyError if it's
+     * nil. Leaves the stack as it found it
+     */
+    idx = abs_index(L, idx);
+
+    if(!lua_checkstack(L, 2)) {
+        PyErr_SetString(PyExc_MemoryError, "table_view_get.checkstack");
+        return NULL;
+    }
+
+    if(!push_python_key(L, key)) {
+        // not something that Lua could have as a key
+        PyErr_SetObject(PyExc_KeyError, key);
+        return NULL;
+    }
+
+    lua_rawget(L, idx);
+
+    if(lua_isnil(L, -1)) {
+        lua_pop(L, 1);
+        PyErr_SetObject(PyExc_KeyError, key);
+        return NULL;
+    }
+
+    PyObject* ret = table_view_value(L, -1, wrap, executor);
+    lua_pop(L, 1);
+    return ret;
+}
+
+
+PyObject* table_view_next(lua_State *L, int idx,
+                          PyObject* wrap, PyObject* executor) {
+    /*
+     * One step of lua_next for iterating a LuaTableView. Expects the previous
+     * key (or nil to start) on top of the stack and pops it. Returns () when
+     * we're done, or a 1-tuple of the next key converted to Python in which
+     * case the Lua version of it is left on the stack for the next call
+     */
+    idx = abs_index(L, idx);
+
+    if(!lua_checkstack(L, 2)) {
+        lua_pop(L, 1);
+        PyErr_SetString(PyExc_MemoryError, "table_view_next.checkstack");
+        return NULL;
+    }
+
+    if(lua_next(L, idx) == 0) {
+        return PyTuple_New(0);
+    }
+
+    // the key is at -2 and the value at -1, which we don't need
+    lua_pop(L, 1);
+
+    PyObject* key = table_view_value(L, -1, wrap, executor);
+    if(key == NULL) {
+        lua_pop(L, 1);
+        return NULL;
+    }
+
+    PyObject* ret = PyTuple_Pack(1, key);
+    Py_DECREF(key);
+    if(ret == NULL) {
+        lua_pop(L, 1);
+    }
+    return ret;
+}
+
+
+Py_ssize_t table_view_length(lua_State *L, int idx) {
+    // the number of keys in the table at idx, which isn't what # tells you
+    Py_ssize_t n = 0;
+
+    idx = abs_index(L, idx);
+
+    if(!lua_checkstack(L, 2)) {
+        return -1;
+    }
+
+    lua_pushnil(L);
+    while(lua_next(L, idx) != 0) {
+        n++;
+        lua_pop(L, 1);
+    }
+
+    return n;
+}
+
+
+static int schema_mismatch(PyObject* val, const char* expected) {
+    PyErr_Format(PyExc_TypeError, "expected %s, got %s",
+                 expected, Py_TYPE(val)->tp_name);
+    return 0;
+}
+
+
+static int schema_push(lua_State *L, int keys, PyObject* type, PyObject* val,
+                       PyObject* fallback, PyObject* executor, int depth) {
+    /*
+     * Push val as described by `type`, one of the (kind, sub, cls)
+     * descriptors built by executor.py:SchemaConverter. keys is the index of
+     * the table of the schema's key strings. Returns 0 with a Python exception
+     * set and nothing pushed if val doesn't fit. None is nil for any type
+     */
+    if(val == Py_None) {
+        lua_pushnil(L);
+        return 1;
+    }
+
+    long kind = PyInt_AS_LONG(PyTuple_GET_ITEM(type, 0));
+    PyObject* sub = PyTuple_GET_ITEM(type, 1);
+    Py_ssize_t i, n;
+
+    switch(kind) {
+        case EXECUTOR_SCHEMA_STR:
+            if(!PyString_Check(val) && !PyUnicode_Check(val)) {
+                return schema_mismatch(val, "a string");
+            }
+            break;
+
+        case EXECUTOR_SCHEMA_INT:
+            if(PyBool_Check(val) || !(PyInt_Check(val) || PyLong_Check(val))) {
+                return schema_mismatch(val, "an int");
+            }
+            break;
+
+        case EXECUTOR_SCHEMA_FLOAT: {
+            if(PyBool_Check(val) || !(PyFloat_Check(val) || PyInt_Check(val)
+                                      || PyLong_Check(val))) {
+                return schema_mismatch(val, "a float");
+            }
+            double d = PyFloat_AsDouble(val);
+            if(d == -1.0 && PyErr_Occurred()) {
+                return 0;
+            }
+            lua_pushnumber(L, (lua_Number)d);
+            return 1;
+        }
+
+        case EXECUTOR_SCHEMA_BOOL:
+            if(!PyBool_Check(val)) {
+                return schema_mismatch(val, "a bool");
+            }
+            lua_pushboolean(L, val == Py_True);
+            return 1;
+
+        case EXECUTOR_SCHEMA_RECORD:
+        case EXECUTOR_SCHEMA_LIST:
+            if(depth > EXECUTOR_MAX_CONVERSION_DEPTH) {
+                PyErr_Format(PyExc_ValueError, "recursed too much (%d>%d)",
+                             depth, EXECUTOR_MAX_CONVERSION_DEPTH);
+                return 0;
+            }
+            if(PyString_Check(val) || PyUnicode_Check(val)
+               || PyNumber_Check(val)) {
+                return schema_mismatch(val, kind == EXECUTOR_SCHEMA_RECORD
+                                            ? "a record" : "a sequence");
+            }
+            if(!lua_checkstack(L, 3)) {
+                PyErr_SetString(PyExc_MemoryError, "schema_push.checkstack");
+                return 0;
+            }
+            if(kind == EXECUTOR_SCHEMA_RECORD) {
+                return schema_push_record(L, keys, sub, val, fallback,
+                                          executor, depth);
+            }
+
+            if(PyDict_Check(val)) {
+                return schema_mismatch(val, "a sequence");
+            }
+
+            PyObject* seq = PySequence_Fast(val, "expected a sequence");
+            if(seq == NULL) {
+                return 0;
+            }
+
+            n = PySequence_Fast_GET_SIZE(seq);
+            lua_createtable(L, (int)n, 0);
+
+            for(i=0; i<n; i++) {
+                PyObject* item = PySequence_Fast_GET_ITEM(seq, i);
+                if(item == Py_None) {
+                    continue;
+                }
+                if(!schema_push(L, keys, sub, item, fallback, executor,
+                                depth+1)) {
+                    Py_DECREF(seq);
+                    lua_pop(L, 1); // the table
+                    return 0;
+                }
+                lua_rawseti(L, -2, (int)(i+1));
+            }
+
+            Py_DECREF(seq);
+            return 1;
+
+        default: {
+            // anything goes, so it's up to from_python
+            PyObject* pushed = PyObject_CallFunctionObjArgs(fallback, executor,
+                                                            val, NULL);
+            if(pushed == NULL) {
+                return 0;
+            }
+            Py_DECREF(pushed);
+            return 1;
+        }
+    }
+
+    // strings and ints
+    if(!push_python_key(L, val)) {
+        PyErr_Format(PyExc_ValueError, "can't convert this %s",
+                     Py_TYPE(val)->tp_name);
+        return 0;
+    }
+    return 1;
+}
+
+
+static int schema_push_record(lua_State *L, int keys, PyObject* fields,
+                              PyObject* val, PyObject* fallback,
+                              PyObject* executor, int depth) {
+    /*
+     * The record part of schema_push. Fields are read out of dicts by name,
+     * tuples (like namedtuples) by position, and anything else by attribute.
+     * Tuples must have exactly one item per field and other objects every
+     * field as an attribute, but dicts may leave fields out to make them nil.
+     * Keys that aren't in the schema are ignored
+     */
+    Py_ssize_t n = PyTuple_GET_SIZE(fields);
+    Py_ssize_t i;
+    int is_dict = PyDict_Check(val);
+    int by_position = PyTuple_Check(val);
+
+    if(by_position && PyTuple_GET_SIZE(val) != n) {
+        PyErr_Format(PyExc_TypeError,
+                     "expected a record of %zd fields, got a tuple of %zd",
+                     n, PyTuple_GET_SIZE(val));
+        return 0;
+    }
+    if(PyList_Check(val)) {
+        return schema_mismatch(val, "a record");
+    }
+
+    lua_createtable(L, 0, (int)n);
+
+    for(i=0; i<n; i++) {
+        PyObject* field = PyTuple_GET_ITEM(fields, i);
+        PyObject* name = PyTuple_GET_ITEM(field, 0);
+        PyObject* value;
+
+        if(is_dict) {
+            value = PyDict_GetItem(val, name);
+            Py_XINCREF(value);
+        } else if(by_position) {
+            value = PyTuple_GET_ITEM(val, i);
+            Py_INCREF(value);
+        } else {
+            value = PyObject_GetAttr(val, name);
+            if(value == NULL) {
+                if(PyErr_ExceptionMatches(PyExc_AttributeError)) {
+                    PyErr_Clear();
+                    PyErr_Format(PyExc_TypeError, "expected a record, got "
+                                 "%s missing field '%s'",
+                                 Py_TYPE(val)->tp_name,
+                                 PyString_AS_STRING(name));
+                }
+                lua_pop(L, 1); // the table
+                return 0;
+            }
+        }
+
+        if(value == NULL || value == Py_None) {
+            Py_XDECREF(value);
+            continue;
+        }
+
+        // the interned key string, so there's no hashing it again
+        lua_rawgeti(L, keys, (int)PyInt_AS_LONG(PyTuple_GET_ITEM(field, 1)));
+
+        int ok = schema_push(L, keys, PyTuple_GET_ITEM(field, 2), value,
+                             fallback, executor, depth+1);
+        Py_DECREF(value);
+
+        if(!ok) {
+            lua_pop(L, 2); // the key and the table
+            return 0;
+        }
+
+        lua_rawset(L, -3);
+    }
+
+    return 1;
+}
+
+
+PyObject* schema_to_lua(lua_State *L, int keys_ref, PyObject* type,
+                        PyObject* val, PyObject* fallback,
+                        PyObject* executor) {
+    /*
+     * Push val converted as described by `type`. keys_ref is the registry ref
+     * of the table of the schema's key strings, and fallback(executor, val)
+     * pushes fields of any type. Returns None, or NULL with a Python exception
+     * set and nothing pushed
+     */
+    int top = lua_gettop(L);
+
+    if(!lua_checkstack(L, 2)) {
+        PyErr_SetString(PyExc_MemoryError, "schema_to_lua.checkstack");
+        return NULL;
+    }
+
+    lua_rawgeti(L, LUA_REGISTRYINDEX, keys_ref);
+
+    if(!schema_push(L, top+1, type, val, fallback, executor, 0)) {
+        lua_settop(L, top);
+        return NULL;
+    }
+
+    lua_remove(L, top+1); // the keys
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject* schema_python_mismatch(lua_State *L, int idx,
+                                        const char* expected) {
+    PyErr_Format(PyExc_TypeError, "expected %s, got %s",
+                 expected, lua_typename(L, lua_type(L, idx)));
+    return NULL;
+}
+
+
+static PyObject* schema_to_python_recursive(lua_State *L, int idx, int keys,
+                                            PyObject* type,
+                                            PyObject* fallback,
+                                            PyObject* executor, int depth) {
+    /*
+     * The other direction from schema_push: records come out as tuples, or
+     * instances of the descriptor's cls (like a namedtuple), and sequences as
+     * lists. Returns a new reference or NULL with a Python exception set, and
+     * leaves the stack as it found it
+     */
+    idx = abs_index(L, idx);
+
+    int t = lua_type(L, idx);
+    if(t == LUA_TNIL) {
+        Py_RETURN_NONE;
+    }
+
+    long kind = PyInt_AS_LONG(PyTuple_GET_ITEM(type, 0));
+    PyObject* sub = PyTuple_GET_ITEM(type, 1);
+    size_t i, n;
+
+    switch(kind) {
+        case EXECUTOR_SCHEMA_STR: {
+            if(t != LUA_TSTRING) {
+                return schema_python_mismatch(L, idx, "a string");
+            }
+            size_t size = 0;
+            const char* str = lua_tolstring(L, idx, &size);
+            return PyString_FromStringAndSize(str, size);
+        }
+
+        case EXECUTOR_SCHEMA_INT: {
+            if(t != LUA_TNUMBER) {
+                return schema_python_mismatch(L, idx, "an int");
+            }
+#if LUA_VERSION_NUM >= 503
+            if(lua_isinteger(L, idx)) {
+                lua_Integer li = lua_tointeger(L, idx);
+                if(li >= LONG_MIN && li <= LONG_MAX) {
+                    return PyInt_FromLong((long)li);
+                }
+                return PyLong_FromLongLong((PY_LONG_LONG)li);
+            }
+#endif
+            // before 5.3 every number is a double
+            double d = (double)lua_tonumber(L, idx);
+            if(d != floor(d) || d - d != 0) {
+                return schema_python_mismatch(L, idx, "an int");
+            }
+            // strictly, because LONG_MAX rounds up to a double
+            if(d > LONG_MIN && d < LONG_MAX) {
+                return PyInt_FromLong((long)d);
+            }
+            return PyLong_FromDouble(d);
+        }
+
+        case EXECUTOR_SCHEMA_FLOAT:
+            if(t != LUA_TNUMBER) {
+                return schema_python_mismatch(L, idx, "a float");
+            }
+            return PyFloat_FromDouble((double)lua_tonumber(L, idx));
+
+        case EXECUTOR_SCHEMA_BOOL:
+            if(t != LUA_TBOOLEAN) {
+                return schema_python_mismatch(L, idx, "a bool");
+            }
+            return PyBool_FromLong(lua_toboolean(L, idx));
+
+        case EXECUTOR_SCHEMA_RECORD:
+        case EXECUTOR_SCHEMA_LIST:
+            break;
+
+        default:
+            return to_python_recursive(L, idx, fallback, executor, depth);
+    }
+
+    // only records and lists make it down here
+
+    if(t != LUA_TTABLE) {
+        return schema_python_mismatch(L, idx,
+                                      kind == EXECUTOR_SCHEMA_RECORD
+                                      ? "a record" : "a sequence");
+    }
+
+    if(depth > EXECUTOR_MAX_CONVERSION_DEPTH) {
+        PyErr_Format(PyExc_ValueError, "recursed too much (%d>%d)",
+                     depth, EXECUTOR_MAX_CONVERSION_DEPTH);
+        return NULL;
+    }
+
+    if(!lua_checkstack(L, 2)) {
+        PyErr_SetString(PyExc_MemoryError, "schema_to_python.checkstack");
+        return NULL;
+    }
+
+    if(kind == EXECUTOR_SCHEMA_LIST) {
+        n = executor_rawlen(L, idx);
+
+        PyObject* ret = PyList_New((Py_ssize_t)n);
+        if(ret == NULL) {
+            return NULL;
+        }
+
+        for(i=0; i<n; i++) {
+            lua_rawgeti(L, idx, (int)(i+1));
+            PyObject* item = schema_to_python_recursive(L, -1, keys, sub,
+                                                        fallback, executor,
+                                                        depth+1);
+            lua_pop(L, 1);
+            if(item == NULL) {
+                Py_DECREF(ret);
+                return NULL;
+            }
+            PyList_SET_ITEM(ret, (Py_ssize_t)i, item); // steals the reference
+        }
+
+        return ret;
+    }
+
+    n = (size_t)PyTuple_GET_SIZE(sub);
+
+    PyObject* values = PyTuple_New((Py_ssize_t)n);
+    if(values == NULL) {
+        return NULL;
+    }
+
+    for(i=0; i<n; i++) {
+        PyObject* field = PyTuple_GET_ITEM(sub, i);
+
+        lua_rawgeti(L, keys, (int)PyInt_AS_LONG(PyTuple_GET_ITEM(field, 1)));
+        lua_rawget(L, idx);
+
+        PyObject* item = schema_to_python_recursive(
+            L, -1, keys, PyTuple_GET_ITEM(field, 2), fallback, executor,
+            depth+1);
+        lua_pop(L, 1);
+
+        if(item == NULL) {
+            Py_DECREF(values);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(values, (Py_ssize_t)i, item); // steals the reference
+    }
+
+    PyObject* cls = PyTuple_GET_ITEM(type, 2);
+    if(cls == Py_None) {
+        return values;
+    }
+
+    // what namedtuple's _make does, without going through Python
+    PyObject* args = PyTuple_Pack(1, values);
+    Py_DECREF(values);
+    if(args == NULL) {
+        return NULL;
+    }
+
+    PyObject* ret = PyTuple_Type.tp_new((PyTypeObject*)cls, args, NULL);
+    Py_DECREF(args);
+    return ret;
+}
+
+
+PyObject* schema_to_python(lua_State *L, int idx, int keys_ref,
+                           PyObject* type, PyObject* fallback,
+                           PyObject* executor) {
+    /*
+     * Convert the value at idx as described by `type`, like schema_to_lua in
+     * reverse. Anything of any type is converted like to_python
+     */
+    idx = abs_index(L, idx);
+
+    if(!lua_checkstack(L, 1)) {
+        PyErr_SetString(PyExc_MemoryError, "schema_to_python.checkstack");
+        return NULL;
+    }
+
+    lua_rawgeti(L, LUA_REGISTRYINDEX, keys_ref);
+
+    PyObject* ret = schema_to_python_recursive(L, idx, lua_gettop(L), type,
+                                               fallback, executor, 0);
+    lua_pop(L, 1); // the keys
+
+    return ret;
+}
+
+
+void scope_store(lua_State *L, int scope_ref, int index) {
+    // pop the value on the top of the stack into slot `index` of the scope
+    // table that's stored in the registry at scope_ref. See
+    // executor.py:LuaScope
+    lua_rawgeti(L, LUA_REGISTRYINDEX, scope_ref);
+    // stack is [value, scope]
+    lua_insert(L, -2);
+    // stack is [scope, value]
+    lua_rawseti(L, -2, index);
+    // stack is [scope]
+    lua_pop(L, 1);
+}
+
+
+void scope_push(lua_State *L, int scope_ref, int index) {
+    // push the value at slot `index` of the scope table onto the stack
+    lua_rawgeti(L, LUA_REGISTRYINDEX, scope_ref);
+    // stack is [scope]
+    lua_rawgeti(L, -1, index);
+    // stack is [scope, value]
+    lua_remove(L, -2);
+    // stack is [value]
+}
+
+
+lua_tenant* new_tenant(size_t memory_limit) {
+    // tenants are owned by executor.py:Tenant, which releases them with
+    // free_tenant. The blocks that they allocated keep them around after
+    // that until they're freed too
+    lua_tenant* tenant = malloc(sizeof(lua_tenant));
+
+    if(tenant == NULL) {
+        return NULL;
+    }
+
+    tenant->memory_used = 0;
+    tenant->memory_limit = memory_limit;
+    tenant->refused = 0;
+    tenant->refcount = 1;
+    tenant->runtime_started = 0;
+    tenant->runtime_used = 0;
+
+    return tenant;
+}
+
+
+void free_tenant(lua_tenant* tenant) {
+    release_tenant(tenant);
+}
+
+
+static void release_tenant(lua_tenant* tenant) {
+    if(__sync_sub_and_fetch(&tenant->refcount, 1) == 0) {
+        free(tenant);
+    }
+}
+
+
+static size_t owner_hash(tenant_owners* owners, void* block) {
+    // the slot that block goes in if nothing else is already there
+    size_t h = (size_t)((uintptr_t)block >> 4);
+
+    h ^= h >> 16;
+    h *= 0x45d9f3b;
+    h ^= h >> 16;
+
+    return h & (owners->capacity-1);
+}
+
+
+static size_t owner_slot(tenant_owners* owners, void* block) {
+    /*
+     * The slot that block is in, or the empty one where it would go. The
+     * table must have been allocated
+     */
+    size_t mask = owners->capacity-1;
+    size_t slot = owner_hash(owners, block);
+
+    while(owners->blocks[slot] != NULL && owners->blocks[slot] != block) {
+        slot = (slot+1) & mask;
+    }
+    return slot;
+}
+
+
+static int reserve_owner(tenant_owners* owners) {
+    /*
+     * Make sure that there's room for one more block, growing the table if
+     * we have to. Returns 0 if we couldn't allocate it
+     */
+    if((owners->count+1)*2 <= owners->capacity) {
+        return 1;
+    }
+
+    tenant_owners grown;
+    grown.capacity = owners->capacity ? owners->capacity*2 : 64;
+    grown.count = owners->count;
+    grown.blocks = calloc(grown.capacity, sizeof(void*));
+    grown.owners = malloc(grown.capacity*sizeof(lua_tenant*));
+
+    if(grown.blocks == NULL || grown.owners == NULL) {
+        free(grown.blocks);
+        free(grown.owners);
+        return 0;
+    }
+
+    size_t i;
+    for(i=0; i<owners->capacity; i++) {
+        if(owners->blocks[i] != NULL) {
+            size_t slot = owner_slot(&grown, owners->blocks[i]);
+            grown.blocks[slot] = owners->blocks[i];
+            grown.owners[slot] = owners->owners[i];
+        }
+    }
+
+    free(owners->blocks);
+    free(owners->owners);
+    *owners = grown;
+    return 1;
+}
+
+
+static void set_owner(tenant_owners* owners, void* block, lua_tenant* tenant) {
+    // after reserve_owner, or removing the block's old entry
+    size_t slot = owner_slot(owners, block);
+    if(owners->blocks[slot] == NULL) {
+        owners->blocks[slot] = block;
+        owners->count++;
+    }
+    owners->owners[slot] = tenant;
+}
+
+
+static lua_tenant* find_owner(tenant_owners* owners, void* block) {
+    size_t slot = owner_slot(owners, block);
+    return owners->blocks[slot] != NULL ? owners->owners[slot] : NULL;
+}
+
+
+static void remove_owner(tenant_owners* owners, void* block) {
+    /*
+     * Take block out of the table. Rather than leaving tombstones, the
+     * entries after it are moved back into the hole if they'd otherwise
+     * become unreachable
+     */
+    size_t mask = owners->capacity-1;
+    size_t hole = owner_slot(owners, block);
+    size_t i = hole;
+
+    if(owners->blocks[hole] == NULL) {
+        return;
+    }
+
+    while(1) {
+        i = (i+1) & mask;
+        if(owners->blocks[i] == NULL) {
+            break;
+        }
+
+        // it can move if its home isn't cyclically in (hole, i]
+        size_t home = owner_hash(owners, owners->blocks[i]);
+        int stays = hole < i ? (home > hole && home <= i)
+                             : (home > hole || home <= i);
+        if(!stays) {
+            owners->blocks[hole] = owners->blocks[i];
+            owners->owners[hole] = owners->owners[i];
+            hole = i;
+        }
+    }
+
+    owners->blocks[hole] = NULL;
+    owners->count--;
+}
+
+
+static void free_owners(tenant_owners* owners) {
+    // after lua_close, when every block is gone
+    size_t i;
+    for(i=0; i<owners->capacity; i++) {
+        if(owners->blocks[i] != NULL) {
+            release_tenant(owners->owners[i]);
+        }
+    }
+
+    free(owners->blocks);
+    free(owners->owners);
+    owners->blocks = NULL;
+    owners->owners = NULL;
+    owners->capacity = owners->count = 0;
+}
+
+
+lua_tenant* enter_tenant(lua_State *L, lua_tenant* tenant) {
+    /*
+     * Charge everything that's allocated from now until exit_tenant to
+     * `tenant`. Returns the previously running tenant (if any) for
+     * exit_tenant to restore
+     */
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
+    lua_tenant* previous = control->tenant;
+
+    tenant->runtime_started = clock();
+    tenant->refused = 0;
+    control->tenant = tenant;
+
+    return previous;
+}
+
+
+void exit_tenant(lua_State *L, lua_tenant* previous) {
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
+    lua_tenant* tenant = control->tenant;
+
+    if(tenant != NULL) {
+        tenant->runtime_used += clock() - tenant->runtime_started;
+    }
+
+    control->tenant = previous;
+}
+
+
+size_t get_tenant_memory_used(lua_tenant* tenant) {
+    return tenant->memory_used;
+}
+
+
+size_t get_tenant_refused(lua_tenant* tenant) {
+    /*
+     * If the tenant's own limit refused an allocation since we last asked,
+     * what it would have taken them to. Otherwise 0
+     */
+    size_t refused = tenant->refused;
+    tenant->refused = 0;
+    return refused;
+}
+
+
+double get_tenant_runtime_used(lua_tenant* tenant) {
+    return (double)tenant->runtime_used/(double)CLOCKS_PER_SEC;
+}
+
+
+#if LUA_VERSION_NUM >= 502
+
+static void preempting_hook(lua_State *L, lua_Debug *_ar) {
+    // installed by resume_task. Rather than erroring like time_limiting_hook,
+    // this gives control back to the scheduler. If we can't yield right now
+    // we'll try again on the next count.
+    //
+    // lua_newthread copies the hook, so coroutines that the task's script
+    // creates run this too. Yielding from one of those would hand control to
+    // the script's own coroutine.resume rather than to the scheduler, so only
+    // the task's thread itself ever yields
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
+    if(L == control->task_thread && can_yield(L, 0)) {
+        lua_yield(L, 0);
+    }
+}
+
+#endif
+
+
+int resume_task(lua_State *L, lua_State *thread, int nargs, int slice,
+                int *nresults) {
+    /*
+     * Run the coroutine `thread` until it finishes, errors, or has run about
+     * `slice` instructions (see executor.py:Task). Returns the status from
+     * lua_resume and sets nresults to how many values it yielded or returned,
+     * which are on the top of its stack. Like lua_pcallk we're called without
+     * the GIL
+     */
+#if LUA_VERSION_NUM == 501
+    // luajit can't yield from hooks, which executor.py:Scheduler refuses
+    // to run without
+    lua_pushstring(thread, "the scheduler isn't supported on luajit");
+    *nresults = 1;
+    return LUA_ERRRUN;
+#else
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(L, (void*)&control);
+
+    lua_State* previous = control->task_thread;
+    control->task_thread = thread;
+
+    lua_sethook(thread, preempting_hook, LUA_MASKCOUNT, slice);
+
+    // allocation limiting must only be turned on while we're operating inside
+    // of a protected call, which lua_resume is
+    enable_limit_memory(L);
+#if LUA_VERSION_NUM >= 504
+    int ret = lua_resume(thread, L, nargs, nresults);
+#else
+    int ret = lua_resume(thread, L, nargs);
+    // before 5.4 a suspended coroutine's stack is only what it yielded
+    *nresults = lua_gettop(thread);
+#endif
+    disable_limit_memory(L);
+
+    lua_sethook(thread, NULL, 0, 0);
+    control->task_thread = previous;
+
+    return ret;
+#endif
+}
+
+
+int run_rules(lua_State *L, int stop_at_first, double max_runtime, int hz) {
+    /*
+     * The loop behind executor.py:RuleSet. Expects a sequence of rules and the
+     * record on the top of the stack, and replaces them with a table of the
+     * rules' results and a table of their errors, both keyed by the rule's
+     * index. Each rule(record) runs in its own protected call, with its own
+     * runtime budget if max_runtime > 0. Like lua_pcallk we're called without
+     * the GIL. Returns how many rules ran, or -1 if we ran out of memory
+     */
+    int rules = lua_gettop(L) - 1;
+    int record = rules + 1;
+    int results = rules + 2;
+    int errors = rules + 3;
+    int n = (int)executor_rawlen(L, rules);
+    int ran = 0;
+    int i;
+
+    lua_createtable(L, n, 0);
+    lua_createtable(L, 0, 0);
+
+    for(i=1; i<=n; i++) {
+        lua_rawgeti(L, rules, i);
+        lua_pushvalue(L, record);
+
+        if(max_runtime > 0) {
+            start_runtime_limiter(L, max_runtime, hz);
+        }
+
+        // allocation limiting must only be turned on while we're operating
+        // inside of a protected call
+        enable_limit_memory(L);
+#if LUA_VERSION_NUM == 501
+        int ret = memory_safe_pcallk(L, 1, 1, 0);
+#else
+        int ret = lua_pcall(L, 1, 1, 0);
+#endif
+        disable_limit_memory(L);
+
+        if(max_runtime > 0) {
+            finish_runtime_limiter(L);
+        }
+
+        ran++;
+
+        if(ret == LUA_OK) {
+            int matched = lua_toboolean(L, -1);
+            lua_rawseti(L, results, i);
+            if(matched && stop_at_first) {
+                break;
+            }
+        } else if(ret == LUA_ERRMEM) {
+            // the whole VM is over budget so nobody else would fare any better
+            lua_rawseti(L, errors, i);
+            ran = -1;
+            break;
+        } else {
+            lua_rawseti(L, errors, i);
+        }
+    }
+
+    // leave just the results and errors
+    lua_remove(L, rules);
+    lua_remove(L, rules);
+
+    return ran;
+}
+
+
+/*
+ * JSON
+ *
+ * json.decode and json.encode for sandboxed code, and load_json/dump_json for
+ * executor.py. They go straight between JSON bytes and the Lua stack without
+ * building any Python objects, and everything they allocate is on the Lua heap
+ * so it counts against the memory limiter
+ */
+
+
+static void json_buffer_init(lua_State *L, json_buffer* b) {
+    b->cap = 64;
+    b->len = 0;
+    b->data = (char*)executor_newuserdata(L, b->cap);
+    b->slot = lua_gettop(L);
+}
+
+
+static void json_buffer_reserve(lua_State *L, json_buffer* b, size_t extra) {
+    /*
+     * Make room for `extra' more bytes. We grow by allocating a new userdata
+     * into the same stack slot and leaving the old one for the collector, so
+     * if we run out of memory (or fail any other way) halfway through there's
+     * nothing to clean up
+     */
+    if(b->len + extra <= b->cap) {
+        return;
+    }
+
+    size_t cap = b->cap;
+    while(cap < b->len + extra) {
+        cap *= 2;
+    }
+
+    char* data = (char*)executor_newuserdata(L, cap);
+    memcpy(data, b->data, b->len);
+    lua_replace(L, b->slot);
+
+    b->data = data;
+    b->cap = cap;
+}
+
+
+static void json_buffer_add(lua_State *L, json_buffer* b,
+                            const char* s, size_t n) {
+    json_buffer_reserve(L, b, n);
+    memcpy(b->data + b->len, s, n);
+    b->len += n;
+}
+
+
+static void json_buffer_addchar(lua_State *L, json_buffer* b, char c) {
+    json_buffer_reserve(L, b, 1);
+    b->data[b->len++] = c;
+}
+
+
+static int json_fail(lua_State *L, json_decoder* d, const char* what) {
+    return luaL_error(L, "json: %s at character %d",
+                      what, (int)(d->p - d->start) + 1);
+}
+
+
+static void json_skip_space(json_decoder* d) {
+    while(d->p < d->end && (*d->p == ' ' || *d->p == '\t'
+                            || *d->p == '\n' || *d->p == '\r')) {
+        d->p++;
+    }
+}
+
+
+static void json_expect_literal(lua_State *L, json_decoder* d,
+                                const char* literal) {
+    size_t n = strlen(literal);
+
+    if((size_t)(d->end - d->p) < n || memcmp(d->p, literal, n) != 0) {
+        json_fail(L, d, "unexpected character");
+    }
+
+    d->p += n;
+}
+
+
+static unsigned long json_hex4(lua_State *L, json_decoder* d) {
+    unsigned long ret = 0;
+    int i;
+
+    if(d->end - d->p < 4) {
+        json_fail(L, d, "invalid \\u escape");
+    }
+
+    for(i=0; i<4; i++) {
+        char c = *d->p;
+        ret <<= 4;
+        if(c >= '0' && c <= '9') {
+            ret |= c - '0';
+        } else if(c >= 'a' && c <= 'f') {
+            ret |= c - 'a' + 10;
+        } else if(c >= 'A' && c <= 'F') {
+            ret |= c - 'A' + 10;
+        } else {
+            json_fail(L, d, "invalid \\u escape");
+        }
+        d->p++;
+    }
+
+    return ret;
+}
+
+
+static void json_add_utf8(lua_State *L, json_buffer* b, unsigned long cp) {
+    char out[4];
+    size_t n;
+
+    if(cp < 0x80) {
+        out[0] = (char)cp;
+        n = 1;
+    } else if(cp < 0x800) {
+        out[0] = (char)(0xC0 | (cp >> 6));
+        out[1] = (char)(0x80 | (cp & 0x3F));
+        n = 2;
+    } else if(cp < 0x10000) {
+        out[0] = (char)(0xE0 | (cp >> 12));
+        out[1] = (char)(0x80 | ((cp >> 6) & 0x3F));
+        out[2] = (char)(0x80 | (cp & 0x3F));
+        n = 3;
+    } else {
+        out[0] = (char)(0xF0 | (cp >> 18));
+        out[1] = (char)(0x80 | ((cp >> 12) & 0x3F));
+        out[2] = (char)(0x80 | ((cp >> 6) & 0x3F));
+        out[3] = (char)(0x80 | (cp & 0x3F));
+        n = 4;
+    }
+
+    json_buffer_add(L, b, out, n);
+}
+
+
+static void json_decode_string(lua_State *L, json_decoder* d) {
+    // d->p is just past the opening quote. Pushes the string
+    json_buffer* b = &d->scratch;
+    const char* run = d->p;
+
+    while(d->p < d->end && *d->p != '"' && *d->p != '\\'
+          && (unsigned char)*d->p >= 0x20) {
+        d->p++;
+    }
+
+    if(d->p < d->end && *d->p == '"') {
+        // the common case: no escapes, so we can push it straight from the
+        // input
+        lua_pushlstring(L, run, d->p - run);
+        d->p++;
+        return;
+    }
+
+    b->len = 0;
+
+    for(;;) {
+        json_buffer_add(L, b, run, d->p - run);
+
+        if(d->p >= d->end) {
+            json_fail(L, d, "unterminated string");
+        }
+
+        char c = *d->p;
+
+        if(c == '"') {
+            d->p++;
+            break;
+        } else if(c != '\\') {
+            json_fail(L, d, "control character in string");
+        }
+
+        d->p++; // the backslash
+        if(d->p >= d->end) {
+            json_fail(L, d, "unterminated string");
+        }
+
+        c = *d->p++;
+
+        switch(c) {
+            case '"':
+            case '\\':
+            case '/':
+                json_buffer_addchar(L, b, c);
+                break;
+            case 'b':
+                json_buffer_addchar(L, b, '\b');
+                break;
+            case 'f':
+                json_buffer_addchar(L, b, '\f');
+                break;
+            case 'n':
+                json_buffer_addchar(L, b, '\n');
+                break;
+            case 'r':
+                json_buffer_addchar(L, b, '\r');
+                break;
+            case 't':
+                json_buffer_addchar(L, b, '\t');
+                break;
+            case 'u': {
+                unsigned long cp = json_hex4(L, d);
+
+                if(cp >= 0xD800 && cp <= 0xDBFF) {
+                    // the first half of a surrogate pair
+                    if(d->end - d->p < 2 || d->p[0] != '\\' || d->p[1] != 'u') {
+                        json_fail(L, d, "invalid surrogate pair");
+                    }
+                    d->p += 2;
+                    unsigned long low = json_hex4(L, d);
+                    if(low < 0xDC00 || low > 0xDFFF) {
+                        json_fail(L, d, "invalid surrogate pair");
+                    }
+                    cp = 0x10000 + ((cp - 0xD800) << 10) + (low - 0xDC00);
+
+                } else if(cp >= 0xDC00 && cp <= 0xDFFF) {
+                    json_fail(L, d, "invalid surrogate pair");
+                }
+
+                json_add_utf8(L, b, cp);
+                break;
+            }
+            default:
+                d->p--;
+                json_fail(L, d, "invalid escape");
+        }
+
+        run = d->p;
+        while(d->p < d->end && *d->p != '"' && *d->p != '\\'
+              && (unsigned char)*d->p >= 0x20) {
+            d->p++;
+        }
+    }
+
+    lua_pushlstring(L, b->data, b->len);
+}
+
+
+#define JSON_DIGIT(d) ((d)->p < (d)->end && *(d)->p >= '0' && *(d)->p <= '9')
+
+
+static void json_decode_number(lua_State *L, json_decoder* d) {
+    const char* begin = d->p;
+    int integral = 1;
+
+    if(d->p < d->end && *d->p == '-') {
+        d->p++;
+    }
+
+    if(!JSON_DIGIT(d)) {
+        json_fail(L, d, "unexpected character");
+    }
+
+    if(*d->p == '0') {
+        d->p++;
+    } else {
+        while(JSON_DIGIT(d)) {
+            d->p++;
+        }
+    }
+
+    if(d->p < d->end && *d->p == '.') {
+        integral = 0;
+        d->p++;
+        if(!JSON_DIGIT(d)) {
+            json_fail(L, d, "invalid number");
+        }
+        while(JSON_DIGIT(d)) {
+            d->p++;
+        }
+    }
+
+    if(d->p < d->end && (*d->p == 'e' || *d->p == 'E')) {
+        integral = 0;
+        d->p++;
+        if(d->p < d->end && (*d->p == '+' || *d->p == '-')) {
+            d->p++;
+        }
+        if(!JSON_DIGIT(d)) {
+            json_fail(L, d, "invalid number");
+        }
+        while(JSON_DIGIT(d)) {
+            d->p++;
+        }
+    }
+
+    // strto* want a terminated string, which our input might not be
+    json_buffer* b = &d->scratch;
+    b->len = 0;
+    json_buffer_add(L, b, begin, d->p - begin);
+    json_buffer_addchar(L, b, '\0');
+
+#if LUA_VERSION_NUM >= 503
+    if(integral) {
+        errno = 0;
+        long long i = strtoll(b->data, NULL, 10);
+        if(errno == 0 && i >= LUA_MININTEGER && i <= LUA_MAXINTEGER) {
+            lua_pushinteger(L, (lua_Integer)i);
+            return;
+        }
+    }
+#else
+    (void)integral;
+#endif
+
+    lua_pushnumber(L, (lua_Number)strtod(b->data, NULL));
+}
+
+
+static void json_enter(lua_State *L, json_decoder* d, int depth) {
+    if(depth > EXECUTOR_MAX_CONVERSION_DEPTH) {
+        json_fail(L, d, "too deeply nested");
+    }
+    luaL_checkstack(L, 3, "json.decode");
+    d->p++; // the opening bracket
+}
+
+
+static void json_decode_object(lua_State *L, json_decoder* d, int depth) {
+    json_enter(L, d, depth);
+
+    lua_newtable(L);
+
+    json_skip_space(d);
+    if(d->p < d->end && *d->p == '}') {
+        d->p++;
+        return;
+    }
+
+    for(;;) {
+        json_skip_space(d);
+        if(d->p >= d->end || *d->p != '"') {
+            json_fail(L, d, "expected a string key");
+        }
+        d->p++;
+        json_decode_string(L, d);
+
+        json_skip_space(d);
+        if(d->p >= d->end || *d->p != ':') {
+            json_fail(L, d, "expected ':'");
+        }
+        d->p++;
+
+        json_decode_value(L, d, depth+1);
+
+        if(lua_isnil(L, -1)) {
+            // null, which Lua tables can't hold. This is what from_python
+            // does with None too
+            lua_pop(L, 2);
+        } else {
+            lua_rawset(L, -3);
+        }
+
+        json_skip_space(d);
+        if(d->p < d->end && *d->p == ',') {
+            d->p++;
+        } else if(d->p < d->end && *d->p == '}') {
+            d->p++;
+            return;
+        } else {
+            json_fail(L, d, "expected ',' or '}'");
+        }
+    }
+}
+
+
+static void json_decode_array(lua_State *L, json_decoder* d, int depth) {
+    int i = 0;
+
+    json_enter(L, d, depth);
+
+    lua_newtable(L);
+
+    json_skip_space(d);
+    if(d->p < d->end && *d->p == ']') {
+        d->p++;
+        return;
+    }
+
+    for(;;) {
+        json_decode_value(L, d, depth+1);
+
+        // nulls leave holes, but everything after them keeps its index
+        i++;
+        if(lua_isnil(L, -1)) {
+            lua_pop(L, 1);
+        } else {
+            lua_rawseti(L, -2, i);
+        }
+
+        json_skip_space(d);
+        if(d->p < d->end && *d->p == ',') {
+            d->p++;
+        } else if(d->p < d->end && *d->p == ']') {
+            d->p++;
+            return;
+        } else {
+            json_fail(L, d, "expected ',' or ']'");
+        }
+    }
+}
+
+
+static void json_decode_value(lua_State *L, json_decoder* d, int depth) {
+    json_skip_space(d);
+
+    if(d->p >= d->end) {
+        json_fail(L, d, "unexpected end of input");
+    }
+
+    switch(*d->p) {
+        case '{':
+            json_decode_object(L, d, depth);
+            break;
+        case '[':
+            json_decode_array(L, d, depth);
+            break;
+        case '"':
+            d->p++;
+            json_decode_string(L, d);
+            break;
+        case 't':
+            json_expect_literal(L, d, "true");
+            lua_pushboolean(L, 1);
+            break;
+        case 'f':
+            json_expect_literal(L, d, "false");
+            lua_pushboolean(L, 0);
+            break;
+        case 'n':
+            json_expect_literal(L, d, "null");
+            lua_pushnil(L);
+            break;
+        default:
+            json_decode_number(L, d);
+    }
+}
+
+
+static void decode_json(lua_State *L, const char* s, size_t len) {
+    // push the value that the JSON in s describes
+    json_decoder d;
+
+    d.start = d.p = s;
+    d.end = s + len;
+    json_buffer_init(L, &d.scratch);
+
+    json_decode_value(L, &d, 0);
+
+    json_skip_space(&d);
+    if(d.p != d.end) {
+        json_fail(L, &d, "trailing garbage");
+    }
+
+    lua_remove(L, d.scratch.slot);
+}
+
+
+static void json_encode_string(lua_State *L, json_buffer* b, int idx) {
+    static const char hex[] = "0123456789abcdef";
+    size_t len = 0;
+    const char* s = lua_tolstring(L, idx, &len);
+    size_t run = 0;
+    size_t i;
+
+    json_buffer_reserve(L, b, len+2);
+    json_buffer_addchar(L, b, '"');
+
+    for(i=0; i<len; i++) {
+        unsigned char c = (unsigned char)s[i];
+
+        if(c >= 0x20 && c != '"' && c != '\\') {
+            continue;
+        }
+
+        json_buffer_add(L, b, s+run, i-run);
+        run = i+1;
+
+        switch(c) {
+            case '"':
+                json_buffer_add(L, b, "\\\"", 2);
+                break;
+            case '\\':
+                json_buffer_add(L, b, "\\\\", 2);
+                break;
+            case '\n':
+                json_buffer_add(L, b, "\\n", 2);
+                break;
+            case '\r':
+                json_buffer_add(L, b, "\\r", 2);
+                break;
+            case '\t':
+                json_buffer_add(L, b, "\\t", 2);
+                break;
+            default: {
+                char escaped[6] = {'\\', 'u', '0', '0',
+                                   hex[c >> 4], hex[c & 0xF]};
+                json_buffer_add(L, b, escaped, 6);
+            }
+        }
+    }
+
+    json_buffer_add(L, b, s+run, len-run);
+    json_buffer_addchar(L, b, '"');
+}
+
+
+static void json_encode_number(lua_State *L, json_buffer* b, int idx) {
+    char num[64];
+    int n;
+
+#if LUA_VERSION_NUM >= 503
+    if(lua_isinteger(L, idx)) {
+        n = snprintf(num, sizeof(num), "%lld",
+                     (long long)lua_tointeger(L, idx));
+    } else
+#endif
+    {
+        double d = (double)lua_tonumber(L, idx);
+
+        if(isnan(d) || isinf(d)) {
+            luaL_error(L, "json: can't encode %f", d);
+        }
+
+        // the shortest of these that survives the round trip
+        n = snprintf(num, sizeof(num), "%.15g", d);
+        if(strtod(num, NULL) != d) {
+            n = snprintf(num, sizeof(num), "%.17g", d);
+        }
+    }
+
+    json_buffer_add(L, b, num, n);
+}
+
+
+static void json_encode_table(lua_State *L, json_buffer* b, int idx,
+                              int depth) {
+    if(depth > EXECUTOR_MAX_CONVERSION_DEPTH) {
+        luaL_error(L, "json: too deeply nested (or cyclic)");
+    }
+
+    luaL_checkstack(L, 3, "json.encode");
+    idx = abs_index(L, idx);
+
+    // it's an array if its keys are exactly 1..n. Otherwise it's an object,
+    // including if it's empty since that's what to_python would give you
+    size_t n = executor_rawlen(L, idx);
+    size_t count = 0;
+    size_t in_sequence = 0;
+
+    lua_pushnil(L);
+    while(lua_next(L, idx) != 0) {
+        count++;
+        if(lua_type(L, -2) == LUA_TNUMBER) {
+            lua_Number k = lua_tonumber(L, -2);
+            if(k >= 1 && k <= (lua_Number)n && k == (lua_Number)(size_t)k) {
+                in_sequence++;
+            }
+        }
+        lua_pop(L, 1);
+    }
+
+    if(n > 0 && count == n && in_sequence == n) {
+        size_t i;
+
+        json_buffer_addchar(L, b, '[');
+        for(i=1; i<=n; i++) {
+            if(i > 1) {
+                json_buffer_addchar(L, b, ',');
+            }
+            lua_rawgeti(L, idx, i);
+            json_encode_value(L, b, -1, depth+1);
+            lua_pop(L, 1);
+        }
+        json_buffer_addchar(L, b, ']');
+        return;
+    }
+
+    int first = 1;
+
+    json_buffer_addchar(L, b, '{');
+    lua_pushnil(L);
+    while(lua_next(L, idx) != 0) {
+        if(!first) {
+            json_buffer_addchar(L, b, ',');
+        }
+        first = 0;
+
+        // careful not to lua_tolstring a number key, which would confuse
+        // lua_next
+        int kind = lua_type(L, -2);
+        if(kind == LUA_TSTRING) {
+            json_encode_string(L, b, -2);
+        } else if(kind == LUA_TNUMBER) {
+            json_buffer_addchar(L, b, '"');
+            json_encode_number(L, b, -2);
+            json_buffer_addchar(L, b, '"');
+        } else {
+            luaL_error(L, "json: can't encode a %s key", luaL_typename(L, -2));
+        }
+
+        json_buffer_addchar(L, b, ':');
+        json_encode_value(L, b, -1, depth+1);
+
+        lua_pop(L, 1); // the value, leaving the key for lua_next
+    }
+    json_buffer_addchar(L, b, '}');
+}
+
+
+static void json_encode_value(lua_State *L, json_buffer* b, int idx,
+                              int depth) {
+    switch(lua_type(L, idx)) {
+        case LUA_TNIL:
+            json_buffer_add(L, b, "null", 4);
+            break;
+        case LUA_TBOOLEAN:
+            if(lua_toboolean(L, idx)) {
+                json_buffer_add(L, b, "true", 4);
+            } else {
+                json_buffer_add(L, b, "false", 5);
+            }
+            break;
+        case LUA_TNUMBER:
+            json_encode_number(L, b, idx);
+            break;
+        case LUA_TSTRING:
+            json_encode_string(L, b, idx);
+            break;
+        case LUA_TTABLE:
+            json_encode_table(L, b, idx, depth);
+            break;
+        default:
+            luaL_error(L, "json: can't encode %s", luaL_typename(L, idx));
+    }
+}
+
+
+static void encode_json(lua_State *L, int idx) {
+    // push the JSON for the value at idx as a string
+    json_buffer b;
+
+    idx = abs_index(L, idx);
+    json_buffer_init(L, &b);
+
+    json_encode_value(L, &b, idx, 0);
+
+    lua_pushlstring(L, b.data, b.len);
+    lua_remove(L, b.slot);
+}
+
+
+static int json_decode(lua_State *L) {
+    size_t len = 0;
+    const char* s = luaL_checklstring(L, 1, &len);
+    decode_json(L, s, len);
+    return 1;
+}
+
+
+static int json_decode_buffer(lua_State *L) {
+    // load_json's way in: a pointer and a length instead of a Lua string, so
+    // the input doesn't have to be copied into Lua first
+    decode_json(L, (const char*)lua_touserdata(L, 1),
+                (size_t)lua_tonumber(L, 2));
+    return 1;
+}
+
+
+static int json_encode(lua_State *L) {
+    luaL_checkany(L, 1);
+    lua_settop(L, 1);
+    encode_json(L, 1);
+    return 1;
+}
+
+
+static const luaL_Reg json_lib[] = {
+    {"decode", json_decode},
+    {"encode", json_encode},
+    {NULL, NULL}
+};
+
+
+void install_json(lua_State *L) {
+    // the global `json` library
+    lua_createtable(L, 0, sizeof(json_lib)/sizeof(luaL_Reg) - 1);
+    set_functions(L, json_lib);
+    lua_setglobal(L, "json");
+}
+
+
+static int protected_json_call(lua_State *L, int nargs) {
+    enable_limit_memory(L);
+#if LUA_VERSION_NUM == 501
+    int ret = memory_safe_pcallk(L, nargs, 1, 0);
+#else
+    int ret = lua_pcall(L, nargs, 1, 0);
+#endif
+    disable_limit_memory(L);
+    return ret;
+}
+
+
+int load_json(lua_State *L, const char* buf, size_t len) {
+    /*
+     * Push the value described by the JSON in buf, or the error if it isn't
+     * valid. Returns the status of the protected call. Like lua_pcallk we're
+     * called without the GIL
+     */
+    lua_pushcfunction(L, json_decode_buffer);
+    lua_pushlightuserdata(L, (void*)buf);
+    lua_pushnumber(L, (lua_Number)len);
+    return protected_json_call(L, 2);
+}
+
+
+int dump_json(lua_State *L) {
+    // like load_json, but replace the value on the top of the stack with its
+    // JSON
+    lua_pushcfunction(L, json_encode);
+    lua_insert(L, -2);
+    return protected_json_call(L, 1);
+}
+
+
+/*
+ * Patterns
+ *
+ * A stand-in for string.find, match, gmatch and gsub for sandboxed code. It
+ * has the same semantics, but it's a backtracking matcher that counts its
+ * steps, and every so often it checks the runtime limiter, so a pathological
+ * pattern gets cut off like a pathological loop would instead of hanging the
+ * interpreter where the count hook can't reach it. Patterns are compiled once
+ * into a list of items whose character classes are precomputed bitmaps, and
+ * kept in a per-state cache
+ */
+
+
+static int pattern_class_matches(int c, int cl) {
+    // lstrlib's match_class: c against %cl
+    int res;
+    switch(tolower(cl)) {
+        case 'a': res = isalpha(c); break;
+        case 'c': res = iscntrl(c); break;
+        case 'd': res = isdigit(c); break;
+        case 'g': res = isgraph(c); break;
+        case 'l': res = islower(c); break;
+        case 'p': res = ispunct(c); break;
+        case 's': res = isspace(c); break;
+        case 'u': res = isupper(c); break;
+        case 'w': res = isalnum(c); break;
+        case 'x': res = isxdigit(c); break;
+#if LUA_VERSION_NUM <= 502
+        case 'z': res = (c == 0); break; // deprecated, and gone in 5.3
+#endif
+        default: return (cl == c);
+    }
+    if(isupper(cl)) {
+        res = !res;
+    }
+    return res;
+}
+
+
+static int pattern_set_matches(int c, const char* p, const char* ec) {
+    /*
+     * lstrlib's matchbracketclass: c against the set [p..ec], where p is at
+     * the '[' and ec at the ']'
+     */
+    int sig = 1;
+
+    if(*(p+1) == '^') {
+        sig = 0;
+        p++;
+    }
+
+    while(++p < ec) {
+        if(*p == '%') {
+            p++;
+            if(pattern_class_matches(c, (unsigned char)*p)) {
+                return sig;
+            }
+        } else if(*(p+1) == '-' && p+2 < ec) {
+            p += 2;
+            if((unsigned char)*(p-2) <= c && c <= (unsigned char)*p) {
+                return sig;
+            }
+        } else if((unsigned char)*p == c) {
+            return sig;
+        }
+    }
+
+    return !sig;
+}
+
+
+static const char* pattern_class_end(lua_State *L, const char* p,
+                                     const char* end) {
+    // p is just past the start of a single character class. Find its end
+    switch(*p++) {
+        case '%':
+            if(p >= end) {
+                luaL_error(L, "malformed pattern (ends with '%%')");
+            }
+            return p+1;
+
+        case '[':
+            if(p < end && *p == '^') {
+                p++;
+            }
+            do {
+                // look for a ']'
+                if(p >= end) {
+                    luaL_error(L, "malformed pattern (missing ']')");
+                }
+                if(*(p++) == '%' && p < end) {
+                    p++; // skip escapes (e.g. '%]')
+                }
+            } while(p >= end || *p != ']');
+            return p+1;
+
+        default:
+            return p;
+    }
+}
+
+
+static void pattern_fill_set(unsigned char* set, const char* p,
+                             const char* ep) {
+    // precompute which bytes the single character class p..ep matches
+    int c;
+
+    memset(set, 0, 32);
+
+    for(c=0; c<256; c++) {
+        int matched;
+
+        switch(*p) {
+            case '.':
+                matched = 1;
+                break;
+            case '%':
+                matched = pattern_class_matches(c, (unsigned char)*(p+1));
+                break;
+            case '[':
+                matched = pattern_set_matches(c, p, ep-1);
+                break;
+            default:
+                matched = ((unsigned char)*p == c);
+        }
+
+        if(matched) {
+            set[c >> 3] |= (unsigned char)(1 << (c & 7));
+        }
+    }
+}
+
+
+#define PATTERN_IN_SET(set, c) \
+    ((set)[(unsigned char)(c) >> 3] & (1 << ((unsigned char)(c) & 7)))
+
+
+static int pattern_has_specials(const char* p, size_t len) {
+    // lstrlib's nospecials, inverted
+    size_t i;
+    for(i=0; i<len; i++) {
+        if(strchr("^$*+?.([%-", p[i]) != NULL) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+
+static compiled_pattern* compile_pattern(lua_State *L, const char* p,
+                                         size_t len, int anchors) {
+    /*
+     * Compile p into a new userdata that we push. If anchors is 0 (for
+     * gmatch), a leading '^' is just a character
+     */
+    const char* end = p + len;
+    compiled_pattern* compiled = (compiled_pattern*)executor_newuserdata(L,
+        sizeof(compiled_pattern) + len*sizeof(pattern_item));
+
+    compiled->anchored = anchors && len > 0 && *p == '^';
+    compiled->nitems = 0;
+
+    if(compiled->anchored) {
+        p++;
+    }
+
+    while(p < end) {
+        pattern_item* item = &compiled->items[compiled->nitems++];
+        item->quantifier = 0;
+
+        switch(*p) {
+            case '(':
+                if(p+1 < end && *(p+1) == ')') {
+                    item->kind = PATTERN_POSITION;
+                    p += 2;
+                } else {
+                    item->kind = PATTERN_OPEN;
+                    p++;
+                }
+                continue;
+
+            case ')':
+                item->kind = PATTERN_CLOSE;
+                p++;
+                continue;
+
+            case '$':
+                if(p+1 == end) {
+                    item->kind = PATTERN_END;
+                    p++;
+                    continue;
+                }
+                break; // otherwise it's just a character
+
+            case '%':
+                if(p+1 < end && *(p+1) == 'b') {
+                    if(p+3 >= end) {
+                        luaL_error(L, "malformed pattern (missing arguments to '%%b')");
+                    }
+                    item->kind = PATTERN_BALANCE;
+                    item->a = (unsigned char)*(p+2);
+                    item->b = (unsigned char)*(p+3);
+                    p += 4;
+                    continue;
+
+                } else if(p+1 < end && *(p+1) == 'f') {
+                    const char* ep;
+                    p += 2;
+                    if(p >= end || *p != '[') {
+                        luaL_error(L, "missing '[' after '%%f' in pattern");
+                    }
+                    ep = pattern_class_end(L, p, end);
+                    item->kind = PATTERN_FRONTIER;
+                    pattern_fill_set(item->set, p, ep);
+                    p = ep;
+                    continue;
+
+                } else if(p+1 < end && isdigit((unsigned char)*(p+1))) {
+                    item->kind = PATTERN_BACKREF;
+                    item->a = (unsigned char)*(p+1);
+                    p += 2;
+                    continue;
+                }
+                break; // a class or an escaped character
+        }
+
+        // a single character class, maybe with a quantifier
+        const char* ep = pattern_class_end(L, p, end);
+        item->kind = PATTERN_SINGLE;
+        pattern_fill_set(item->set, p, ep);
+        p = ep;
+
+        if(p < end && (*p == '*' || *p == '+' || *p == '-' || *p == '?')) {
+            item->quantifier = *p++;
+        }
+    }
+
+    return compiled;
+}
+
+
+static compiled_pattern* get_compiled_pattern(lua_State *L, int idx,
+                                              int anchors) {
+    /*
+     * Compile the pattern at idx, or find it in the cache, and push it. The
+     * cache is a weak table in the registry so it's emptied out by the
+     * collector like anything else
+     */
+    size_t len = 0;
+    const char* p = lua_tolstring(L, idx, &len);
+    compiled_pattern* compiled;
+
+    idx = abs_index(L, idx);
+
+    if(!anchors && len > 0 && *p == '^') {
+        // gmatch's unusual reading of the same pattern. Rare enough not to
+        // bother caching
+        return compile_pattern(L, p, len, anchors);
+    }
+
+    lua_getfield(L, LUA_REGISTRYINDEX, EXECUTOR_PATTERN_CACHE_KEY);
+    if(lua_isnil(L, -1)) {
+        lua_pop(L, 1);
+        lua_newtable(L);
+        lua_createtable(L, 0, 1);
+        lua_pushstring(L, "v");
+        lua_setfield(L, -2, "__mode");
+        lua_setmetatable(L, -2);
+        lua_pushvalue(L, -1);
+        lua_setfield(L, LUA_REGISTRYINDEX, EXECUTOR_PATTERN_CACHE_KEY);
+    }
+
+    lua_pushvalue(L, idx);
+    lua_rawget(L, -2);
+    compiled = (compiled_pattern*)lua_touserdata(L, -1);
+
+    if(compiled == NULL) {
+        lua_pop(L, 1);
+        compiled = compile_pattern(L, p, len, anchors);
+        lua_pushvalue(L, idx);
+        lua_pushvalue(L, -2);
+        lua_rawset(L, -4);
+    }
+
+    lua_remove(L, -2); // the cache
+    return compiled;
+}
+
+
+static void pattern_ticks(pattern_state* ms, size_t n) {
+    /*
+     * Count n steps of work, and check the runtime limiter if it's been long
+     * enough since we last did
+     */
+    if(ms->budget > n) {
+        ms->budget -= n;
+        return;
+    }
+
+    ms->budget = EXECUTOR_PATTERN_CHECK_INTERVAL;
+
+    lua_control_block *control = NULL;
+    (void*)lua_getallocf(ms->L, (void*)&control);
+
+    if((control->runtime).enabled) {
+        check_runtime_quota(ms->L, control);
+    }
+}
+
+
+static const char* pattern_match(pattern_state* ms, const char* s, int i);
+
+
+static const char* pattern_max_expand(pattern_state* ms, const char* s,
+                                      int i) {
+    const unsigned char* set = ms->pattern->items[i].set;
+    ptrdiff_t n = 0;
+
+    while(s+n < ms->src_end && PATTERN_IN_SET(set, s[n])) {
+        n++;
+    }
+    pattern_ticks(ms, (size_t)n);
+
+    // try with the longest run and back off one at a time
+    while(n >= 0) {
+        const char* res = pattern_match(ms, s+n, i+1);
+        if(res != NULL) {
+            return res;
+        }
+        n--;
+    }
+
+    return NULL;
+}
+
+
+static const char* pattern_min_expand(pattern_state* ms, const char* s,
+                                      int i) {
+    const unsigned char* set = ms->pattern->items[i].set;
+
+    for(;;) {
+        const char* res = pattern_match(ms, s, i+1);
+        if(res != NULL) {
+            return res;
+        } else if(s < ms->src_end && PATTERN_IN_SET(set, *s)) {
+            s++;
+        } else {
+            return NULL;
+        }
+    }
+}
+
+
+static const char* pattern_start_capture(pattern_state* ms, const char* s,
+                                         int i, ptrdiff_t what) {
+    const char* res;
+    int level = ms->level;
+
+    if(level >= LUA_MAXCAPTURES) {
+        luaL_error(ms->L, "too many captures");
+    }
+
+    ms->capture[level].init = s;
+    ms->capture[level].len = what;
+    ms->level = level+1;
+
+    if((res = pattern_match(ms, s, i)) == NULL) {
+        ms->level--; // undo the capture
+    }
+
+    return res;
+}
+
+
+static const char* pattern_end_capture(pattern_state* ms, const char* s,
+                                       int i) {
+    const char* res;
+    int l;
+
+    // the innermost capture that's still open
+    for(l = ms->level-1; l >= 0; l--) {
+        if(ms->capture[l].len == PATTERN_CAP_UNFINISHED) {
+            break;
+        }
+    }
+    if(l < 0) {
+        luaL_error(ms->L, "invalid pattern capture");
+    }
+
+    ms->capture[l].len = s - ms->capture[l].init;
+
+    if((res = pattern_match(ms, s, i)) == NULL) {
+        ms->capture[l].len = PATTERN_CAP_UNFINISHED;
+    }
+
+    return res;
+}
+
+
+static const char* pattern_match_balance(pattern_state* ms, const char* s,
+                                         const pattern_item* item) {
+    const char* start = s;
+    int cont = 1;
+
+    if(s >= ms->src_end || (unsigned char)*s != item->a) {
+        return NULL;
+    }
+
+    while(++s < ms->src_end) {
+        if((unsigned char)*s == item->b) {
+            if(--cont == 0) {
+                pattern_ticks(ms, (size_t)(s - start));
+                return s+1;
+            }
+        } else if((unsigned char)*s == item->a) {
+            cont++;
+        }
+    }
+
+    pattern_ticks(ms, (size_t)(s - start));
+    return NULL;
+}
+
+
+static const char* pattern_match_capture(pattern_state* ms, const char* s,
+                                         int digit) {
+    int l = digit - '1';
+    size_t len;
+
+    if(l < 0 || l >= ms->level
+       || ms->capture[l].len == PATTERN_CAP_UNFINISHED) {
+        luaL_error(ms->L, "invalid capture index %%%d", l+1);
+    }
+
+    len = (size_t)ms->capture[l].len;
+    pattern_ticks(ms, len);
+
+    if((size_t)(ms->src_end - s) >= len
+       && memcmp(ms->capture[l].init, s, len) == 0) {
+        return s+len;
+    }
+
+    return NULL;
+}
+
+
+static const char* pattern_match(pattern_state* ms, const char* s, int i) {
+    /*
+     * lstrlib's do_match, but over our compiled items. Returns the end of the
+     * match of items i.. starting at s, or NULL
+     */
+    const char* res = s;
+
+    if(ms->matchdepth-- == 0) {
+        luaL_error(ms->L, "pattern too complex");
+    }
+
+    pattern_ticks(ms, 1);
+
+    while(i < ms->pattern->nitems) {
+        const pattern_item* item = &ms->pattern->items[i];
+
+        switch(item->kind) {
+            case PATTERN_OPEN:
+                res = pattern_start_capture(ms, s, i+1, PATTERN_CAP_UNFINISHED);
+                goto done;
+
+            case PATTERN_POSITION:
+                res = pattern_start_capture(ms, s, i+1, PATTERN_CAP_POSITION);
+                goto done;
+
+            case PATTERN_CLOSE:
+                res = pattern_end_capture(ms, s, i+1);
+                goto done;
+
+            case PATTERN_END:
+                res = (s == ms->src_end) ? s : NULL;
+                goto done;
+
+            case PATTERN_BALANCE:
+                if((s = pattern_match_balance(ms, s, item)) == NULL) {
+                    res = NULL;
+                    goto done;
+                }
+                i++;
+                continue;
+
+            case PATTERN_FRONTIER: {
+                unsigned char previous = (s == ms->src_init) ? '\0' : *(s-1);
+                unsigned char current = (s < ms->src_end) ? *s : '\0';
+                if(PATTERN_IN_SET(item->set, previous)
+                   || !PATTERN_IN_SET(item->set, current)) {
+                    res = NULL;
+                    goto done;
+                }
+                i++;
+                continue;
+            }
+
+            case PATTERN_BACKREF:
+                if((s = pattern_match_capture(ms, s, item->a)) == NULL) {
+                    res = NULL;
+                    goto done;
+                }
+                i++;
+                continue;
+
+            default: { // PATTERN_SINGLE
+                int matched = s < ms->src_end && PATTERN_IN_SET(item->set, *s);
+
+                switch(item->quantifier) {
+                    case '?':
+                        if(matched
+                           && (res = pattern_match(ms, s+1, i+1)) != NULL) {
+                            goto done;
+                        }
+                        i++;
+                        continue;
+
+                    case '+':
+                        res = matched ? pattern_max_expand(ms, s+1, i) : NULL;
+                        goto done;
+
+                    case '*':
+                        res = pattern_max_expand(ms, s, i);
+                        goto done;
+
+                    case '-':
+                        res = pattern_min_expand(ms, s, i);
+                        goto done;
+
+                    default:
+                        if(!matched) {
+                            res = NULL;
+                            goto done;
+                        }
+                        s++;
+                        i++;
+                        continue;
+                }
+            }
+        }
+    }
+
+    res = s; // we made it to the end of the pattern
+
+done:
+    ms->matchdepth++;
+    return res;
+}
+
+
+static void pattern_prepare(pattern_state* ms, lua_State *L,
+                            compiled_pattern* pattern,
+                            const char* s, size_t len) {
+    ms->L = L;
+    ms->pattern = pattern;
+    ms->src_init = s;
+    ms->src_end = s + len;
+    ms->budget = EXECUTOR_PATTERN_CHECK_INTERVAL;
+}
+
+
+static void pattern_reset(pattern_state* ms) {
+    ms->level = 0;
+    ms->matchdepth = EXECUTOR_PATTERN_MAX_DEPTH;
+}
+
+
+static void pattern_push_capture(pattern_state* ms, int i,
+                                 const char* s, const char* e) {
+    if(i >= ms->level) {
+        if(i != 0) {
+            luaL_error(ms->L, "invalid capture index %%%d", i+1);
+        }
+        // no explicit captures, so the whole match
+        lua_pushlstring(ms->L, s, e - s);
+        return;
+    }
+
+    ptrdiff_t len = ms->capture[i].len;
+
+    if(len == PATTERN_CAP_UNFINISHED) {
+        luaL_error(ms->L, "unfinished capture");
+    } else if(len == PATTERN_CAP_POSITION) {
+        lua_pushinteger(ms->L, (ms->capture[i].init - ms->src_init) + 1);
+    } else {
+        lua_pushlstring(ms->L, ms->capture[i].init, len);
+    }
+}
+
+
+static int pattern_push_captures(pattern_state* ms,
+                                 const char* s, const char* e) {
+    int nlevels = (ms->level == 0 && s) ? 1 : ms->level;
+    int i;
+
+    luaL_checkstack(ms->L, nlevels, "too many captures");
+
+    for(i=0; i<nlevels; i++) {
+        pattern_push_capture(ms, i, s, e);
+    }
+
+    return nlevels;
+}
+
+
+static size_t pattern_start_position(lua_Integer pos, size_t len) {
+    // a 1-based, possibly negative, init argument as an offset into s
+    if(pos > 0) {
+        return (size_t)pos - 1;
+    } else if(pos == 0) {
+        return 0;
+    } else if((size_t)-pos > len) {
+        return 0;
+    }
+    return len - (size_t)-pos;
+}
+
+
+static const char* pattern_memfind(const char* s, size_t ls,
+                                   const char* p, size_t lp) {
+    // plain substring search, for find(..., plain) and patterns that have no
+    // special characters
+    if(lp == 0) {
+        return s;
+    }
+
+    while(lp <= ls) {
+        const char* init = (const char*)memchr(s, *p, ls - lp + 1);
+        if(init == NULL) {
+            return NULL;
+        }
+        if(memcmp(init+1, p+1, lp-1) == 0) {
+            return init;
+        }
+        ls -= (init+1) - s;
+        s = init+1;
+    }
+
+    return NULL;
+}
+
+
+static int pattern_find_aux(lua_State *L, int find) {
+    size_t ls, lp;
+    const char* s = luaL_checklstring(L, 1, &ls);
+    const char* p = luaL_checklstring(L, 2, &lp);
+    size_t init = pattern_start_position(luaL_optinteger(L, 3, 1), ls);
+
+    if(init > ls) {
+        lua_pushnil(L);
+        return 1;
+    }
+
+    if(find && (lua_toboolean(L, 4) || !pattern_has_specials(p, lp))) {
+        const char* found = pattern_memfind(s+init, ls-init, p, lp);
+        if(found != NULL) {
+            lua_pushinteger(L, (found - s) + 1);
+            lua_pushinteger(L, (found - s) + lp);
+            return 2;
+        }
+
+    } else {
+        pattern_state ms;
+        compiled_pattern* pattern;
+        const char* s1 = s + init;
+
+        lua_settop(L, 4);
+        pattern = get_compiled_pattern(L, 2, 1);
+        pattern_prepare(&ms, L, pattern, s, ls);
+
+        do {
+            const char* e;
+            pattern_reset(&ms);
+            if((e = pattern_match(&ms, s1, 0)) != NULL) {
+                if(find) {
+                    lua_pushinteger(L, (s1 - s) + 1);
+                    lua_pushinteger(L, e - s);
+                    return pattern_push_captures(&ms, NULL, 0) + 2;
+                }
+                return pattern_push_captures(&ms, s1, e);
+            }
+        } while(s1++ < ms.src_end && !pattern->anchored);
+    }
+
+    lua_pushnil(L);
+    return 1;
+}
+
+
+static int pattern_find(lua_State *L) {
+    return pattern_find_aux(L, 1);
+}
+
+
+static int pattern_match_lua(lua_State *L) {
+    return pattern_find_aux(L, 0);
+}
+
+
+static int pattern_gmatch_aux(lua_State *L) {
+    // upvalues: the string, the pattern, its compiled form, where to start
+    // and where the last match ended (or -1)
+    size_t ls;
+    const char* s = lua_tolstring(L, lua_upvalueindex(1), &ls);
+    compiled_pattern* pattern =
+        (compiled_pattern*)lua_touserdata(L, lua_upvalueindex(3));
+    ptrdiff_t pos = (ptrdiff_t)lua_tointeger(L, lua_upvalueindex(4));
+    ptrdiff_t last = (ptrdiff_t)lua_tointeger(L, lua_upvalueindex(5));
+    pattern_state ms;
+    const char* src;
+
+    pattern_prepare(&ms, L, pattern, s, ls);
+
+    for(src = s + pos; src <= ms.src_end; src++) {
+        const char* e;
+        pattern_reset(&ms);
+        if((e = pattern_match(&ms, src, 0)) != NULL && (e - s) != last) {
+            // the next search starts where this one ended, and we don't
+            // accept another empty match right there
+            lua_pushinteger(L, e - s);
+            lua_replace(L, lua_upvalueindex(4));
+            lua_pushinteger(L, e - s);
+            lua_replace(L, lua_upvalueindex(5));
+            return pattern_push_captures(&ms, src, e);
+        }
+    }
+
+    return 0; // not found
+}
+
+
+static int pattern_gmatch(lua_State *L) {
+    luaL_checkstring(L, 1);
+    luaL_checkstring(L, 2);
+    lua_settop(L, 2);
+    get_compiled_pattern(L, 2, 0);
+    lua_pushinteger(L, 0);
+    lua_pushinteger(L, -1);
+    lua_pushcclosure(L, pattern_gmatch_aux, 5);
+    return 1;
+}
+
+
+static void pattern_add_s(pattern_state* ms, luaL_Buffer* b,
+                          const char* s, const char* e) {
+    size_t l, i;
+    lua_State *L = ms->L;
+    const char* news = lua_tolstring(L, 3, &l);
+
+    for(i=0; i<l; i++) {
+        if(news[i] != '%') {
+            luaL_addchar(b, news[i]);
+            continue;
+        }
+
+        i++; // skip the %
+        if(!isdigit((unsigned char)news[i])) {
+            if(news[i] != '%') {
+                luaL_error(L, "invalid use of '%%' in replacement string");
+            }
+            luaL_addchar(b, news[i]);
+        } else if(news[i] == '0') {
+            luaL_addlstring(b, s, e - s);
+        } else {
+            // luaL_addvalue takes care of position captures being numbers
+            pattern_push_capture(ms, news[i] - '1', s, e);
+            luaL_addvalue(b);
+        }
+    }
+}
+
+
+static void pattern_add_value(pattern_state* ms, luaL_Buffer* b,
+                              const char* s, const char* e, int tr) {
+    lua_State *L = ms->L;
+
+    switch(tr) {
+        case LUA_TFUNCTION: {
+            int n;
+            lua_pushvalue(L, 3);
+            n = pattern_push_captures(ms, s, e);
+            lua_call(L, n, 1);
+            break;
+        }
+        case LUA_TTABLE:
+            pattern_push_capture(ms, 0, s, e);
+            lua_gettable(L, 3);
+            break;
+        default:
+            pattern_add_s(ms, b, s, e);
+            return;
+    }
+
+    if(!lua_toboolean(L, -1)) {
+        // nil or false means keep the original
+        lua_pop(L, 1);
+        lua_pushlstring(L, s, e - s);
+    } else if(!lua_isstring(L, -1)) {
+        luaL_error(L, "invalid replacement value (a %s)",
+                   luaL_typename(L, -1));
+    }
+
+    luaL_addvalue(b);
+}
+
+
+static int pattern_gsub(lua_State *L) {
+    size_t srcl;
+    const char* src = luaL_checklstring(L, 1, &srcl);
+    const char* lastmatch = NULL;
+    int tr = lua_type(L, 3);
+    lua_Integer max_s;
+    lua_Integer n = 0;
+    pattern_state ms;
+    compiled_pattern* pattern;
+    luaL_Buffer b;
+
+    luaL_checkstring(L, 2);
+    max_s = luaL_optinteger(L, 4, (lua_Integer)srcl+1);
+    luaL_argcheck(L, tr == LUA_TNUMBER || tr == LUA_TSTRING
+                     || tr == LUA_TFUNCTION || tr == LUA_TTABLE,
+                  3, "string/function/table expected");
+
+    lua_settop(L, 4);
+    pattern = get_compiled_pattern(L, 2, 1);
+    pattern_prepare(&ms, L, pattern, src, srcl);
+
+    luaL_buffinit(L, &b);
+
+    while(n < max_s) {
+        const char* e;
+        pattern_reset(&ms);
+        if((e = pattern_match(&ms, src, 0)) != NULL && e != lastmatch) {
+            n++;
+            pattern_add_value(&ms, &b, src, e, tr);
+            src = lastmatch = e;
+        } else if(src < ms.src_end) {
+            luaL_addchar(&b, *src++);
+        } else {
+            break;
+        }
+        if(pattern->anchored) {
+            break;
+        }
+    }
+
+    luaL_addlstring(&b, src, ms.src_end - src);
+    luaL_pushresult(&b);
+    lua_pushinteger(L, n);
+    return 2;
+}
+
+
+static const luaL_Reg pattern_lib[] = {
+    {"find", pattern_find},
+    {"gmatch", pattern_gmatch},
+    {"gsub", pattern_gsub},
+    {"match", pattern_match_lua},
+    {NULL, NULL}
+};
+
+
+void install_pattern(lua_State *L) {
+    // the global `pattern` library
+    lua_createtable(L, 0, sizeof(pattern_lib)/sizeof(luaL_Reg) - 1);
+    set_functions(L, pattern_lib);
+    lua_setglobal(L, "pattern");
+}
+
+
+static uint32_t lookup_u32(const unsigned char* p) {
+    // the file is little-endian whatever we're running on
+    return (uint32_t)p[0] | ((uint32_t)p[1] << 8)
+           | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+
+static void lookup_entry(lookup_mapping* m, uint32_t i,
+                         const char** key, size_t* key_len,
+                         const char** value, size_t* value_len) {
+    const unsigned char* e = m->base + EXECUTOR_LOOKUP_HEADER_SIZE
+                             + (size_t)i * EXECUTOR_LOOKUP_ENTRY_SIZE;
+    if(key) {
+        *key = (const char*)m->base + lookup_u32(e);
+        *key_len = lookup_u32(e+4);
+    }
+    if(value) {
+        *value = (const char*)m->base + lookup_u32(e+8);
+        *value_len = lookup_u32(e+12);
+    }
+}
+
+
+static int lookup_compare(const char* a, size_t a_len,
+                          const char* b, size_t b_len) {
+    // bytewise, then shorter first. write_lookup_table sorts the same way
+    int c = memcmp(a, b, a_len < b_len ? a_len : b_len);
+    if(c) {
+        return c;
+    }
+    return a_len < b_len ? -1 : a_len > b_len ? 1 : 0;
+}
+
+
+static uint32_t lookup_lower_bound(lookup_mapping* m,
+                                   const char* key, size_t len, int* exact) {
+    /*
+     * The index of the first entry >= key (m->count if there isn't one), and
+     * whether it's equal to key
+     */
+    uint32_t lo = 0, hi = m->count;
+    const char* k;
+    size_t k_len;
+
+    while(lo < hi) {
+        uint32_t mid = lo + (hi-lo)/2;
+        lookup_entry(m, mid, &k, &k_len, NULL, NULL);
+        if(lookup_compare(k, k_len, key, len) < 0) {
+            lo = mid+1;
+        } else {
+            hi = mid;
+        }
+    }
+
+    if(exact) {
+        *exact = 0;
+        if(lo < m->count) {
+            lookup_entry(m, lo, &k, &k_len, NULL, NULL);
+            *exact = lookup_compare(k, k_len, key, len) == 0;
+        }
+    }
+
+    return lo;
+}
+
+
+static lookup_mapping* lookup_map_file(const char* path) {
+    /*
+     * mmap a file written by executor.py:write_lookup_table and check that
+     * every entry lies inside of it and that they're in order, so that we
+     * never have to check again. Returns NULL with a Python exception set on
+     * failure
+     */
+    int fd = open(path, O_RDONLY);
+    if(fd == -1) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, (char*)path);
+        return NULL;
+    }
+
+    struct stat st;
+    if(fstat(fd, &st) == -1) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, (char*)path);
+        close(fd);
+        return NULL;
+    }
+
+    size_t size = (size_t)st.st_size;
+    if(size < EXECUTOR_LOOKUP_HEADER_SIZE) {
+        close(fd);
+        PyErr_Format(PyExc_ValueError, "%s isn't a lookup table", path);
+        return NULL;
+    }
+
+    void* base = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+    // the mapping keeps the file alive on its own
+    close(fd);
+
+    if(base == MAP_FAILED) {
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, (char*)path);
+        return NULL;
+    }
+
+    lookup_mapping* m = (lookup_mapping*)malloc(sizeof(lookup_mapping));
+    if(m == NULL) {
+        munmap(base, size);
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    m->refcount = 1;
+    m->base = (const unsigned char*)base;
+    m->size = size;
+    m->count = lookup_u32(m->base + 8);
+
+    uint32_t i;
+    const char* prev_key = NULL;
+    size_t prev_len = 0;
+
+    int valid = memcmp(m->base, EXECUTOR_LOOKUP_MAGIC, 8) == 0
+                && ((size - EXECUTOR_LOOKUP_HEADER_SIZE)
+                    / EXECUTOR_LOOKUP_ENTRY_SIZE) >= m->count;
+
+    for(i=0; valid && i<m->count; i++) {
+        const unsigned char* e = m->base + EXECUTOR_LOOKUP_HEADER_SIZE
+                                 + (size_t)i * EXECUTOR_LOOKUP_ENTRY_SIZE;
+        size_t key_off = lookup_u32(e), key_len = lookup_u32(e+4);
+        size_t value_off = lookup_u32(e+8), value_len = lookup_u32(e+12);
+        const char* key = (const char*)m->base + key_off;
+
+        valid = key_off <= size && key_len <= size - key_off
+                && value_off <= size && value_len <= size - value_off
+                && (prev_key == NULL
+                    || lookup_compare(prev_key, prev_len, key, key_len) < 0);
+
+        prev_key = key;
+        prev_len = key_len;
+    }
+
+    if(!valid) {
+        munmap(base, size);
+        free(m);
+        PyErr_Format(PyExc_ValueError, "%s isn't a valid lookup table", path);
+        return NULL;
+    }
+
+    return m;
+}
+
+
+static lookup_mapping* lookup_acquire(lookup_table* t) {
+    // a reference to the current version of t's file
+    pthread_mutex_lock(&t->lock);
+    lookup_mapping* m = t->current;
+    m->refcount++;
+    pthread_mutex_unlock(&t->lock);
+    return m;
+}
+
+
+static void lookup_release(lookup_table* t, lookup_mapping* m) {
+    pthread_mutex_lock(&t->lock);
+    int last = --m->refcount == 0;
+    pthread_mutex_unlock(&t->lock);
+
+    if(last) {
+        munmap((void*)m->base, m->size);
+        free(m);
+    }
+}
+
+
+lookup_table* lookup_table_open(const char* path) {
+    /*
+     * Returns NULL with a Python exception set on failure. The caller owns
+     * the one reference, and every userdata that we push takes another
+     */
+    lookup_mapping* m = lookup_map_file(path);
+    if(m == NULL) {
+        return NULL;
+    }
+
+    lookup_table* t = (lookup_table*)malloc(sizeof(lookup_table));
+    if(t == NULL) {
+        munmap((void*)m->base, m->size);
+        free(m);
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    pthread_mutex_init(&t->lock, NULL);
+    t->refcount = 1;
+    t->current = m;
+
+    return t;
+}
+
+
+int lookup_table_swap(lookup_table* t, const char* path) {
+    /*
+     * Switch t over to the file at path. Lookups that started on the old one
+     * finish on it, and it's unmapped when the last of them lets go. Returns
+     * 0 with a Python exception set (and t unchanged) on failure
+     */
+    lookup_mapping* m = lookup_map_file(path);
+    if(m == NULL) {
+        return 0;
+    }
+
+    pthread_mutex_lock(&t->lock);
+    lookup_mapping* old = t->current;
+    t->current = m;
+    pthread_mutex_unlock(&t->lock);
+
+    lookup_release(t, old);
+    return 1;
+}
+
+
+void lookup_table_release(lookup_table* t) {
+    pthread_mutex_lock(&t->lock);
+    int last = --t->refcount == 0;
+    pthread_mutex_unlock(&t->lock);
+
+    if(last) {
+        lookup_release(t, t->current);
+        pthread_mutex_destroy(&t->lock);
+        free(t);
+    }
+}
+
+
+size_t lookup_table_count(lookup_table* t) {
+    lookup_mapping* m = lookup_acquire(t);
+    size_t count = m->count;
+    lookup_release(t, m);
+    return count;
+}
+
+
+PyObject* lookup_table_get(lookup_table* t, PyObject* key) {
+    /*
+     * The value for key (a str) as a Python string, or None. For looking
+     * things up from Python without going through Lua
+     */
+    if(!PyString_Check(key)) {
+        PyErr_SetString(PyExc_TypeError, "lookup table keys are strings");
+        return NULL;
+    }
+
+    lookup_mapping* m = lookup_acquire(t);
+    PyObject* ret;
+    int exact;
+    uint32_t i = lookup_lower_bound(m, PyString_AS_STRING(key),
+                                    PyString_GET_SIZE(key), &exact);
+
+    if(exact) {
+        const char* value;
+        size_t value_len;
+        lookup_entry(m, i, NULL, NULL, &value, &value_len);
+        ret = PyString_FromStringAndSize(value, value_len);
+    } else {
+        Py_INCREF(Py_None);
+        ret = Py_None;
+    }
+
+    lookup_release(t, m);
+    return ret;
+}
+
+
+void push_lookup_table(lua_State *L, lookup_table* t) {
+    /*
+     * Push a userdata for t. It pins whichever version of the file it last
+     * looked at, so that the memory it's reading can't be unmapped out from
+     * under it, even if a lookup longjmps out half way through
+     */
+    lua_lookup_table* ud =
+        (lua_lookup_table*)executor_newuserdata(L, sizeof(lua_lookup_table));
+    ud->table = NULL;
+    ud->mapping = NULL;
+
+    lua_getfield(L, LUA_REGISTRYINDEX, EXECUTOR_LUA_LOOKUP_KEY);
+    lua_setmetatable(L, -2);
+
+    pthread_mutex_lock(&t->lock);
+    t->refcount++;
+    pthread_mutex_unlock(&t->lock);
+
+    ud->table = t;
+    ud->mapping = lookup_acquire(t);
+}
+
+
+static lookup_mapping* lookup_check(lua_State *L, int idx) {
+    /*
+     * The current version of the file for the lookup table userdata at idx,
+     * which it now pins
+     */
+    lua_lookup_table* ud =
+        (lua_lookup_table*)luaL_checkudata(L, idx, EXECUTOR_LUA_LOOKUP_KEY);
+
+    lookup_table* t = ud->table;
+
+    pthread_mutex_lock(&t->lock);
+    int stale = ud->mapping != t->current;
+    pthread_mutex_unlock(&t->lock);
+
+    if(stale) {
+        lookup_mapping* old = ud->mapping;
+        ud->mapping = lookup_acquire(t);
+        lookup_release(t, old);
+    }
+
+    return ud->mapping;
+}
+
+
+static int lookup_push_entry(lua_State *L, lookup_mapping* m, uint32_t i) {
+    const char *key, *value;
+    size_t key_len, value_len;
+    lookup_entry(m, i, &key, &key_len, &value, &value_len);
+    lua_pushlstring(L, key, key_len);
+    lua_pushlstring(L, value, value_len);
+    return 2;
+}
+
+
+static int lookup_get(lua_State *L) {
+    lookup_mapping* m = lookup_check(L, 1);
+    size_t len;
+    const char* key = luaL_checklstring(L, 2, &len);
+
+    int exact;
+    uint32_t i = lookup_lower_bound(m, key, len, &exact);
+
+    if(!exact) {
+        lua_pushnil(L);
+        return 1;
+    }
+
+    const char* value;
+    size_t value_len;
+    lookup_entry(m, i, NULL, NULL, &value, &value_len);
+    lua_pushlstring(L, value, value_len);
+    return 1;
+}
+
+
+static int lookup_contains(lua_State *L) {
+    lookup_mapping* m = lookup_check(L, 1);
+    size_t len;
+    const char* key = luaL_checklstring(L, 2, &len);
+
+    int exact;
+    lookup_lower_bound(m, key, len, &exact);
+
+    lua_pushboolean(L, exact);
+    return 1;
+}
+
+
+static int lookup_floor(lua_State *L) {
+    /*
+     * The greatest key <= the one given, and its value. With ranges stored by
+     * their first key (like IP ranges by their packed start address), that's
+     * the range that a key falls into
+     */
+    lookup_mapping* m = lookup_check(L, 1);
+    size_t len;
+    const char* key = luaL_checklstring(L, 2, &len);
+
+    int exact;
+    uint32_t i = lookup_lower_bound(m, key, len, &exact);
+
+    if(!exact) {
+        if(i == 0) {
+            lua_pushnil(L);
+            return 1;
+        }
+        i--;
+    }
+
+    return lookup_push_entry(L, m, i);
+}
+
+
+static int lookup_range(lua_State *L) {
+    /*
+     * An iterator over the keys and values from lo to hi inclusive, in order.
+     * Either may be nil to leave that end open. It iterates over the version
+     * of the file that was current when it started
+     */
+    lua_lookup_table* ud =
+        (lua_lookup_table*)luaL_checkudata(L, 1, EXECUTOR_LUA_LOOKUP_KEY);
+    lookup_mapping* m = lookup_check(L, 1);
+
+    size_t lo_len, hi_len;
+    const char* lo = luaL_optlstring(L, 2, NULL, &lo_len);
+    const char* hi = luaL_optlstring(L, 3, NULL, &hi_len);
+
+    uint32_t start = lo ? lookup_lower_bound(m, lo, lo_len, NULL) : 0;
+    uint32_t end = m->count;
+
+    if(hi) {
+        int exact;
+        end = lookup_lower_bound(m, hi, hi_len, &exact);
+        if(exact) {
+            end++;
+        }
+    }
+
+    lookup_cursor* cursor =
+        (lookup_cursor*)executor_newuserdata(L, sizeof(lookup_cursor));
+    cursor->table = NULL;
+    cursor->mapping = NULL;
+    cursor->pos = start;
+    cursor->end = end;
+
+    lua_getfield(L, LUA_REGISTRYINDEX, EXECUTOR_LUA_LOOKUP_CURSOR_KEY);
+    lua_setmetatable(L, -2);
+
+    // nothing below here can fail, so the references can't leak
+    lookup_table* t = ud->table;
+    pthread_mutex_lock(&t->lock);
+    t->refcount++;
+    m->refcount++;
+    pthread_mutex_unlock(&t->lock);
+
+    cursor->table = t;
+    cursor->mapping = m;
+
+    lua_pushcclosure(L, lookup_range_next, 1);
+    return 1;
+}
+
+
+static int lookup_range_next(lua_State *L) {
+    lookup_cursor* cursor = (lookup_cursor*)lua_touserdata(L,
+                                                           lua_upvalueindex(1));
+
+    if(cursor->pos >= cursor->end) {
+        return 0;
+    }
+
+    return lookup_push_entry(L, cursor->mapping, cursor->pos++);
+}
+
+
+static int lookup_len(lua_State *L) {
+    lookup_mapping* m = lookup_check(L, 1);
+    lua_pushinteger(L, (lua_Integer)m->count);
+    return 1;
+}
+
+
+static int free_lookup_table(lua_State *L) {
+    lua_lookup_table* ud =
+        (lua_lookup_table*)luaL_checkudata(L, 1, EXECUTOR_LUA_LOOKUP_KEY);
+
+    if(ud->table != NULL) {
+        lookup_release(ud->table, ud->mapping);
+        lookup_table_release(ud->table);
+        ud->table = NULL;
+        ud->mapping = NULL;
+    }
+
+    return 0;
+}
+
+
+static int free_lookup_cursor(lua_State *L) {
+    lookup_cursor* cursor = (lookup_cursor*)luaL_checkudata(
+        L, 1, EXECUTOR_LUA_LOOKUP_CURSOR_KEY);
+
+    if(cursor->table != NULL) {
+        lookup_release(cursor->table, cursor->mapping);
+        lookup_table_release(cursor->table);
+        cursor->table = NULL;
+        cursor->mapping = NULL;
+    }
+
+    return 0;
+}
+
+
+static const luaL_Reg lookup_table_methods[] = {
+    {"contains", lookup_contains},
+    {"floor", lookup_floor},
+    {"get", lookup_get},
+    {"range", lookup_range},
+    {NULL, NULL}
+};
+
+
+void install_lookup_table(lua_State *L) {
+    /*
+     * Install the metatables for lookup tables and their range cursors. All
+     * of the methods are in C, called like t:get(key)
+     */
+    luaL_newmetatable(L, EXECUTOR_LUA_LOOKUP_KEY);
+
+    lua_pushcclosure(L, free_lookup_table, 0);
+    lua_setfield(L, -2, "__gc");
+
+    lua_pushcclosure(L, lookup_len, 0);
+    lua_setfield(L, -2, "__len");
+
+    lua_createtable(L, 0, sizeof(lookup_table_methods)/sizeof(luaL_Reg) - 1);
+    set_functions(L, lookup_table_methods);
+    lua_setfield(L, -2, "__index");
+
+    // so we can identify it
+    lua_pushstring(L, "lookuptable");
+    lua_setfield(L, -2, "lookuptable");
+
+    lua_pop(L, 1); // the metatable
+
+    luaL_newmetatable(L, EXECUTOR_LUA_LOOKUP_CURSOR_KEY);
+    lua_pushcclosure(L, free_lookup_cursor, 0);
+    lua_setfield(L, -2, "__gc");
+    lua_pop(L, 1);
+}
+
+
+static const luaL_Reg executor_libraries[] = {
+    {"_G", luaopen_base},
+#if LUA_VERSION_NUM == 501
+    {LUA_COLIBNAME, NULL}, // comes with the base library
+#else
+    {LUA_COLIBNAME, luaopen_coroutine},
+#endif
+    {LUA_LOADLIBNAME, luaopen_package},
+    {LUA_TABLIBNAME, luaopen_table},
+    {LUA_IOLIBNAME, luaopen_io},
+    {LUA_OSLIBNAME, luaopen_os},
+    {LUA_STRLIBNAME, luaopen_string},
+    {LUA_MATHLIBNAME, luaopen_math},
+    {LUA_DBLIBNAME, luaopen_debug},
+#if LUA_VERSION_NUM == 501
+    {LUA_BITLIBNAME, luaopen_bit},
+    {LUA_JITLIBNAME, luaopen_jit},
+    {LUA_FFILIBNAME, luaopen_ffi},
+#elif LUA_VERSION_NUM == 502
+    {LUA_BITLIBNAME, luaopen_bit32},
+#else
+    {LUA_UTF8LIBNAME, luaopen_utf8},
+#endif
+    {NULL, NULL}
+};
+
+
+int open_library(lua_State *L, const char* name) {
+    /*
+     * Open just the one standard library, where luaL_openlibs would open all
+     * of them. Returns 0 if there's no library by that name
+     */
+    const luaL_Reg* lib;
+
+    for(lib = executor_libraries; lib->name != NULL; lib++) {
+        if(strcmp(lib->name, name) != 0) {
+            continue;
+        }
+
+        if(lib->func == NULL) {
+            return 1;
+        }
+
+#if LUA_VERSION_NUM == 501
+        lua_pushcfunction(L, lib->func);
+        lua_pushstring(L, strcmp(name, "_G") == 0 ? "" : name);
+        lua_call(L, 1, 0);
+#else
+        luaL_requiref(L, name, lib->func, 1);
+        lua_pop(L, 1);
+#endif
+        return 1;
+    }
+
+    return 0;
+}
+
+
+int executor_gc(lua_State *L, int what, int data) {
+    // lua_gc is variadic in 5.4, which ctypes can't call portably
+    return lua_gc(L, what, data);
+}
+
+
+int set_gc_mode(lua_State *L, int mode) {
+    /*
+     * Switch the collector to LUA_GCGEN or LUA_GCINC, keeping its current
+     * parameters. Returns the previous mode, or -1 if there's no choice
+     */
+#if LUA_VERSION_NUM >= 504
+    return lua_gc(L, mode, 0, 0, 0);
+#else
+    return -1;
+#endif
+}
+
+
+/*
+ * Python versions of the hottest Lua API calls, so executor.py can skip
+ * ctypes' argument conversion for them. They take the same arguments as their
+ * ctypes equivalents: a lua_State* (as an int or the ctypes.c_void_p that
+ * executor.py keeps around) and then some ints
+ */
+
+
+static lua_State* state_from_python(PyObject* o) {
+    lua_State* L = NULL;
+
+    if(PyInt_Check(o) || PyLong_Check(o)) {
+        L = (lua_State*)PyLong_AsVoidPtr(o);
+        if(L == NULL && PyErr_Occurred()) {
+            return NULL;
+        }
+
+    } else {
+        // a ctypes.c_void_p, whose buffer is the pointer itself
+        Py_buffer view;
+
+        if(PyObject_GetBuffer(o, &view, PyBUF_SIMPLE) == -1) {
+            return NULL;
+        }
+        if(view.len == sizeof(L)) {
+            memcpy(&L, view.buf, sizeof(L));
+        }
+        PyBuffer_Release(&view);
+    }
+
+    if(L == NULL) {
+        PyErr_SetString(PyExc_ValueError, "expected a lua_State*");
+    }
+
+    return L;
+}
+
+
+static int parse_state_args(PyObject* args, const char* name, int nints,
+                            lua_State** L, int* ints) {
+    /*
+     * Unpack a lua_State* and nints ints from args. Returns 0 with a Python
+     * exception set if that's not what we were given
+     */
+    int i;
+
+    if(PyTuple_GET_SIZE(args) != nints+1) {
+        PyErr_Format(PyExc_TypeError, "%s() takes exactly %d arguments (%d given)",
+                     name, nints+1, (int)PyTuple_GET_SIZE(args));
+        return 0;
+    }
+
+    *L = state_from_python(PyTuple_GET_ITEM(args, 0));
+    if(*L == NULL) {
+        return 0;
+    }
+
+    for(i=0; i<nints; i++) {
+        long value = PyInt_AsLong(PyTuple_GET_ITEM(args, i+1));
+        if(value == -1 && PyErr_Occurred()) {
+            return 0;
+        }
+        ints[i] = (int)value;
+    }
+
+    return 1;
+}
+
+
+static PyObject* api_result(PyObject* ret) {
+    // like ctypes.PyDLL, notice if anything that Lua called back into (like a
+    // __gc) left a Python exception set
+    if(PyErr_Occurred()) {
+        Py_XDECREF(ret);
+        return NULL;
+    }
+    return ret;
+}
+
+
+static PyObject* api_none(void) {
+    Py_INCREF(Py_None);
+    return api_result(Py_None);
+}
+
+
+static PyObject* py_lua_gettop(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_gettop", 0, &L, ints)) {
+        return NULL;
+    }
+    return api_result(PyInt_FromLong(lua_gettop(L)));
+}
+
+
+static PyObject* py_lua_settop(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_settop", 1, &L, ints)) {
+        return NULL;
+    }
+    lua_settop(L, ints[0]);
+    return api_none();
+}
+
+
+static PyObject* py_lua_pop(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_pop", 1, &L, ints)) {
+        return NULL;
+    }
+    lua_pop(L, ints[0]);
+    return api_none();
+}
+
+
+static PyObject* py_lua_type(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_type", 1, &L, ints)) {
+        return NULL;
+    }
+    return api_result(PyInt_FromLong(lua_type(L, ints[0])));
+}
+
+
+static PyObject* py_lua_checkstack(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_checkstack", 1, &L, ints)) {
+        return NULL;
+    }
+    return api_result(PyInt_FromLong(lua_checkstack(L, ints[0])));
+}
+
+
+static PyObject* py_lua_pushnil(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_pushnil", 0, &L, ints)) {
+        return NULL;
+    }
+    lua_pushnil(L);
+    return api_none();
+}
+
+
+static PyObject* py_lua_pushvalue(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_pushvalue", 1, &L, ints)) {
+        return NULL;
+    }
+    lua_pushvalue(L, ints[0]);
+    return api_none();
+}
+
+
+static PyObject* py_lua_rawget(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_rawget", 1, &L, ints)) {
+        return NULL;
+    }
+    lua_rawget(L, ints[0]);
+    return api_none();
+}
+
+
+static PyObject* py_lua_rawgeti(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[2];
+    if(!parse_state_args(args, "lua_rawgeti", 2, &L, ints)) {
+        return NULL;
+    }
+    lua_rawgeti(L, ints[0], ints[1]);
+    return api_none();
+}
+
+
+static PyObject* py_lua_rawset(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "lua_rawset", 1, &L, ints)) {
+        return NULL;
+    }
+    lua_rawset(L, ints[0]);
+    return api_none();
+}
+
+
+static PyObject* py_luaL_ref(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "luaL_ref", 1, &L, ints)) {
+        return NULL;
+    }
+    return api_result(PyInt_FromLong(luaL_ref(L, ints[0])));
+}
+
+
+static PyObject* py_luaL_unref(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[2];
+    if(!parse_state_args(args, "luaL_unref", 2, &L, ints)) {
+        return NULL;
+    }
+    luaL_unref(L, ints[0], ints[1]);
+    return api_none();
+}
+
+
+static PyObject* py_enable_limit_memory(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "enable_limit_memory", 0, &L, ints)) {
+        return NULL;
+    }
+    enable_limit_memory(L);
+    return api_none();
+}
+
+
+static PyObject* py_disable_limit_memory(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[1];
+    if(!parse_state_args(args, "disable_limit_memory", 0, &L, ints)) {
+        return NULL;
+    }
+    disable_limit_memory(L);
+    return api_none();
+}
+
+
+static PyObject* py_limited_pcall(PyObject* self, PyObject* args) {
+    lua_State* L;
+    int ints[2];
+    int ret;
+
+    if(!parse_state_args(args, "limited_pcall", 2, &L, ints)) {
+        return NULL;
+    }
+
+    // like lua_pcallk from ctypes.CDLL, we run without the GIL. Anything that
+    // calls back into Python takes it back for itself
+    Py_BEGIN_ALLOW_THREADS
+
+    // allocation limiting must only be turned on while we're operating
+    // inside of a pcall, or Lua's longjmp will skip turning it back off
+    enable_limit_memory(L);
+#if LUA_VERSION_NUM == 501
+    ret = memory_safe_pcallk(L, ints[0], ints[1], 0);
+#else
+    ret = lua_pcall(L, ints[0], ints[1], 0);
+#endif
+    disable_limit_memory(L);
+
+    Py_END_ALLOW_THREADS
+
+    return PyInt_FromLong(ret);
+}
+
+
+static PyMethodDef executor_methods[] = {
+    {"lua_gettop", py_lua_gettop, METH_VARARGS, NULL},
+    {"lua_settop", py_lua_settop, METH_VARARGS, NULL},
+    {"lua_pop", py_lua_pop, METH_VARARGS, NULL},
+    {"lua_type", py_lua_type, METH_VARARGS, NULL},
+    {"lua_checkstack", py_lua_checkstack, METH_VARARGS, NULL},
+    {"lua_pushnil", py_lua_pushnil, METH_VARARGS, NULL},
+    {"lua_pushvalue", py_lua_pushvalue, METH_VARARGS, NULL},
+    {"lua_rawget", py_lua_rawget, METH_VARARGS, NULL},
+    {"lua_rawgeti", py_lua_rawgeti, METH_VARARGS, NULL},
+    {"lua_rawset", py_lua_rawset, METH_VARARGS, NULL},
+    {"luaL_ref", py_luaL_ref, METH_VARARGS, NULL},
+    {"luaL_unref", py_luaL_unref, METH_VARARGS, NULL},
+    {"enable_limit_memory", py_enable_limit_memory, METH_VARARGS, NULL},
+    {"disable_limit_memory", py_disable_limit_memory, METH_VARARGS, NULL},
+    {"limited_pcall", py_limited_pcall, METH_VARARGS,
+     "enable_limit_memory, lua_pcall and disable_limit_memory in one call"},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static int add_int_constant(PyObject* module, char* name, int value) {
+    PyObject *as_int = PyInt_FromLong(value);
+    if(as_int == NULL) {
+        return -1;
+    }
+
+    if(PyModule_AddObject(module, name, as_int) == 1) {
+        return -1;
+    }
+
+    return 0;
+}
+
+
+static int add_str_constant(PyObject* module, char* name, char* value) {
+    PyObject *as_str = PyString_FromString(value);
+    if(as_str == NULL) {
+        return -1;
+    }
+
+    if(PyModule_AddObject(module, name, as_str) == 1) {
+        return -1;
+    }
+
+    return 0;
+}
+
+
+PyMODINIT_FUNC init_executor(void) {
+    // initialise the module
+
+    PyObject* module = NULL;
+
+    module = Py_InitModule3("lua_sandbox._executor",
+        executor_methods,
+        "C portion that implements the Lua-Python bridge");
+    if (module == NULL) {
+        /* exception raised in preparing */
+        return;
+    }
+
+    /*
+        Lua keeps a bunch of really important constants in #defines so they
+        aren't accessible at runtime from ctypes. This just attempts to copy
+        them into the module's namespace so they are accessible at runtime
+    */
+
+    if(add_int_constant(module, "LUA_REGISTRYINDEX", LUA_REGISTRYINDEX)==-1)
+        goto error;
+
+#ifdef LUA_GLOBALSINDEX
+    if(add_int_constant(module, "LUA_GLOBALSINDEX", LUA_GLOBALSINDEX)==-1)
+        goto error;
+#endif
+
+    if(add_int_constant(module, "LUA_TNIL", LUA_TNIL)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TBOOLEAN", LUA_TBOOLEAN)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TLIGHTUSERDATA", LUA_TLIGHTUSERDATA)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TNUMBER", LUA_TNUMBER)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TSTRING", LUA_TSTRING)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TTABLE", LUA_TTABLE)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TFUNCTION", LUA_TFUNCTION)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TUSERDATA", LUA_TUSERDATA)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_TTHREAD", LUA_TTHREAD)==-1)
+        goto error;
+
+    if(add_int_constant(module, "LUA_MULTRET", LUA_MULTRET)==-1)
+        goto error;
+
+    if(add_int_constant(module, "LUA_OK", LUA_OK)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_YIELD", LUA_YIELD)==-1)
+        goto error;
     if(add_int_constant(module, "LUA_ERRSYNTAX", LUA_ERRSYNTAX)==-1)
         goto error;
     if(add_int_constant(module, "LUA_ERRRUN", LUA_ERRRUN)==-1)
@@ -745,8 +5569,54 @@ PyMODINIT_FUNC init_executor(void) {
     if(add_int_constant(module, "LUA_MASKLINE", LUA_MASKLINE)==-1)
         goto error;
 
+    if(add_int_constant(module, "LUA_GCSTOP", LUA_GCSTOP)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_GCRESTART", LUA_GCRESTART)==-1)
+        goto error;
     if(add_int_constant(module, "LUA_GCCOLLECT", LUA_GCCOLLECT)==-1)
         goto error;
+    if(add_int_constant(module, "LUA_GCSTEP", LUA_GCSTEP)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_GCCOUNT", LUA_GCCOUNT)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_GCCOUNTB", LUA_GCCOUNTB)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_GCSETPAUSE", LUA_GCSETPAUSE)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_GCSETSTEPMUL", LUA_GCSETSTEPMUL)==-1)
+        goto error;
+
+    if(add_int_constant(module, "EXECUTOR_ARRAY_FLOAT64",
+                        EXECUTOR_ARRAY_FLOAT64)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_ARRAY_INT64",
+                        EXECUTOR_ARRAY_INT64)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_ARRAY_INT32",
+                        EXECUTOR_ARRAY_INT32)==-1)
+        goto error;
+
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_ANY",
+                        EXECUTOR_SCHEMA_ANY)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_STR",
+                        EXECUTOR_SCHEMA_STR)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_INT",
+                        EXECUTOR_SCHEMA_INT)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_FLOAT",
+                        EXECUTOR_SCHEMA_FLOAT)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_BOOL",
+                        EXECUTOR_SCHEMA_BOOL)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_RECORD",
+                        EXECUTOR_SCHEMA_RECORD)==-1)
+        goto error;
+    if(add_int_constant(module, "EXECUTOR_SCHEMA_LIST",
+                        EXECUTOR_SCHEMA_LIST)==-1)
+        goto error;
 
     if(add_str_constant(module, "LUA_LIB_NAME", LUA_LIB_NAME)==-1)
         goto error;
@@ -777,6 +5647,19 @@ PyMODINIT_FUNC init_executor(void) {
                         EXECUTOR_XSTR(LUA_NUMBER))==-1)
         goto error;
 
+#if LUA_VERSION_NUM >= 503
+    if(add_int_constant(module, "EXECUTOR_LUA_INTEGER_SIZE",
+                        sizeof(lua_Integer))==-1)
+        goto error;
+#endif
+
+#if LUA_VERSION_NUM >= 504
+    if(add_int_constant(module, "LUA_GCGEN", LUA_GCGEN)==-1)
+        goto error;
+    if(add_int_constant(module, "LUA_GCINC", LUA_GCINC)==-1)
+        goto error;
+#endif
+
     return;
 
 error:
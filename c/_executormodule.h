@@ -1,6 +1,8 @@
 #ifndef _EXECUTOR_MODULE_H
 #define _EXECUTOR_MODULE_H
 
+#include <pthread.h>
+#include <stdint.h>
 #include <time.h>
 
 #include <Python.h>
@@ -14,7 +16,61 @@
 #define LUA_OK 0
 #endif
 
+#if LUA_VERSION_NUM == 501
+#define executor_rawlen lua_objlen
+#else
+#define executor_rawlen lua_rawlen
+#endif
+
+#if LUA_VERSION_NUM >= 504
+// none of our userdatas need user values
+#define executor_newuserdata(L, size) lua_newuserdatauv(L, size, 0)
+#else
+#define executor_newuserdata(L, size) lua_newuserdata(L, size)
+#endif
+
 char* EXECUTOR_LUA_CAPSULE_KEY = "EXECUTOR_LUA_CAPSULE_KEY";
+char* EXECUTOR_LUA_ARRAY_KEY = "EXECUTOR_LUA_ARRAY_KEY";
+char* EXECUTOR_PATTERN_CACHE_KEY = "EXECUTOR_PATTERN_CACHE_KEY";
+char* EXECUTOR_LUA_LOOKUP_KEY = "EXECUTOR_LUA_LOOKUP_KEY";
+char* EXECUTOR_LUA_LOOKUP_CURSOR_KEY = "EXECUTOR_LUA_LOOKUP_CURSOR_KEY";
+
+// the layout of lookup table files (see executor.py:write_lookup_table): the
+// magic, a uint32 count, 4 reserved bytes, then the entries sorted by key,
+// each of them the uint32 offset and length of its key then of its value
+#define EXECUTOR_LOOKUP_MAGIC "LSBLKUP1"
+#define EXECUTOR_LOOKUP_HEADER_SIZE 16
+#define EXECUTOR_LOOKUP_ENTRY_SIZE 16
+
+// how deeply nested a table can be for us to convert it to Python in C
+#define EXECUTOR_MAX_CONVERSION_DEPTH 100
+
+// what we guess it costs to hold a Python object in references, on top of the
+// size of the object itself
+#define EXECUTOR_PYTHON_REFERENCE_OVERHEAD 128
+
+// how many steps the pattern matcher takes between checks of the runtime
+// limiter, and how deeply it may recurse (like lstrlib's MAXCCALLS)
+#define EXECUTOR_PATTERN_CHECK_INTERVAL 10000
+#define EXECUTOR_PATTERN_MAX_DEPTH 200
+
+// only 5.1 exports this from luaconf.h; later versions keep it in lstrlib.c
+#ifndef LUA_MAXCAPTURES
+#define LUA_MAXCAPTURES 32
+#endif
+
+// the kinds of field in a schema (see executor.py:Schema)
+#define EXECUTOR_SCHEMA_ANY 0
+#define EXECUTOR_SCHEMA_STR 1
+#define EXECUTOR_SCHEMA_INT 2
+#define EXECUTOR_SCHEMA_FLOAT 3
+#define EXECUTOR_SCHEMA_BOOL 4
+#define EXECUTOR_SCHEMA_RECORD 5
+#define EXECUTOR_SCHEMA_LIST 6
+
+#define EXECUTOR_ARRAY_FLOAT64 1
+#define EXECUTOR_ARRAY_INT64 2
+#define EXECUTOR_ARRAY_INT32 3
 
 typedef struct {
     int enabled;
@@ -22,6 +78,10 @@ typedef struct {
     size_t memory_limit;
     lua_Alloc old_allocf;
     void* old_ud;
+    // whether objects held by capsules count against memory_limit, and what
+    // they've been charged so far (see store_python_capsule)
+    int charge_python;
+    size_t python_used;
 } memory_limiter;
 
 typedef struct {
@@ -37,17 +97,139 @@ typedef struct {
     int cache;
     int recursive;
     int raw_lua_args;
+    int returns_future;
+    // what we charged for val and who to refund when we're collected. This
+    // points into the control block, which outlives every capsule
+    size_t charged;
+    size_t* charged_to;
 } lua_capsule;
 
+typedef struct {
+    PyObject* owner;
+    char* data;
+    size_t length; // in items, not bytes
+    int kind;
+    int readonly;
+    int has_view;
+    Py_buffer view;
+} lua_typed_array;
+
+// one version of a lookup table's file, mapped into memory
+typedef struct {
+    int refcount; // guarded by its lookup_table's lock
+    const unsigned char* base;
+    size_t size;
+    uint32_t count;
+} lookup_mapping;
+
+// shared by every state (and the Python LookupTable) that uses it
+typedef struct {
+    pthread_mutex_t lock;
+    int refcount;
+    lookup_mapping* current;
+} lookup_table;
+
+// what Lua sees. mapping is the version that it last looked at
+typedef struct {
+    lookup_table* table;
+    lookup_mapping* mapping;
+} lua_lookup_table;
+
+// a range() in progress
+typedef struct {
+    lookup_table* table;
+    lookup_mapping* mapping;
+    uint32_t pos;
+    uint32_t end;
+} lookup_cursor;
+
+typedef struct {
+    size_t memory_used; // the blocks that we allocated and are still in use
+    size_t memory_limit;
+    size_t refused; // where the last allocation that we refused would've gone
+    // one for executor.py:Tenant and one for each block in tenant_owners that
+    // we own. Changed atomically, since Tenant can be freed in any thread
+    size_t refcount;
+    clock_t runtime_started;
+    clock_t runtime_used;
+} lua_tenant;
+
+// which tenant allocated each of the blocks that tenants own, as an open
+// addressing hash table from the block to the tenant
+typedef struct {
+    void** blocks; // NULL for an empty slot
+    lua_tenant** owners;
+    size_t capacity; // 0 or a power of 2
+    size_t count;
+} tenant_owners;
+
 typedef struct {
     memory_limiter memory;
     runtime_limiter runtime;
+    lua_tenant* tenant; // who we're charging for what's running, if anyone
+    tenant_owners owners;
+    lua_State* main_thread;
+    lua_State* task_thread; // what resume_task is running, if anything
     PyObject* references;
 #if LUA_VERSION_NUM == 501
     jmp_buf* panic_return;
 #endif
 } lua_control_block;
 
+#define PATTERN_SINGLE 0
+#define PATTERN_OPEN 1
+#define PATTERN_POSITION 2
+#define PATTERN_CLOSE 3
+#define PATTERN_END 4
+#define PATTERN_BALANCE 5
+#define PATTERN_FRONTIER 6
+#define PATTERN_BACKREF 7
+
+#define PATTERN_CAP_UNFINISHED (-1)
+#define PATTERN_CAP_POSITION (-2)
+
+typedef struct {
+    unsigned char kind; // one of the PATTERN_ constants
+    unsigned char quantifier; // for PATTERN_SINGLE: 0, '*', '+', '-' or '?'
+    unsigned char a; // %b's opener, or the digit of a back reference
+    unsigned char b; // %b's closer
+    unsigned char set[32]; // the bytes that a single class or %f matches
+} pattern_item;
+
+typedef struct {
+    int anchored;
+    int nitems;
+    pattern_item items[1]; // really nitems of them
+} compiled_pattern;
+
+typedef struct {
+    lua_State* L;
+    compiled_pattern* pattern;
+    const char* src_init;
+    const char* src_end;
+    int level; // how many captures are open or finished
+    int matchdepth; // how much further we're allowed to recurse
+    size_t budget; // steps until we check the runtime limiter again
+    struct {
+        const char* init;
+        ptrdiff_t len;
+    } capture[LUA_MAXCAPTURES];
+} pattern_state;
+
+typedef struct {
+    int slot; // where the userdata holding data lives on the stack
+    char* data;
+    size_t len;
+    size_t cap;
+} json_buffer;
+
+typedef struct {
+    const char* start;
+    const char* p;
+    const char* end;
+    json_buffer scratch;
+} json_decoder;
+
 PyMODINIT_FUNC init_executor(void);
 
 int install_control_block(lua_State *L, size_t max_memory,
@@ -56,12 +238,17 @@ void wrapped_lua_close(lua_State*);
 void start_runtime_limiter(lua_State*, double max_runtime, int hz);
 void finish_runtime_limiter(lua_State*);
 static void time_limiting_hook(lua_State*, lua_Debug *_ar);
+static void check_runtime_quota(lua_State*, lua_control_block*);
 void* l_alloc_restricted (lua_control_block*,void*, size_t, size_t);
 size_t get_memory_used(lua_State *L);
 void enable_limit_memory(lua_State *L);
 void disable_limit_memory(lua_State *L);
 int call_python_function_from_lua(lua_State *L);
-void store_python_capsule(lua_State*,PyObject*,int,int,int);
+int store_python_capsule(lua_State*,PyObject*,int,int,int,int);
+static int store_capsule(lua_State*,PyObject*,int,int,int,int,int enforce);
+static size_t estimate_python_size(PyObject*);
+void set_charge_python(lua_State*, int);
+size_t get_python_memory_used(lua_State*);
 int free_python_capsule(lua_State *L);
 PyObject* decapsule(lua_capsule* capsule);
 int lazy_capsule_index(lua_State*);
@@ -70,6 +257,214 @@ static int check_capsule_cache(lua_State* L, lua_capsule*, int);
 static void set_capsule_cache(lua_State* L, lua_capsule*, int, int);
 static void create_capsule_cache(lua_State* L, lua_capsule*);
 static int translate_python_exception(lua_State*, PyGILState_STATE);
+static lua_State* python_stack(lua_State*, lua_control_block*, int needed);
+static PyObject* call_python_fast(lua_State*, PyObject* fn, int nargs,
+                                  PyObject* to_python_fallback,
+                                  PyObject* push_fallback,
+                                  PyObject* executor);
+static int push_python_flat(lua_State*, PyObject* val);
+static int add_python_reference(PyObject* references, PyObject* val);
+static void remove_python_reference(PyObject* references, PyObject* val);
+int store_typed_array(lua_State*, PyObject* owner, int kind);
+int free_typed_array(lua_State*);
+PyObject* typed_array_owner(lua_typed_array*);
+int typed_array_index(lua_State*);
+int typed_array_newindex(lua_State*);
+int typed_array_len(lua_State*);
+void install_typed_array(lua_State*, PyObject* references);
+Py_ssize_t lua_sequence_length(lua_State*, int idx);
+static int sequence_next(lua_State*, int idx, Py_ssize_t n, Py_ssize_t* position);
+static int check_sequence_count(Py_ssize_t n, Py_ssize_t count);
+static int sequence_integer(lua_State*, int kind, Py_ssize_t position, int64_t*);
+int lua_sequence_to_buffer(lua_State*, int idx, PyObject* out, int kind);
+static PyObject* lua_number_to_python(lua_State*, int idx);
+PyObject* lua_sequence_to_list(lua_State*, int idx);
+static void* test_userdata(lua_State*, int idx, const char* key);
+static PyObject* to_python_recursive(lua_State*, int idx,
+                                     PyObject* fallback, PyObject* executor,
+                                     int depth);
+PyObject* lua_to_python(lua_State*, int idx,
+                        PyObject* fallback, PyObject* executor);
+PyObject* pop_python_tuple(lua_State*, int n,
+                           PyObject* fallback, PyObject* executor);
+static int push_python_key(lua_State*, PyObject* key);
+static int schema_mismatch(PyObject* val, const char* expected);
+static int schema_push(lua_State*, int keys, PyObject* type, PyObject* val,
+                       PyObject* fallback, PyObject* executor, int depth);
+static int schema_push_record(lua_State*, int keys, PyObject* fields,
+                              PyObject* val, PyObject* fallback,
+                              PyObject* executor, int depth);
+PyObject* schema_to_lua(lua_State*, int keys_ref, PyObject* type,
+                        PyObject* val, PyObject* fallback,
+                        PyObject* executor);
+static PyObject* schema_python_mismatch(lua_State*, int idx,
+                                        const char* expected);
+static PyObject* schema_to_python_recursive(lua_State*, int idx, int keys,
+                                            PyObject* type,
+                                            PyObject* fallback,
+                                            PyObject* executor, int depth);
+PyObject* schema_to_python(lua_State*, int idx, int keys_ref,
+                           PyObject* type, PyObject* fallback,
+                           PyObject* executor);
+static PyObject* table_view_value(lua_State*, int idx,
+                                  PyObject* wrap, PyObject* executor);
+PyObject* table_view_get(lua_State*, int idx, PyObject* key,
+                         PyObject* wrap, PyObject* executor);
+PyObject* table_view_next(lua_State*, int idx,
+                          PyObject* wrap, PyObject* executor);
+Py_ssize_t table_view_length(lua_State*, int idx);
+void scope_store(lua_State*, int scope_ref, int index);
+void scope_push(lua_State*, int scope_ref, int index);
+lua_tenant* new_tenant(size_t memory_limit);
+void free_tenant(lua_tenant*);
+static void release_tenant(lua_tenant*);
+static size_t owner_hash(tenant_owners*, void* block);
+static size_t owner_slot(tenant_owners*, void* block);
+static int reserve_owner(tenant_owners*);
+static void set_owner(tenant_owners*, void* block, lua_tenant*);
+static lua_tenant* find_owner(tenant_owners*, void* block);
+static void remove_owner(tenant_owners*, void* block);
+static void free_owners(tenant_owners*);
+size_t get_tenant_refused(lua_tenant*);
+lua_tenant* enter_tenant(lua_State*, lua_tenant*);
+void exit_tenant(lua_State*, lua_tenant* previous);
+size_t get_tenant_memory_used(lua_tenant*);
+double get_tenant_runtime_used(lua_tenant*);
+int resume_task(lua_State*, lua_State* thread, int nargs, int slice,
+                int *nresults);
+int run_rules(lua_State*, int stop_at_first, double max_runtime, int hz);
+static void json_buffer_init(lua_State*, json_buffer*);
+static void json_buffer_reserve(lua_State*, json_buffer*, size_t extra);
+static void json_buffer_add(lua_State*, json_buffer*, const char*, size_t);
+static void json_buffer_addchar(lua_State*, json_buffer*, char);
+static int json_fail(lua_State*, json_decoder*, const char* what);
+static void json_skip_space(json_decoder*);
+static void json_expect_literal(lua_State*, json_decoder*, const char*);
+static unsigned long json_hex4(lua_State*, json_decoder*);
+static void json_add_utf8(lua_State*, json_buffer*, unsigned long cp);
+static void json_decode_string(lua_State*, json_decoder*);
+static void json_decode_number(lua_State*, json_decoder*);
+static void json_enter(lua_State*, json_decoder*, int depth);
+static void json_decode_object(lua_State*, json_decoder*, int depth);
+static void json_decode_array(lua_State*, json_decoder*, int depth);
+static void json_decode_value(lua_State*, json_decoder*, int depth);
+static void decode_json(lua_State*, const char* s, size_t len);
+static void json_encode_string(lua_State*, json_buffer*, int idx);
+static void json_encode_number(lua_State*, json_buffer*, int idx);
+static void json_encode_table(lua_State*, json_buffer*, int idx, int depth);
+static void json_encode_value(lua_State*, json_buffer*, int idx, int depth);
+static void encode_json(lua_State*, int idx);
+static int json_decode(lua_State*);
+static int json_decode_buffer(lua_State*);
+static int json_encode(lua_State*);
+void install_json(lua_State*);
+static int protected_json_call(lua_State*, int nargs);
+int load_json(lua_State*, const char* buf, size_t len);
+int dump_json(lua_State*);
+int open_library(lua_State*, const char* name);
+static int pattern_class_matches(int c, int cl);
+static int pattern_set_matches(int c, const char* p, const char* ec);
+static const char* pattern_class_end(lua_State*, const char* p,
+                                     const char* end);
+static void pattern_fill_set(unsigned char* set, const char* p,
+                             const char* ep);
+static int pattern_has_specials(const char* p, size_t len);
+static compiled_pattern* compile_pattern(lua_State*, const char* p,
+                                         size_t len, int anchors);
+static compiled_pattern* get_compiled_pattern(lua_State*, int idx,
+                                              int anchors);
+static void pattern_ticks(pattern_state*, size_t n);
+static const char* pattern_max_expand(pattern_state*, const char* s, int i);
+static const char* pattern_min_expand(pattern_state*, const char* s, int i);
+static const char* pattern_start_capture(pattern_state*, const char* s,
+                                         int i, ptrdiff_t what);
+static const char* pattern_end_capture(pattern_state*, const char* s, int i);
+static const char* pattern_match_balance(pattern_state*, const char* s,
+                                         const pattern_item*);
+static const char* pattern_match_capture(pattern_state*, const char* s,
+                                         int digit);
+static const char* pattern_match(pattern_state*, const char* s, int i);
+static void pattern_prepare(pattern_state*, lua_State*, compiled_pattern*,
+                            const char* s, size_t len);
+static void pattern_reset(pattern_state*);
+static void pattern_push_capture(pattern_state*, int i,
+                                 const char* s, const char* e);
+static int pattern_push_captures(pattern_state*, const char* s,
+                                 const char* e);
+static size_t pattern_start_position(lua_Integer pos, size_t len);
+static const char* pattern_memfind(const char* s, size_t ls,
+                                   const char* p, size_t lp);
+static int pattern_find_aux(lua_State*, int find);
+static int pattern_find(lua_State*);
+static int pattern_match_lua(lua_State*);
+static int pattern_gmatch_aux(lua_State*);
+static int pattern_gmatch(lua_State*);
+static void pattern_add_s(pattern_state*, luaL_Buffer*,
+                          const char* s, const char* e);
+static void pattern_add_value(pattern_state*, luaL_Buffer*,
+                              const char* s, const char* e, int tr);
+static int pattern_gsub(lua_State*);
+void install_pattern(lua_State*);
+static uint32_t lookup_u32(const unsigned char* p);
+static void lookup_entry(lookup_mapping* m, uint32_t i,
+                         const char** key, size_t* key_len,
+                         const char** value, size_t* value_len);
+static int lookup_compare(const char* a, size_t a_len,
+                          const char* b, size_t b_len);
+static uint32_t lookup_lower_bound(lookup_mapping* m,
+                                   const char* key, size_t len, int* exact);
+static lookup_mapping* lookup_map_file(const char* path);
+static lookup_mapping* lookup_acquire(lookup_table* t);
+static void lookup_release(lookup_table* t, lookup_mapping* m);
+lookup_table* lookup_table_open(const char* path);
+int lookup_table_swap(lookup_table* t, const char* path);
+void lookup_table_release(lookup_table* t);
+size_t lookup_table_count(lookup_table* t);
+PyObject* lookup_table_get(lookup_table* t, PyObject* key);
+void push_lookup_table(lua_State*, lookup_table* t);
+static lookup_mapping* lookup_check(lua_State*, int idx);
+static int lookup_push_entry(lua_State*, lookup_mapping* m, uint32_t i);
+static int lookup_get(lua_State*);
+static int lookup_contains(lua_State*);
+static int lookup_floor(lua_State*);
+static int lookup_range(lua_State*);
+static int lookup_range_next(lua_State*);
+static int lookup_len(lua_State*);
+static int free_lookup_table(lua_State*);
+static int free_lookup_cursor(lua_State*);
+void install_lookup_table(lua_State*);
+static lua_State* state_from_python(PyObject*);
+static int parse_state_args(PyObject* args, const char* name, int nints,
+                            lua_State** L, int* ints);
+static PyObject* api_result(PyObject*);
+static PyObject* api_none(void);
+static PyObject* py_lua_gettop(PyObject*, PyObject*);
+static PyObject* py_lua_settop(PyObject*, PyObject*);
+static PyObject* py_lua_pop(PyObject*, PyObject*);
+static PyObject* py_lua_type(PyObject*, PyObject*);
+static PyObject* py_lua_checkstack(PyObject*, PyObject*);
+static PyObject* py_lua_pushnil(PyObject*, PyObject*);
+static PyObject* py_lua_pushvalue(PyObject*, PyObject*);
+static PyObject* py_lua_rawget(PyObject*, PyObject*);
+static PyObject* py_lua_rawgeti(PyObject*, PyObject*);
+static PyObject* py_lua_rawset(PyObject*, PyObject*);
+static PyObject* py_luaL_ref(PyObject*, PyObject*);
+static PyObject* py_luaL_unref(PyObject*, PyObject*);
+static PyObject* py_enable_limit_memory(PyObject*, PyObject*);
+static PyObject* py_disable_limit_memory(PyObject*, PyObject*);
+static PyObject* py_limited_pcall(PyObject*, PyObject*);
+int executor_gc(lua_State*, int what, int data);
+int set_gc_mode(lua_State*, int mode);
+static int can_yield(lua_State*, int);
+static int finish_awaited_call(lua_State*, int);
+#if LUA_VERSION_NUM >= 503
+static int finish_awaited_call_k(lua_State*, int, lua_KContext);
+#elif LUA_VERSION_NUM == 502
+static int finish_awaited_call_k(lua_State*);
+#endif
+#if LUA_VERSION_NUM >= 502
+static void preempting_hook(lua_State*, lua_Debug*);
+#endif
 
 #if LUA_VERSION_NUM == 501
 static int memory_panicer (lua_State *L);
@@ -1,8 +1,18 @@
 from ctypes.util import find_library
 from functools import partial
 from functools import wraps
+import array
+import collections
 import contextlib
 import ctypes
+import os
+import re
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
 
 from lua_sandbox import _executor
 from lua_sandbox.utils import datafile, dataloc
@@ -30,6 +40,17 @@ else:
     raise ImportError("Unable to deal with lua configured with LUA_NUMBER=%s"
                     % _executor.EXECUTOR_LUA_NUMBER_TYPE_NAME)
 
+# 5.3 and up have an integer subtype of numbers
+if _executor.LUA_VERSION_NUM < 503:
+    lua_integer_type = None
+elif _executor.EXECUTOR_LUA_INTEGER_SIZE == 8:
+    lua_integer_type = ctypes.c_int64
+elif _executor.EXECUTOR_LUA_INTEGER_SIZE == 4:
+    lua_integer_type = ctypes.c_int32
+else:
+    raise ImportError("Unable to deal with lua configured with a %d byte "
+                      "LUA_INTEGER" % _executor.EXECUTOR_LUA_INTEGER_SIZE)
+
 # dylib exports
 luaL_loadbufferx = lua_lib.luaL_loadbufferx
 luaL_newmetatable = lua_lib.luaL_newmetatable
@@ -38,6 +59,8 @@ luaL_newstate = lua_lib.luaL_newstate
 luaL_newstate.restype = ctypes.c_void_p
 luaL_openlibs = lua_lib.luaL_openlibs
 luaL_openlibs.restype = None
+open_library = executor_lib.open_library
+open_library.restype = ctypes.c_int
 luaL_ref = lua_lib.luaL_ref
 luaL_ref.restype = ctypes.c_int
 luaL_unref = lua_lib.luaL_unref
@@ -46,8 +69,6 @@ lua_checkstack = lua_lib.lua_checkstack
 lua_checkstack.restype = ctypes.c_int
 lua_createtable = lua_lib.lua_createtable
 lua_createtable.restype = None
-lua_gc = lua_lib_nogil.lua_gc
-lua_gc.restype = ctypes.c_int
 lua_getallocf = lua_lib.lua_getallocf
 lua_getallocf.restype = ctypes.c_void_p
 lua_getfield = lua_lib.lua_getfield
@@ -58,6 +79,8 @@ lua_gettop = lua_lib.lua_gettop
 lua_gettop.restype = ctypes.c_int
 lua_newstate = lua_lib.lua_newstate
 lua_newstate.restype = ctypes.c_void_p
+lua_newthread = lua_lib.lua_newthread
+lua_newthread.restype = ctypes.c_void_p
 lua_next = lua_lib.lua_next
 lua_pushboolean = lua_lib.lua_pushboolean
 lua_pushboolean.restype = None
@@ -73,6 +96,8 @@ lua_pushnumber = lua_lib.lua_pushnumber
 lua_pushnumber.restype = None
 lua_pushstring = lua_lib.lua_pushstring
 lua_pushstring.restype = ctypes.c_void_p # this isn't true but we never use it
+lua_pushvalue = lua_lib.lua_pushvalue
+lua_pushvalue.restype = None
 lua_rawget = lua_lib.lua_rawget
 lua_rawget.restype = None
 lua_rawgeti = lua_lib.lua_rawgeti
@@ -98,11 +123,15 @@ lua_toboolean = lua_lib.lua_toboolean
 # it returns a void* and handle the string conversion ourselves
 lua_tolstring = lua_lib.lua_tolstring
 lua_tolstring.restype = ctypes.c_void_p
+lua_tothread = lua_lib.lua_tothread
+lua_tothread.restype = ctypes.c_void_p
 lua_touserdata = lua_lib.lua_touserdata
 lua_touserdata.restype = ctypes.c_void_p
 lua_type = lua_lib.lua_type
 lua_typename = lua_lib.lua_typename
 lua_typename.restype = ctypes.c_char_p
+lua_xmove = lua_lib.lua_xmove
+lua_xmove.restype = None
 
 
 EXECUTOR_LUA_CAPSULE_KEY = ctypes.c_char_p.in_dll(executor_lib,
@@ -117,6 +146,10 @@ finish_runtime_limiter = executor_lib.finish_runtime_limiter
 finish_runtime_limiter.restype = None
 get_memory_used = executor_lib.get_memory_used
 get_memory_used.restype = ctypes.c_size_t
+get_python_memory_used = executor_lib.get_python_memory_used
+get_python_memory_used.restype = ctypes.c_size_t
+set_charge_python = executor_lib.set_charge_python
+set_charge_python.restype = None
 enable_limit_memory = executor_lib.enable_limit_memory
 enable_limit_memory.restype = None
 disable_limit_memory = executor_lib.disable_limit_memory
@@ -124,7 +157,7 @@ disable_limit_memory.restype = None
 call_python_function_from_lua = executor_lib.call_python_function_from_lua
 call_python_function_from_lua.restype = ctypes.c_int
 store_python_capsule = executor_lib.store_python_capsule
-store_python_capsule.restype = None
+store_python_capsule.restype = ctypes.c_int
 free_python_capsule = executor_lib.free_python_capsule
 free_python_capsule.restype = ctypes.c_int
 decapsule = executor_lib.decapsule
@@ -133,6 +166,80 @@ lazy_capsule_index = executor_lib.lazy_capsule_index
 lazy_capsule_index.restype = ctypes.c_int
 lua_string_to_python_buffer = executor_lib.lua_string_to_python_buffer
 lua_string_to_python_buffer.restype = ctypes.py_object
+store_typed_array = executor_lib.store_typed_array
+store_typed_array.restype = ctypes.c_int
+typed_array_owner = executor_lib.typed_array_owner
+typed_array_owner.restype = ctypes.py_object
+install_typed_array = executor_lib.install_typed_array
+install_typed_array.restype = None
+install_json = executor_lib.install_json
+install_json.restype = None
+install_pattern = executor_lib.install_pattern
+install_pattern.restype = None
+install_lookup_table = executor_lib.install_lookup_table
+install_lookup_table.restype = None
+lookup_table_open = executor_lib.lookup_table_open
+lookup_table_open.restype = ctypes.c_void_p
+lookup_table_swap = executor_lib.lookup_table_swap
+lookup_table_swap.restype = ctypes.c_int
+lookup_table_release = executor_lib.lookup_table_release
+lookup_table_release.restype = None
+lookup_table_count = executor_lib.lookup_table_count
+lookup_table_count.restype = ctypes.c_size_t
+lookup_table_get = executor_lib.lookup_table_get
+lookup_table_get.restype = ctypes.py_object
+push_lookup_table = executor_lib.push_lookup_table
+push_lookup_table.restype = None
+lua_sequence_length = executor_lib.lua_sequence_length
+lua_sequence_length.restype = ctypes.c_ssize_t
+lua_sequence_to_buffer = executor_lib.lua_sequence_to_buffer
+lua_sequence_to_buffer.restype = ctypes.c_int
+lua_sequence_to_list = executor_lib.lua_sequence_to_list
+lua_sequence_to_list.restype = ctypes.py_object
+lua_to_python = executor_lib.lua_to_python
+lua_to_python.restype = ctypes.py_object
+pop_python_tuple = executor_lib.pop_python_tuple
+pop_python_tuple.restype = ctypes.py_object
+table_view_get = executor_lib.table_view_get
+table_view_get.restype = ctypes.py_object
+table_view_next = executor_lib.table_view_next
+table_view_next.restype = ctypes.py_object
+table_view_length = executor_lib.table_view_length
+table_view_length.restype = ctypes.c_ssize_t
+schema_to_lua = executor_lib.schema_to_lua
+schema_to_lua.restype = ctypes.py_object
+schema_to_python = executor_lib.schema_to_python
+schema_to_python.restype = ctypes.py_object
+scope_store = executor_lib.scope_store
+scope_store.restype = None
+scope_push = executor_lib.scope_push
+scope_push.restype = None
+new_tenant = executor_lib.new_tenant
+new_tenant.restype = ctypes.c_void_p
+free_tenant = executor_lib.free_tenant
+free_tenant.restype = None
+enter_tenant = executor_lib.enter_tenant
+enter_tenant.restype = ctypes.c_void_p
+exit_tenant = executor_lib.exit_tenant
+exit_tenant.restype = None
+get_tenant_memory_used = executor_lib.get_tenant_memory_used
+get_tenant_memory_used.restype = ctypes.c_size_t
+get_tenant_refused = executor_lib.get_tenant_refused
+get_tenant_refused.restype = ctypes.c_size_t
+get_tenant_runtime_used = executor_lib.get_tenant_runtime_used
+get_tenant_runtime_used.restype = ctypes.c_double
+resume_task = executor_lib_nogil.resume_task
+resume_task.restype = ctypes.c_int
+lua_gc = executor_lib_nogil.executor_gc
+lua_gc.restype = ctypes.c_int
+set_gc_mode = executor_lib_nogil.set_gc_mode
+set_gc_mode.restype = ctypes.c_int
+run_rules = executor_lib_nogil.run_rules
+run_rules.restype = ctypes.c_int
+load_json = executor_lib_nogil.load_json
+load_json.restype = ctypes.c_int
+dump_json = executor_lib_nogil.dump_json
+dump_json.restype = ctypes.c_int
 
 # function types
 lua_CFunction = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p)
@@ -169,7 +276,7 @@ if _executor.LUA_VERSION_NUM == 501:
 
     luaJIT_setmode = lua_lib.luaJIT_setmode
 
-elif _executor.LUA_VERSION_NUM in (502, 503):
+elif _executor.LUA_VERSION_NUM in (502, 503, 504):
     lua_pcallk = lua_lib_nogil.lua_pcallk
     lua_tonumberx = lua_lib.lua_tonumberx
     lua_tonumberx.restype = lua_number_type
@@ -180,10 +287,50 @@ elif _executor.LUA_VERSION_NUM in (502, 503):
 
     luaJIT_setmode = None
 
+    if _executor.LUA_VERSION_NUM >= 503:
+        lua_isinteger = lua_lib.lua_isinteger
+        lua_isinteger.restype = ctypes.c_int
+        lua_pushinteger = lua_lib.lua_pushinteger
+        lua_pushinteger.restype = None
+        lua_tointegerx = lua_lib.lua_tointegerx
+        lua_tointegerx.restype = lua_integer_type
+
+    # only 5.4.0 through 5.4.2 have a configurable C stack limit, and later
+    # versions keep a stub that does nothing
+    lua_setcstacklimit = getattr(lua_lib, 'lua_setcstacklimit', None)
+    if lua_setcstacklimit is not None:
+        lua_setcstacklimit.restype = ctypes.c_int
+
 else:
     raise ImportError("I don't know LUA_VERSION_NUM %r", _executor.LUA_VERSION_NUM)
 
 
+def limited_pcall(L, nargs, nresults):
+    # allocation limiting must only be turned on while we're operating inside
+    # of a pcall, or Lua's crazy longjmp thing will kick in
+    enable_limit_memory(L)
+    ret = lua_pcallk(L, nargs, nresults, 0, 0, None)
+    disable_limit_memory(L)
+    return ret
+
+
+# _executor also exports the hottest of these as real Python functions, which
+# skips ctypes' argument conversion on every call. The ctypes versions stay as
+# the fallback, and can be forced with LUA_SANDBOX_CTYPES_ONLY=1 to compare
+FAST_BINDINGS = (
+    'disable_limit_memory', 'enable_limit_memory', 'limited_pcall',
+    'luaL_ref', 'luaL_unref', 'lua_checkstack', 'lua_gettop', 'lua_pop',
+    'lua_pushnil', 'lua_pushvalue', 'lua_rawget', 'lua_rawgeti',
+    'lua_rawset', 'lua_settop', 'lua_type',
+)
+
+if not os.environ.get('LUA_SANDBOX_CTYPES_ONLY'):
+    for _name in FAST_BINDINGS:
+        if hasattr(_executor, _name):
+            globals()[_name] = getattr(_executor, _name)
+    del _name
+
+
 def abs_index(L, i, LUA_REGISTRYINDEX=_executor.LUA_REGISTRYINDEX):
     "convert a potentially relative stack index to an absolute one"
     if i > 0 or i <= LUA_REGISTRYINDEX:
@@ -237,14 +384,30 @@ MAX_MEMORY_DEFAULT = 2*1024*1024
 MAX_RUNTIME_DEFAULT = 2.0 # (in seconds)
 MAX_RUNTIME_HZ_DEFAULT = 500*1000 # how often to check (in "lua instructions")
 
+# how long a Task runs before letting the next one have a turn (in "lua
+# instructions")
+SCHEDULER_SLICE_DEFAULT = 10*1000
+# how long to sleep when every task is waiting on a future that we can't get
+# notified about
+SCHEDULER_POLL_INTERVAL = 0.01
+
 class Lua(object):
-    __slots__ = ['L', 'max_memory', 'cleanup_cache', 'name', 'references']
+    __slots__ = ['L', 'max_memory', 'cleanup_cache', 'name', 'references',
+                 'scopes', 'gc_counters', 'conversion_cache']
 
-    def __init__(self, max_memory=MAX_MEMORY_DEFAULT, name=None):
+    def __init__(self, max_memory=MAX_MEMORY_DEFAULT, name=None,
+                 conversion_cache_memory=None,
+                 charge_python_references=False,
+                 libraries=None):
         self.name = name or "%s[%s]" % (self.__class__.__name__, id(self))
 
         self.max_memory = max_memory = max_memory or 0
 
+        # for Cached values. By default it may use a quarter of our memory
+        if conversion_cache_memory is None:
+            conversion_cache_memory = max_memory // 4
+        self.conversion_cache = ConversionCache(conversion_cache_memory)
+
         # If every time we hold a reference in Lua land to an object in Python
         # land we do the obvious incref/decref pair we end up with reference
         # cycles which prevent those objects from ever getting cleaned up
@@ -259,6 +422,19 @@ class Lua(object):
         # https://github.com/scoder/lupa/commit/c634e44d77a17adcf99a562284da76a5a40065a4
         self.references = {}
 
+        # the stack of active scope()s. LuaValues are created in the innermost
+        # one
+        self.scopes = []
+
+        # see gc_stats
+        self.gc_counters = {'cycles': 0, 'steps': 0, 'time_spent': 0.0}
+
+        # hold on to this for __del__, which needs it as soon as there's an L
+        # to close even if the rest of this raises
+        self.cleanup_cache = dict(
+            wrapped_lua_close = wrapped_lua_close,
+        )
+
         self.L = luaL_newstate()
         self.L = ctypes.c_void_p(self.L)  # save us casts later
 
@@ -266,17 +442,43 @@ class Lua(object):
                                      ctypes.py_object(self.references)):
             raise LuaOutOfMemoryException("couldn't allocate control block")
 
-        luaL_openlibs(self.L)
-        self.install_python_capsule()
+        if charge_python_references:
+            # Python objects that Lua is keeping alive through capsules count
+            # against max_memory too, so scripts can't grow the host process
+            # without limit by hoarding them
+            set_charge_python(self.L, 1)
 
-        # hold on to this for __del__
-        self.cleanup_cache = dict(
-            wrapped_lua_close = wrapped_lua_close,
-        )
+        if libraries is None:
+            luaL_openlibs(self.L)
+        else:
+            self.open_libraries(libraries)
+
+        self.install_python_capsule()
+        self.install_typed_array()
+        self.install_json()
+        self.install_pattern()
+        self.install_lookup_table()
 
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__, self.name)
 
+    @contextlib.contextmanager
+    def scope(self):
+        """
+        Track every LuaValue created inside of this block together and release
+        them all at once when it exits, instead of one at a time as they are
+        garbage collected. Using one of them after that raises LuaException
+        """
+        scope = LuaScope(self)
+        self.scopes.append(scope)
+
+        try:
+            yield scope
+        finally:
+            popped = self.scopes.pop()
+            assert popped is scope, "scopes exited out of order"
+            scope.release()
+
     @contextlib.contextmanager
     def limit_runtime(self,
                       max_runtime=MAX_RUNTIME_DEFAULT,
@@ -313,10 +515,13 @@ class Lua(object):
         lua_pushcclosure(self.L, free_python_capsule, 1)
         lua_setfield(self.L, -2, '__gc')
 
-        # and call them
+        # and call them. Arguments and results are converted in C where it
+        # can, and in Python where it can't
         lua_pushlightuserdata(self.L, ctypes.py_object(_callable_wrapper))
         lua_pushlightuserdata(self.L, ctypes.py_object(self))
-        lua_pushcclosure(self.L, call_python_function_from_lua, 2)
+        lua_pushlightuserdata(self.L, ctypes.py_object(_to_python_fallback))
+        lua_pushlightuserdata(self.L, ctypes.py_object(_push_callback_result))
+        lua_pushcclosure(self.L, call_python_function_from_lua, 4)
         lua_setfield(self.L, -2, '__call')
 
         # and index them
@@ -331,9 +536,136 @@ class Lua(object):
 
         lua_pop(self.L, 1)  # get the metatable off the stack
 
+    @check_stack(3, 0)
+    def open_libraries(self, libraries):
+        """
+        Open just these standard libraries by name ('_G' is the base library)
+        instead of all of them
+        """
+        for library in libraries:
+            if not open_library(self.L, library):
+                raise ValueError("no such library %r" % (library,))
+
+    @check_stack(3, 0)
+    def install_typed_array(self):
+        # the metatable for typed arrays and the global `array` library. All of
+        # their methods are in C, so there's nothing to do from here
+        install_typed_array(self.L, ctypes.py_object(self.references))
+
+    @check_stack(3, 0)
+    def install_json(self):
+        # the global `json` library, also in C
+        install_json(self.L)
+
+    @check_stack(3, 0)
+    def install_pattern(self):
+        # the global `pattern` library: string.find and friends, but their
+        # matching is checked against the runtime limiter
+        install_pattern(self.L)
+
+    @check_stack(2, 0)
+    def install_lookup_table(self):
+        # the metatables for LookupTables. Their methods are all in C
+        install_lookup_table(self.L)
+
     def gc(self):
         "Force a garbage collection"
+        started = time.time()
         lua_gc(self.L, _executor.LUA_GCCOLLECT, 0)
+        self.gc_counters['time_spent'] += time.time() - started
+        self.gc_counters['cycles'] += 1
+
+    def gc_step(self, kb=0, max_steps=1, max_time=None):
+        """
+        Do a bounded amount of incremental collection, so that the collector's
+        work can be done between calls instead of during them. Each step does
+        the work of `kb` kilobytes of allocation (0 means one basic step). We
+        stop after `max_steps` steps (None for no limit), after `max_time`
+        seconds, or when a cycle finishes. Returns whether a cycle finished
+        """
+        if max_steps is None and max_time is None:
+            raise ValueError("gc_step needs max_steps or max_time")
+
+        started = time.time()
+        steps = 0
+        finished = False
+
+        try:
+            while max_steps is None or steps < max_steps:
+                steps += 1
+                if lua_gc(self.L, _executor.LUA_GCSTEP, kb):
+                    finished = True
+                    break
+                if max_time is not None and time.time()-started >= max_time:
+                    break
+        finally:
+            self.gc_counters['time_spent'] += time.time() - started
+            self.gc_counters['steps'] += steps
+            if finished:
+                self.gc_counters['cycles'] += 1
+
+        return finished
+
+    def set_gc_params(self, pause=None, stepmul=None):
+        """
+        Tune the incremental collector. `pause` is how big (as a percentage)
+        the heap must grow after a cycle before the next one starts and
+        `stepmul` is how much collection each allocation pays for, so a high
+        pause and a low stepmul keep the collector out of the way of calls
+        and leave more of the work for gc_step. None leaves either as it is.
+        Returns the previous (pause, stepmul)
+        """
+        previous = []
+
+        for what, value in ((_executor.LUA_GCSETPAUSE, pause),
+                            (_executor.LUA_GCSETSTEPMUL, stepmul)):
+            # the only way to read these is to set them
+            old = lua_gc(self.L, what, 0 if value is None else value)
+            if value is None:
+                lua_gc(self.L, what, old)
+            previous.append(old)
+
+        return tuple(previous)
+
+    def set_gc_mode(self, mode):
+        """
+        Switch the collector between 'incremental' and (on Lua 5.4)
+        'generational' mode, which is much cheaper for scripts that make lots
+        of short-lived garbage. Returns the previous mode
+        """
+        if _executor.LUA_VERSION_NUM < 504:
+            if mode != 'incremental':
+                raise LuaException("%s gc mode needs lua 5.4" % (mode,))
+            return 'incremental'
+
+        modes = {'incremental': _executor.LUA_GCINC,
+                 'generational': _executor.LUA_GCGEN}
+        if mode not in modes:
+            raise ValueError("unknown gc mode %r" % (mode,))
+
+        previous = set_gc_mode(self.L, modes[mode])
+        return 'generational' if previous == _executor.LUA_GCGEN else 'incremental'
+
+    def set_cstack_limit(self, limit):
+        """
+        Set how deeply C calls (including calls into Python and back) may
+        nest. Only Lua 5.4.0 through 5.4.2 let you change this. Returns the
+        old limit, or 0 on versions that don't have one
+        """
+        if _executor.LUA_VERSION_NUM < 504 or lua_setcstacklimit is None:
+            return 0
+        return lua_setcstacklimit(self.L, ctypes.c_uint(limit))
+
+    def gc_stats(self):
+        """
+        The collector's state: kb_in_use from Lua and the cycles, steps and
+        time_spent (in seconds) of the collections that we asked for. Cycles
+        that Lua runs on its own during calls aren't counted
+        """
+        stats = dict(self.gc_counters)
+        stats['kb_in_use'] = (lua_gc(self.L, _executor.LUA_GCCOUNT, 0)
+                              + lua_gc(self.L, _executor.LUA_GCCOUNTB, 0)/1024.0)
+        return stats
 
     @check_stack(2, 0)
     def registry(self, key):
@@ -372,6 +704,14 @@ class Lua(object):
     def memory_used(self):
         return get_memory_used(self.L)
 
+    @property
+    def python_memory_used(self):
+        """
+        what we've estimated the Python objects held by capsules to be using,
+        if charge_python_references is on
+        """
+        return get_python_memory_used(self.L)
+
     @check_stack(1, 0)
     def load(self, code, desc=None, mode="t"):
         assert isinstance(code, str)
@@ -392,6 +732,48 @@ class Lua(object):
         else:
             raise LuaStateException(self)
 
+    @check_stack(3, 0)
+    def load_json(self, buf):
+        """
+        Parse JSON straight into a Lua value, without building the Python
+        objects first. null becomes nil, the same as None does
+        """
+        if isinstance(buf, unicode):
+            buf = buf.encode('utf-8')
+        elif not isinstance(buf, str):
+            buf = str(buf)
+
+        pcall_ret = load_json(self.L, buf, ctypes.c_size_t(len(buf)))
+        if pcall_ret != _executor.LUA_OK:
+            raise _pcall_exception(self, pcall_ret)
+
+        return LuaValue(self)
+
+    @check_stack(3, 0)
+    def dump_json(self, value):
+        """
+        Serialize a LuaValue (or anything that from_python takes) as JSON
+        bytes. Tables that are sequences become arrays and everything else
+        becomes an object
+        """
+        value = LuaValue.from_python(self, value)
+        value._bring_to_top(False)
+
+        # replaces the value with its JSON
+        pcall_ret = dump_json(self.L)
+        if pcall_ret != _executor.LUA_OK:
+            raise _pcall_exception(self, pcall_ret)
+
+        ret = lua_to_python(self.L, -1,
+                            ctypes.py_object(_to_python_fallback),
+                            ctypes.py_object(self))
+        lua_pop(self.L, 1)
+        return ret
+
+    def compile_schema(self, schema):
+        "A SchemaConverter for converting records of this Schema"
+        return SchemaConverter(self, schema)
+
     @check_stack(1, 0)
     def create_table(self):
         lua_createtable(self.L, 0, 0)
@@ -407,12 +789,21 @@ class Lua(object):
 
 
 class LuaValue(object):
-    __slots__ = ['executor', 'L', 'key', 'cleanup_cache']
+    __slots__ = ['executor', 'L', 'key', 'scope']
+
+    # this is a little weird, but we need to hold on to these so that our
+    # __del__ has access to them even after the module globals have been torn
+    # down. They live on the class so each handle doesn't need its own copy
+    _cleanup_cache = dict(
+        luaL_unref=luaL_unref,
+        LUA_REGISTRYINDEX=_executor.LUA_REGISTRYINDEX,
+    )
 
     def __init__(self, executor):
         """
         Build a LuaValue off of whatever's on the top of the stack, then pop it
-        off. We store it in Lua's global
+        off. We store it in Lua's registry, or in the current scope if there is
+        one
         """
 
         assert isinstance(executor, Lua), "expected Lua, got %r" % (executor,)
@@ -427,22 +818,24 @@ class LuaValue(object):
     def _create(self):
         # right now the top of the stack contains the item that we're storing
 
-        # pops it off and stores the integer reference in the registry
-        self.key = luaL_ref(self.L, _executor.LUA_REGISTRYINDEX)
+        scopes = self.executor.scopes
 
-        # now we've consumed it from the stack
+        if scopes:
+            self.scope = scope = scopes[-1]
+            self.key = scope._store()
+        else:
+            self.scope = None
+            # pops it off and stores the integer reference in the registry
+            self.key = luaL_ref(self.L, _executor.LUA_REGISTRYINDEX)
 
-        # this is a little weird, but we need to hold on to these so that our
-        # __del__ has access to them
-        self.cleanup_cache = dict(
-            luaL_unref=luaL_unref,
-            LUA_REGISTRYINDEX=_executor.LUA_REGISTRYINDEX,
-        )
+        # now we've consumed it from the stack
 
     def __del__(self):
-        self.cleanup_cache['luaL_unref'](self.L,
-            self.cleanup_cache['LUA_REGISTRYINDEX'],
-            self.key)
+        if self.scope is None:
+            self._cleanup_cache['luaL_unref'](self.L,
+                self._cleanup_cache['LUA_REGISTRYINDEX'],
+                self.key)
+        # otherwise our scope releases us
 
     @check_stack()
     def type(self):
@@ -456,11 +849,14 @@ class LuaValue(object):
     @contextlib.contextmanager
     def _bring_to_top(self, cleanup_after=True):
         "Get the value to the top of the stack"
-        if not lua_checkstack(self.L, 1):
+        if not lua_checkstack(self.L, 2):
             raise LuaOutOfMemoryException("_bring_to_top.checkstack")
 
         # get the value to the top of the stack
-        lua_rawgeti(self.L, _executor.LUA_REGISTRYINDEX, self.key)
+        if self.scope is None:
+            lua_rawgeti(self.L, _executor.LUA_REGISTRYINDEX, self.key)
+        else:
+            self.scope._push(self.key)
 
         if cleanup_after:
             return self.__bring_to_top()
@@ -481,6 +877,8 @@ class LuaValue(object):
             return bool(lua_toboolean(self.L, idx, None))
 
         elif kind == _executor.LUA_TNUMBER:
+            if lua_integer_type is not None and lua_isinteger(self.L, idx):
+                return int(lua_tointegerx(self.L, idx, None))
             return lua_tonumberx(self.L, idx, None)
 
         elif kind == _executor.LUA_TSTRING:
@@ -525,6 +923,11 @@ class LuaValue(object):
             ptr_py = decapsule(ptr_v)
             return ptr_py
 
+        elif kind == _executor.LUA_TUSERDATA and self._is_typed_array(idx):
+            # hand back the very same object that we were given
+            ptr_v = ctypes.c_void_p(lua_touserdata(self.L, idx))
+            return typed_array_owner(ptr_v)
+
         else:
             raise LuaException("can't coerce %s" % self.type_name())
 
@@ -532,14 +935,24 @@ class LuaValue(object):
         with self._bring_to_top():
             return self._is_capsule(-1)
 
-    @check_stack(2, 0)
     def _is_capsule(self, idx):
+        return self._has_metatable_marker(idx, "capsule")
+
+    def is_typed_array(self):
+        with self._bring_to_top():
+            return self._is_typed_array(-1)
+
+    def _is_typed_array(self, idx):
+        return self._has_metatable_marker(idx, "typedarray")
+
+    @check_stack(2, 0)
+    def _has_metatable_marker(self, idx, marker):
         idx = abs_index(self.L, idx)
 
         if not lua_getmetatable(self.L, idx):
             return False
 
-        lua_pushstring(self.L, "capsule")
+        lua_pushstring(self.L, marker)
         lua_rawget(self.L, -2)
         ret = not lua_isnil(self.L, -1)
 
@@ -554,8 +967,89 @@ class LuaValue(object):
             ret = self._to_python(-1)
         return ret
 
+    def view(self):
+        """
+        A read-only LuaTableView of this table that converts fields as they're
+        asked for, rather than all at once like to_python
+        """
+        if self.type() != _executor.LUA_TTABLE:
+            raise TypeError("can only view tables, not %r"
+                            % (self.type_name(),))
+        return LuaTableView(self)
+
+    @check_stack(3, 0)
+    def to_list(self):
+        """
+        Convert a Lua sequence of numbers (a table with only the keys 1..n) to
+        a list in one pass, raising ValueError if it isn't one. Like to_python,
+        Lua integers come back as ints and everything else as floats
+        """
+        with self._bring_to_top():
+            return lua_sequence_to_list(self.L, -1)
+
+    @check_stack(3, 0)
+    def to_array(self, typecode='d'):
+        """
+        Like to_list, but fill a new array.array of the given typecode which
+        must be one that a TypedArray can hold (see ARRAY_TYPECODES)
+        """
+        if typecode not in ARRAY_TYPECODES:
+            raise ValueError("can't fill an array of typecode %r, only %s"
+                             % (typecode, ', '.join(map(repr,
+                                                        ARRAY_TYPECODES))))
+
+        with self._bring_to_top():
+            n = lua_sequence_length(self.L, -1)
+            ret = array.array(typecode, [0]) * n
+            kind = TYPED_ARRAY_KINDS[_typed_array_kind(ret)]
+            lua_sequence_to_buffer(self.L, -1, ctypes.py_object(ret), kind)
+        return ret
+
     @check_stack(1)
     def __call__(self, *args):
+        nresults = self._pcall(args)
+
+        rets = []
+
+        for _ in xrange(nresults):
+            rets.append(LuaValue(self.executor))
+
+        rets.reverse()
+
+        return rets
+
+    @check_stack(1)
+    def call_py(self, *args):
+        """
+        Like calling us, but convert the return values straight into a tuple of
+        Python values in C (like to_python) instead of creating LuaValues
+        """
+        nresults = self._pcall(args)
+        return pop_python_tuple(self.L, nresults,
+                                ctypes.py_object(_to_python_fallback),
+                                ctypes.py_object(self.executor))
+
+    def call_many_py(self, arg_lists):
+        """
+        call_py once for each sequence of arguments in arg_lists, returning a
+        list of the result tuples
+        """
+        fallback = ctypes.py_object(_to_python_fallback)
+        executor = ctypes.py_object(self.executor)
+        rets = []
+
+        for args in arg_lists:
+            nresults = self._pcall(args)
+            rets.append(pop_python_tuple(self.L, nresults, fallback, executor))
+
+        return rets
+
+    def _pcall(self, args):
+        """
+        Call us with the given args, leaving the results on the stack and
+        returning how many there are
+        """
+
         # NOTE!!! lua does a longjmp back to the lua_pcallk call site if
         # anything goes wrong. Because of that, Python's exception handling
         # (including finally clauses!) will *not* be triggered. This can cause
@@ -566,6 +1060,7 @@ class LuaValue(object):
         self._bring_to_top(False)  # lua_pcallk consumes
 
         if not lua_checkstack(self.L, 2+len(args)):
+            lua_pop(self.L, 1)
             raise LuaOutOfMemoryException("__call__.checkstack")
 
         before_top = lua_gettop(self.L)
@@ -580,42 +1075,15 @@ class LuaValue(object):
         for la in lua_args:
             la._bring_to_top(False)
 
-        # allocation limiting must only be turned on while we're operating
-        # inside of a pcall, or Lua's crazy longjmp thing will kick in
-        enable_limit_memory(self.L)
-
-        # lua_pcallk will pop the function all of the arguments that we added,
-        # whether or not it fails
-        pcall_ret = lua_pcallk(self.L,
-                               len(lua_args), _executor.LUA_MULTRET,
-                               0, 0, None)
-
-        disable_limit_memory(self.L)
+        # this will pop the function all of the arguments that we added,
+        # whether or not it fails. Memory limiting is only on for the duration
+        pcall_ret = limited_pcall(self.L, len(lua_args), _executor.LUA_MULTRET)
 
         if pcall_ret == _executor.LUA_OK:
             after_top = lua_gettop(self.L)
+            return 1+after_top-before_top
 
-            rets = []
-
-            for _ in xrange(1+after_top-before_top):
-                rets.append(LuaValue(self.executor))
-
-            rets.reverse()
-
-            return rets
-
-        elif pcall_ret == _executor.LUA_ERRRUN:
-            raise LuaStateException(self.executor)
-
-        elif pcall_ret == _executor.LUA_ERRMEM:
-            raise LuaOutOfMemoryException("%.2fmb > %.2fmb (%dc)"
-                                          % (self.executor.memory_used/1024.0/1024.0,
-                                             self.executor.max_memory/1024.0/1024.0,
-                                             len(self.executor.references)))
-
-        else:
-            raise LuaException("Unknown return value from lua_pcallk: %r"
-                               % (pcall_ret,))
+        raise _pcall_exception(self.executor, pcall_ret)
 
     @check_stack(2, 0)
     def __getitem__(self, key):
@@ -703,6 +1171,13 @@ class LuaValue(object):
             lua_pushboolean(self.L, 1 if val else 0)
             return LuaValue(executor)
 
+        elif (isinstance(val, (int, long))
+              and lua_integer_type is not None
+              and lua_integer_type(val).value == val):
+            # it fits in a Lua integer
+            lua_pushinteger(self.L, lua_integer_type(val))
+            return LuaValue(executor)
+
         elif isinstance(val, (int, long, float)):
             lua_pushnumber(self.L, lua_number_type(val))
             return LuaValue(executor)
@@ -780,10 +1255,27 @@ class LuaValue(object):
             # now the table should be at the top
             return LuaValue(executor)
 
+        elif isinstance(val, Cached):
+            return executor.conversion_cache.get(executor, val)
+
+        elif isinstance(val, LookupTable):
+            # shared rather than copied, and it doesn't count against our
+            # memory
+            push_lookup_table(self.L, val.ptr)
+            return LuaValue(executor)
+
+        elif isinstance(val, TypedArray):
+            # leaves the userdata on the stack, or raises and leaves the stack
+            # alone
+            store_typed_array(self.L,
+                              ctypes.py_object(val.inner),
+                              TYPED_ARRAY_KINDS[val.kind])
+            return LuaValue(executor)
+
         elif callable(val) or isinstance(val, Capsule):
             lval = val.inner if isinstance(val, Capsule) else val
 
-            should_cache = recursive = raw_lua_args = 0
+            should_cache = recursive = raw_lua_args = returns_future = 0
 
             if isinstance(val, Capsule):
                 if val.cache:
@@ -792,14 +1284,18 @@ class LuaValue(object):
                     recursive = 1
                 if val.raw_lua_args:
                     raw_lua_args = 1
+                if val.returns_future:
+                    returns_future = 1
 
             # fiddling with pointers is easier in C (leaves the userdata on
             # the stack)
-            store_python_capsule(self.L,
-                                 ctypes.py_object(lval),
-                                 should_cache,
-                                 recursive,
-                                 raw_lua_args)
+            if not store_python_capsule(self.L,
+                                        ctypes.py_object(lval),
+                                        should_cache,
+                                        recursive,
+                                        raw_lua_args,
+                                        returns_future):
+                raise _out_of_memory(self)
 
             # consume the userdata (now with the metatable set)
             return LuaValue(executor)
@@ -829,13 +1325,47 @@ class LuaValue(object):
         # value is no longer on the stack
 
 
-def _callable_wrapper(executor, val, raw_lua_args=False):
-    # we get called with a new stack so anything on it belongs to us
-    nargs = lua_gettop(executor.L)
-
+def _pcall_exception(executor, pcall_ret):
+    """
+    The exception for a protected call that failed with pcall_ret, whose error
+    is on the top of the stack
+    """
+    if pcall_ret == _executor.LUA_ERRRUN:
+        error = LuaStateException(executor)
+        if isinstance(getattr(error, '__cause__', None),
+                      LuaOutOfMemoryException):
+            # a Python function that they called ran out of budget creating a
+            # capsule, which is just as fatal as Lua running out
+            return error.__cause__
+        return error
+
+    elif pcall_ret == _executor.LUA_ERRMEM:
+        return _out_of_memory(executor)
+
+    return LuaException("Unknown return value from lua_pcallk: %r"
+                        % (pcall_ret,))
+
+
+def _out_of_memory(executor):
+    # the Python objects that Lua's holding count against max_memory too, so
+    # without them the numbers can look like there was plenty left
+    return LuaOutOfMemoryException(
+        "%.2fmb + %.2fmb in Python > %.2fmb (%dc)"
+        % (executor.memory_used/1024.0/1024.0,
+           executor.python_memory_used/1024.0/1024.0,
+           executor.max_memory/1024.0/1024.0,
+           len(executor.references)))
+
+
+def _callable_wrapper(executor, val, raw_lua_args, nargs,
+                      returns_future, awaiting):
+    # the slow path for calling Python functions from Lua, for capsules with
+    # raw_lua_args or returns_future. Everything else has its arguments and
+    # results converted in C by call_python_function_from_lua.
+    # the top nargs values on the stack are our arguments
     args = []
 
-    for _ in xrange(1, nargs):
+    for _ in xrange(nargs):
         if raw_lua_args:
             args.append(LuaValue(executor))
         else:
@@ -845,6 +1375,16 @@ def _callable_wrapper(executor, val, raw_lua_args=False):
 
     ret = val(*args)
 
+    if returns_future:
+        if awaiting:
+            # call_python_function_from_lua yields this to our Task, which
+            # resumes the script with the result once it's ready
+            ret = Capsule(_AwaitedFuture(ret))
+        else:
+            # not running under a Scheduler (or not somewhere we can yield
+            # from) so there's nothing to do but block on it
+            ret = ret.result()
+
     as_lua = LuaValue.from_python(executor, ret)
 
     # leave this on top of the stack for
@@ -852,6 +1392,100 @@ def _callable_wrapper(executor, val, raw_lua_args=False):
     as_lua._bring_to_top(False)
 
 
+def _push_callback_result(executor, ret):
+    # called from call_python_function_from_lua with whatever a Python
+    # function returned that's too complicated to convert in C. It's left on
+    # top of the stack like _callable_wrapper leaves it
+    LuaValue.from_python(executor, ret)._bring_to_top(False)
+
+
+class LuaTableView(collections.Mapping):
+    """
+    A lazy, read-only Mapping over a Lua table. Fields are looked up and
+    converted in C one at a time, so reading two fields out of a large result
+    table only pays for those two. Subtables come back as LuaTableViews of
+    their own and functions as LuaValues, like to_python would give you
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.executor = value.executor
+        self.L = value.L
+
+    @check_stack(3, 0)
+    def __getitem__(self, key):
+        with self.value._bring_to_top():
+            return table_view_get(self.L, -1, ctypes.py_object(key),
+                                  ctypes.py_object(_view_fallback),
+                                  ctypes.py_object(self.executor))
+
+    @check_stack(3, 0)
+    def __len__(self):
+        with self.value._bring_to_top():
+            n = table_view_length(self.L, -1)
+        if n < 0:
+            raise LuaOutOfMemoryException("LuaTableView.__len__")
+        return n
+
+    def __iter__(self):
+        # lua_next wants the previous key, which we hold on to as a LuaValue
+        # between steps since it may not survive a round trip through Python
+        previous = None
+
+        while True:
+            found = self._next(previous)
+            if not found:
+                return
+            previous, key = found
+            yield key
+
+    @check_stack(3, 0)
+    def _next(self, previous):
+        with self.value._bring_to_top():
+            if previous is None:
+                lua_pushnil(self.L)
+            else:
+                previous._bring_to_top(False)
+
+            # consumes the previous key, leaving the next one if there is one
+            ret = table_view_next(self.L, -2,
+                                  ctypes.py_object(_view_fallback),
+                                  ctypes.py_object(self.executor))
+            if not ret:
+                return None
+            return LuaValue(self.executor), ret[0]
+
+    def to_python(self):
+        return self.value.to_python()
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.value)
+
+
+def _view_fallback(executor):
+    # like _to_python_fallback, but subtables become LuaTableViews
+    value = LuaValue(executor)
+    kind = value.type()
+
+    if kind == _executor.LUA_TTABLE:
+        return LuaTableView(value)
+    elif kind == _executor.LUA_TFUNCTION:
+        return value
+
+    raise LuaException("can't coerce %s" % value.type_name())
+
+
+def _to_python_fallback(executor):
+    # called from the C version of to_python with a value it doesn't know how
+    # to convert on the top of the stack
+    value = LuaValue(executor)
+
+    if value.type() == _executor.LUA_TFUNCTION:
+        return value # we're already callable
+
+    raise LuaException("can't coerce %s" % value.type_name())
+
+
 def _indexable_wrapper(executor, indexable, should_cache, recursive):
     index_lua = LuaValue(executor)
     index_python = index_lua.to_python()
@@ -876,96 +1510,829 @@ def _indexable_wrapper(executor, indexable, should_cache, recursive):
     return lv._bring_to_top(False)
 
 
+class LuaScope(object):
+    """
+    An arena of LuaValues created by Lua.scope(). Rather than each value
+    holding its own registry reference, they are all stored in one table
+    that's referenced from the registry, so releasing them is a single unref
+    """
+
+    __slots__ = ['executor', 'L', 'ref', 'count', 'live']
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.L = executor.L
+        self.count = 0
+        self.live = True
+
+        lua_createtable(self.L, 0, 0)
+        self.ref = luaL_ref(self.L, _executor.LUA_REGISTRYINDEX)
+
+    def _store(self):
+        "pop the top of the stack into the arena and return its index"
+        if not self.live:
+            lua_pop(self.L, 1)
+            raise LuaException("%r has already been released" % (self,))
+
+        self.count += 1
+        scope_store(self.L, self.ref, self.count)
+        return self.count
+
+    def _push(self, index):
+        "push the value at the given index onto the stack"
+        if not self.live:
+            raise LuaException("LuaValue used after its scope ended")
+
+        scope_push(self.L, self.ref, index)
+
+    def release(self):
+        if self.live:
+            self.live = False
+            luaL_unref(self.L, _executor.LUA_REGISTRYINDEX, self.ref)
+
+    def __repr__(self):
+        return "<%s %s:%d (%d values)>" % (self.__class__.__name__,
+                                            self.executor.name,
+                                            self.ref,
+                                            self.count)
+
+
 class Capsule(object):
     """
     A container for passing Python objects through Lua unmolested
     """
 
-    __slots__ = ['inner', 'cache', 'recursive', 'raw_lua_args']
+    __slots__ = ['inner', 'cache', 'recursive', 'raw_lua_args',
+                 'returns_future']
 
-    def __init__(self, inner, cache=True, recursive=True, raw_lua_args=False):
+    def __init__(self, inner, cache=True, recursive=True, raw_lua_args=False,
+                 returns_future=False):
         self.inner = inner
         self.cache = cache
         self.recursive = recursive
         self.raw_lua_args = raw_lua_args
+        # if set, `inner` returns a future (anything with done() and result()
+        # like a concurrent.futures.Future). Scripts running under a Scheduler
+        # are suspended until it completes and everyone else blocks on it
+        self.returns_future = returns_future
 
 
-class LuaException(Exception):
-    def __str__(self):
-        return "%s(%s)" % (self.__class__.__name__, self.message)
+class _AwaitedFuture(object):
+    # what a Task sees yielded when its script is waiting on a future. Scripts
+    # can't construct these so they can't be confused with a normal yield
+    __slots__ = ['future']
 
-    def __repr__(self):
-        return str(self)
+    def __init__(self, future):
+        self.future = future
 
 
-class LuaInvariantException(LuaException):
-    pass
+TYPED_ARRAY_KINDS = {
+    'float64': _executor.EXECUTOR_ARRAY_FLOAT64,
+    'int64': _executor.EXECUTOR_ARRAY_INT64,
+    'int32': _executor.EXECUTOR_ARRAY_INT32,
+}
 
 
-class LuaOutOfMemoryException(LuaException):
-    pass
+class TypedArray(object):
+    """
+    A container for sharing a numeric buffer (an array.array, bytearray, numpy
+    array, or anything else with the buffer interface) with Lua without
+    copying it.
+
+    Lua sees it as a fixed-length 1-indexed array that can be read and written
+    in place, and the `array` library has helpers that operate on it in C. When
+    it's returned back to Python you get `inner` itself. If the buffer can't
+    be pinned (like array.array on Python 2) you must not resize it while Lua
+    holds a reference to it
+    """
 
+    __slots__ = ['inner', 'kind']
 
-class LuaStateException(LuaException):
-    def __init__(self, executor):
-        # there's currently an error on the top of the Lua stack so extract
-        # it, turn it into a Python exception, and raise it.
+    def __init__(self, inner, kind=None):
+        self.inner = inner
+        self.kind = kind or _typed_array_kind(inner)
 
-        self.lua_value = lua_value = LuaValue(executor)
-        typ = lua_value.type()
-        # pretty-print if it's easy
-        if typ in (
-                _executor.LUA_TNUMBER,
-                _executor.LUA_TNIL,
-                _executor.LUA_TBOOLEAN,
-                _executor.LUA_TSTRING):
-            message = repr(lua_value.to_python())
-        elif typ == _executor.LUA_TUSERDATA and lua_value.is_capsule():
-            python_value = lua_value.to_python()
-            message = repr(python_value)
-            self.__cause__ = python_value
-        else:
-            message = repr(lua_value)
+        if self.kind not in TYPED_ARRAY_KINDS:
+            raise ValueError("kind must be one of %r, not %r"
+                             % (sorted(TYPED_ARRAY_KINDS), self.kind))
 
-        return super(LuaStateException, self).__init__(message)
 
+def _typed_array_kind(inner):
+    # array.array
+    typecode = getattr(inner, 'typecode', None)
+    if typecode == 'd':
+        return 'float64'
+    elif typecode in ('i', 'l', 'q'):
+        return {4: 'int32', 8: 'int64'}.get(inner.itemsize)
 
-class LuaSyntaxError(LuaStateException):
-    pass
+    # numpy and friends
+    dtype = getattr(inner, 'dtype', None)
+    if dtype is not None and str(dtype) in TYPED_ARRAY_KINDS:
+        return str(dtype)
 
+    raise TypeError("can't guess the kind of %r, pass kind=" % (inner,))
 
-# make this available to importers
-SANDBOXER = datafile("lua_utils/safe_sandbox.lua")
 
+def _array_typecodes():
+    # the array.array typecodes that LuaValue.to_array can fill, which depends
+    # on the platform's sizes (and 'q' on Python having it)
+    typecodes = []
+    for typecode in 'dilq':
+        try:
+            _typed_array_kind(array.array(typecode))
+        except (TypeError, ValueError):
+            continue
+        typecodes.append(typecode)
+    return tuple(typecodes)
 
-class SandboxedExecutor(object):
-    def __init__(self,
-                 name=None,
-                 sandboxer=SANDBOXER,
-                 libs=(),
-                 env=None,
-                 **kw):
-        # bring up the VM
-        self.ex = Lua(name=name, **kw)
 
-        loaded_sandboxer = self.ex.load(
-            sandboxer,
-            desc='%s.sandboxer' % self.ex.name)
+ARRAY_TYPECODES = _array_typecodes()
 
-        self.sandbox = loaded_sandboxer()[0]
 
-        # now that the env is built, build the libs in that env too
-        for i, lib in enumerate(libs, 1):
-            loaded_lib = self.sandboxed_load(
-                lib,
-                desc = "%s.libs[%d]" % (self.name, i))
-            loaded_lib()
+LOOKUP_TABLE_MAGIC = 'LSBLKUP1'
+
+# for the mode of new lookup table files. There's no reading the umask without
+# setting it, which would briefly affect every other thread's new files too, so
+# it's only done once while we're being imported
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class LookupTable(object):
+    """
+    A read-only table of string keys and values in a file written by
+    write_lookup_table, for big reference data like IP ranges or blocklists.
+    The file is mmap'd, so one copy of it is shared by every VM that it's
+    passed into and every process that opens it, and it doesn't count against
+    anybody's max_memory. Lua sees a userdata with:
+
+        t:get(key)        the value, or nil
+        t:contains(key)
+        t:floor(key)      the greatest key <= key and its value, for finding
+                          the range that key is in when ranges are stored by
+                          their start
+        t:range(lo, hi)   an iterator over the keys and values from lo to hi
+                          inclusive, in order. Either may be nil
+        #t
+
+    To update it, write_lookup_table the new version over the old file and
+    reload(). Every VM that we were passed into switches to it, and range()s
+    already running finish on the old one
+    """
+
+    def __init__(self, path):
+        self.ptr = None
+        self.path = path
+        self._identity = _file_identity(path)
+
+        ptr = lookup_table_open(_fs_path(path))
+        self.ptr = ctypes.c_void_p(ptr)
+
+        # hold on to this for __del__
+        self.cleanup_cache = dict(
+            lookup_table_release=lookup_table_release,
+        )
+
+    def reload(self):
+        """
+        Switch to the file at our path if it's been replaced since we opened
+        it, returning whether it had
+        """
+        if _file_identity(self.path) == self._identity:
+            return False
+        self.swap(self.path)
+        return True
+
+    def swap(self, path):
+        "Switch to the lookup table file at path"
+        identity = _file_identity(path)
+        lookup_table_swap(self.ptr, _fs_path(path))
+        self.path = path
+        self._identity = identity
+
+    def get(self, key, default=None):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        ret = lookup_table_get(self.ptr, ctypes.py_object(key))
+        return default if ret is None else ret
+
+    def __getitem__(self, key):
+        ret = self.get(key)
+        if ret is None:
+            raise KeyError(key)
+        return ret
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return lookup_table_count(self.ptr)
+
+    def __repr__(self):
+        return "<%s %s (%d entries)>" % (self.__class__.__name__, self.path,
+                                         len(self))
+
+    def __del__(self):
+        if self.ptr:
+            self.cleanup_cache['lookup_table_release'](self.ptr)
+
+
+def write_lookup_table(path, items):
+    """
+    Write items (a dict, or (key, value) pairs) of strings to path for
+    LookupTable. It's written to a temporary file that's renamed over path,
+    so anybody opening path sees either all of the old version or all of the
+    new one. Never modify these files in place instead: every process with
+    one mapped would see the changes as they happen, or crash if it shrank
+    """
+    if isinstance(items, collections.Mapping):
+        items = items.iteritems()
+
+    entries = {}
+    for key, value in items:
+        entries[_lookup_bytes(key)] = _lookup_bytes(value)
+
+    # Python sorts strings the same way as _executormodule.c:lookup_compare
+    keys = sorted(entries)
+
+    index = []
+    data = []
+    offset = len(LOOKUP_TABLE_MAGIC) + 8 + 16*len(keys)
+
+    for key in keys:
+        value = entries[key]
+        index.append(struct.pack('<IIII', offset, len(key),
+                                 offset+len(key), len(value)))
+        data.append(key)
+        data.append(value)
+        offset += len(key) + len(value)
+
+    if offset > 0xffffffff:
+        raise ValueError("too big for a lookup table (%d bytes)" % (offset,))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.lookup-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack('<8sII', LOOKUP_TABLE_MAGIC, len(keys), 0))
+            f.write(''.join(index))
+            f.write(''.join(data))
+            # mkstemp's file is only readable by us, so give it the mode
+            # that the file it replaces had (or that a new one would get)
+            os.fchmod(f.fileno(), _lookup_mode(path))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _lookup_mode(path):
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        return 0666 & ~_UMASK
+
+
+def _lookup_bytes(s):
+    if isinstance(s, unicode):
+        return s.encode('utf8')
+    if not isinstance(s, str):
+        raise TypeError("lookup table keys and values are strings, not %r"
+                        % (type(s),))
+    return s
+
+
+def _fs_path(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding())
+    return path
+
+
+def _file_identity(path):
+    # what changes when the file is replaced
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class Cached(object):
+    """
+    A container for Python values that are passed into Lua over and over
+    again, like a big config dict that every call gets.
+
+    The first time it's converted the Lua table is kept in the executor's
+    ConversionCache, and it's handed out again for as long as `inner` is the
+    same object with the same `version`. So bump the version whenever you
+    change `inner` (or leave it None if you never will). Scripts get a
+    read-only view of the table so they can't corrupt it for each other,
+    and table.insert, table.remove and table.sort refuse it too.
+
+    From 5.2 on the view works with #, pairs and ipairs, but next only sees
+    an empty table, and so do unpack and table.concat on 5.2. On luajit it
+    can only be indexed
+    """
+
+    __slots__ = ['inner', 'version']
+
+    def __init__(self, inner, version=None):
+        self.inner = inner
+        self.version = version
+
+
+class ConversionCache(object):
+    """
+    The Lua tables built for Cached values, keyed by the identity and version
+    of the Python value. The memory the tables use counts against the
+    executor's max_memory like anything else, and the least recently used are
+    dropped to keep them within our own max_memory (0 for no limit)
+    """
+
+    # we only hold registry refs rather than LuaValues, because they'd hold
+    # their executor and it holds us
+    __slots__ = ['max_memory', 'memory_used', 'entries', 'freeze_ref',
+                 'hits', 'misses']
+
+    def __init__(self, max_memory=0):
+        self.max_memory = max_memory
+        self.memory_used = 0
+        self.hits = self.misses = 0
+
+        # (id(inner), version) -> (inner, ref, size), least recently used
+        # first. Holding inner keeps its id from being reused
+        self.entries = collections.OrderedDict()
+
+        self.freeze_ref = None
+
+    def get(self, executor, cached):
+        "A LuaValue of the read-only table for `cached`, building it if needed"
+        key = (id(cached.inner), cached.version)
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            self.misses += 1
+            entry = self._build(executor, cached)
+        else:
+            self.hits += 1
+
+        # it's now the most recently used
+        self.entries[key] = entry
+        self._evict(executor)
+
+        if not lua_checkstack(executor.L, 1):
+            raise LuaOutOfMemoryException("ConversionCache.checkstack")
+        lua_rawgeti(executor.L, _executor.LUA_REGISTRYINDEX, entry[1])
+        return LuaValue(executor)
+
+    def _build(self, executor, cached):
+        # any other versions of it are stale now
+        for key in [k for k in self.entries if k[0] == id(cached.inner)]:
+            self._drop(executor, key)
+
+        freeze = self._freeze(executor)
+
+        # freeze wraps the converted tables in place, so this is all that the
+        # entry holds onto. The collector is stopped so that whatever else it
+        # frees in the meantime doesn't come off of our size
+        lua_gc(executor.L, _executor.LUA_GCSTOP, 0)
+        try:
+            before = executor.memory_used
+            frozen, = freeze(LuaValue.from_python(executor, cached.inner))
+            size = max(0, executor.memory_used - before)
+        finally:
+            lua_gc(executor.L, _executor.LUA_GCRESTART, 0)
+
+        if not lua_checkstack(executor.L, 1):
+            raise LuaOutOfMemoryException("ConversionCache.checkstack")
+        frozen._bring_to_top(False)
+        ref = luaL_ref(executor.L, _executor.LUA_REGISTRYINDEX)
+
+        self.memory_used += size
+        return (cached.inner, ref, size)
+
+    def _freeze(self, executor):
+        if not lua_checkstack(executor.L, 1):
+            raise LuaOutOfMemoryException("ConversionCache.checkstack")
+
+        if self.freeze_ref is None:
+            tenant_utils = executor.load(
+                TENANT_UTILS,
+                desc='%s.tenant_utils' % executor.name)()[0]
+            tenant_utils['freeze']._bring_to_top(False)
+            self.freeze_ref = luaL_ref(executor.L,
+                                       _executor.LUA_REGISTRYINDEX)
+
+        lua_rawgeti(executor.L, _executor.LUA_REGISTRYINDEX, self.freeze_ref)
+        return LuaValue(executor)
+
+    def _evict(self, executor):
+        # always keep the newest, even if it's too big on its own
+        while (self.max_memory
+               and self.memory_used > self.max_memory
+               and len(self.entries) > 1):
+            oldest = next(iter(self.entries))
+            self._drop(executor, oldest)
+
+    def _drop(self, executor, key):
+        inner, ref, size = self.entries.pop(key)
+        luaL_unref(executor.L, _executor.LUA_REGISTRYINDEX, ref)
+        self.memory_used -= size
+
+    def clear(self, executor):
+        for key in list(self.entries):
+            self._drop(executor, key)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Memoized(object):
+    """
+    A loaded function that's a pure function of its arguments, with the
+    results of call_py cached by them.
+
+    Entries are kept least recently used first, and the oldest are dropped to
+    keep to max_entries and max_memory (an estimate of the bytes that the
+    arguments and results take up in Python, 0 for no limit). With ttl they
+    also expire that many seconds after they were made. Results are shared
+    between calls, so don't modify them. Arguments that we don't know how to
+    key on (like Capsules) are passed through to the function uncached.
+
+    Only memoize functions whose results depend on nothing but their
+    arguments. pure_load() helps with that by hiding things like os.time and
+    math.random from the script
+    """
+
+    def __init__(self, function, max_entries=1024, max_memory=0, ttl=None,
+                 timer=time.time):
+        self.function = function
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.timer = timer
+
+        # key -> (expires, result, size), least recently used first
+        self.entries = collections.OrderedDict()
+        self.memory_used = 0
+        self.hits = self.misses = self.evictions = self.uncacheable = 0
+
+    def __call__(self, *args):
+        try:
+            key = _memo_key(args)
+        except TypeError:
+            self.uncacheable += 1
+            return self.function.call_py(*args)
+
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            if entry[0] is None or entry[0] > self.timer():
+                # it's now the most recently used
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.memory_used -= entry[2]
+
+        self.misses += 1
+        result = self.function.call_py(*args)
+
+        expires = self.timer()+self.ttl if self.ttl else None
+        size = _memo_size(key) + _memo_size(result)
+        self.entries[key] = (expires, result, size)
+        self.memory_used += size
+        self._evict()
+
+        return result
+
+    call_py = __call__
+
+    def _evict(self):
+        # always keep the newest, even if it's too big on its own
+        while len(self.entries) > 1 and (
+                (self.max_entries and len(self.entries) > self.max_entries)
+                or (self.max_memory and self.memory_used > self.max_memory)):
+            _key, (_expires, _result, size) = self.entries.popitem(last=False)
+            self.memory_used -= size
+            self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return float(self.hits)/calls if calls else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'uncacheable': self.uncacheable,
+            'hit_rate': self.hit_rate,
+            'entries': len(self.entries),
+            'memory_used': self.memory_used,
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.memory_used = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "<%s %r (%d entries, %.0f%% hits)>" % (
+            self.__class__.__name__, self.function, len(self.entries),
+            self.hit_rate*100)
+
+
+def _memo_key(val):
+    """
+    A hashable key for `val` that's equal for any values that convert to the
+    same Lua value, since that's all that the script can see. Raises TypeError
+    for anything else
+    """
+    # bool before int because it's a subclass of it
+    if val is None or isinstance(val, (bool, str)):
+        return val
+    elif isinstance(val, unicode):
+        return val.encode('utf8')
+    elif isinstance(val, (int, long)):
+        # 1 and 1.0 are different numbers to 5.3's math.type
+        return ('i', val)
+    elif isinstance(val, float):
+        return ('f', val)
+    elif isinstance(val, (list, tuple)):
+        return ('l',) + tuple(_memo_key(x) for x in val)
+    elif isinstance(val, dict):
+        return ('d',) + tuple(sorted((_memo_key(k), _memo_key(v))
+                                     for k, v in val.iteritems()))
+    raise TypeError("can't memoize on %r" % (type(val),))
+
+
+def _memo_size(val):
+    "Roughly how many bytes `val` takes up, counting its contents"
+    size = sys.getsizeof(val)
+    if isinstance(val, dict):
+        for k, v in val.iteritems():
+            size += _memo_size(k) + _memo_size(v)
+    elif isinstance(val, (list, tuple)):
+        for x in val:
+            size += _memo_size(x)
+    return size
+
+
+class Schema(object):
+    """
+    The shape of a kind of record that's passed into or out of Lua over and
+    over, to be compiled by Lua.compile_schema.
+
+    fields are (name, type) pairs, where the type is one of str (or unicode),
+    int, float, bool, another Schema for a nested record, a one-item list like
+    [str] for a sequence of that type, or None for anything (converted like
+    from_python and to_python would). Any field may be None. Records come back
+    out of Lua as namedtuples called `name`, or plain tuples with
+    namedtuple=False
+
+        Event = Schema('Event', [('body', str),
+                                 ('score', float),
+                                 ('tags', [str]),
+                                 ('user', Schema('User', [('id', int)]))])
+    """
+
+    __slots__ = ['name', 'fields', 'record_type']
+
+    def __init__(self, name, fields, namedtuple=True):
+        self.name = name
+        self.fields = []
+
+        for field_name, field_type in fields:
+            if isinstance(field_name, unicode):
+                field_name = field_name.encode('utf8')
+            if not isinstance(field_name, str):
+                raise TypeError("field names must be strings, not %r"
+                                % (field_name,))
+            self.fields.append((field_name, field_type))
+
+        if namedtuple:
+            self.record_type = collections.namedtuple(
+                name, [field_name for field_name, _ in self.fields])
+        else:
+            self.record_type = None
+
+    def __repr__(self):
+        return "<%s %s(%s)>" % (self.__class__.__name__, self.name,
+                                ', '.join(name for name, _ in self.fields))
+
+
+class SchemaConverter(object):
+    """
+    A Schema compiled for one executor. Every key string that it uses is kept
+    in the registry so that they're pushed without being hashed and interned
+    again, and records are converted in a single pass in C with their tables
+    created at the right size
+    """
+
+    _cleanup_cache = dict(
+        luaL_unref=luaL_unref,
+        LUA_REGISTRYINDEX=_executor.LUA_REGISTRYINDEX,
+    )
+
+    _kinds = {
+        str: _executor.EXECUTOR_SCHEMA_STR,
+        unicode: _executor.EXECUTOR_SCHEMA_STR,
+        int: _executor.EXECUTOR_SCHEMA_INT,
+        long: _executor.EXECUTOR_SCHEMA_INT,
+        float: _executor.EXECUTOR_SCHEMA_FLOAT,
+        bool: _executor.EXECUTOR_SCHEMA_BOOL,
+    }
+
+    def __init__(self, executor, schema):
+        self.executor = executor
+        self.L = executor.L
+        self.schema = schema
+
+        self.keys_ref = None
+        keys = []
+        self.type = self._describe(schema, keys, {})
+        self.keys_ref = self._pin_keys(keys)
+
+    def _describe(self, field_type, keys, indexes):
+        # the (kind, sub, cls) tuples that _executormodule.c:schema_push walks
+        if field_type is None:
+            return (_executor.EXECUTOR_SCHEMA_ANY, None, None)
+
+        elif isinstance(field_type, type) and field_type in self._kinds:
+            return (self._kinds[field_type], None, None)
+
+        elif isinstance(field_type, Schema):
+            fields = []
+            for name, sub in field_type.fields:
+                if name not in indexes:
+                    keys.append(name)
+                    indexes[name] = len(keys)
+                fields.append((intern(name), indexes[name],
+                               self._describe(sub, keys, indexes)))
+            return (_executor.EXECUTOR_SCHEMA_RECORD, tuple(fields),
+                    field_type.record_type)
+
+        elif isinstance(field_type, list) and len(field_type) == 1:
+            return (_executor.EXECUTOR_SCHEMA_LIST,
+                    self._describe(field_type[0], keys, indexes),
+                    None)
+
+        raise TypeError("can't describe a field as %r" % (field_type,))
+
+    @check_stack(1, 0)
+    def _pin_keys(self, keys):
+        LuaValue.from_python(self.executor, keys)._bring_to_top(False)
+        return luaL_ref(self.L, _executor.LUA_REGISTRYINDEX)
+
+    @check_stack(1, 0)
+    def to_lua(self, record):
+        """
+        A LuaValue of record, which must fit the schema. It can be a dict, a
+        tuple with one item per field in order, or an object with every field
+        as an attribute
+        """
+        schema_to_lua(self.L, self.keys_ref,
+                      ctypes.py_object(self.type),
+                      ctypes.py_object(record),
+                      ctypes.py_object(_push_callback_result),
+                      ctypes.py_object(self.executor))
+        return LuaValue(self.executor)
+
+    @check_stack(1, 0)
+    def to_python(self, value):
+        "A LuaValue of a table that fits the schema, as a namedtuple"
+        with value._bring_to_top():
+            return schema_to_python(self.L, -1, self.keys_ref,
+                                    ctypes.py_object(self.type),
+                                    ctypes.py_object(_to_python_fallback),
+                                    ctypes.py_object(self.executor))
+
+    def __repr__(self):
+        return "<%s %r on %s>" % (self.__class__.__name__, self.schema,
+                                  self.executor.name)
+
+    def __del__(self):
+        if self.keys_ref is not None:
+            self._cleanup_cache['luaL_unref'](self.L,
+                self._cleanup_cache['LUA_REGISTRYINDEX'],
+                self.keys_ref)
+
+
+class LuaException(Exception):
+    def __str__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.message)
+
+    def __repr__(self):
+        return str(self)
+
+
+class LuaInvariantException(LuaException):
+    pass
+
+
+class LuaOutOfMemoryException(LuaException):
+    pass
+
+
+class LuaStateException(LuaException):
+    def __init__(self, executor):
+        # there's currently an error on the top of the Lua stack so extract
+        # it, turn it into a Python exception, and raise it.
+
+        self.lua_value = lua_value = LuaValue(executor)
+        typ = lua_value.type()
+        # pretty-print if it's easy
+        if typ in (
+                _executor.LUA_TNUMBER,
+                _executor.LUA_TNIL,
+                _executor.LUA_TBOOLEAN,
+                _executor.LUA_TSTRING):
+            message = repr(lua_value.to_python())
+        elif typ == _executor.LUA_TUSERDATA and lua_value.is_capsule():
+            python_value = lua_value.to_python()
+            message = repr(python_value)
+            self.__cause__ = python_value
+        else:
+            message = repr(lua_value)
+
+        return super(LuaStateException, self).__init__(message)
+
+
+class LuaSyntaxError(LuaStateException):
+    pass
+
+
+# make this available to importers
+SANDBOXER = datafile("lua_utils/safe_sandbox.lua")
+
+# the standard libraries that SANDBOXER copies from. Opening only these makes
+# VMs quicker to bring up and smaller. luajit needs its jit library to turn
+# the compiler on
+SANDBOX_LIBRARIES = ('_G', 'coroutine', 'math', 'os', 'string', 'table')
+if luaJIT_setmode:
+    SANDBOX_LIBRARIES += ('jit',)
+
+LAZY_LIBS = datafile("lua_utils/lazy_libs.lua")
+PURE_UTILS = datafile("lua_utils/pure.lua")
+
+
+class SandboxedExecutor(object):
+    def __init__(self,
+                 name=None,
+                 sandboxer=SANDBOXER,
+                 libs=(),
+                 env=None,
+                 libraries=SANDBOX_LIBRARIES,
+                 **kw):
+        # bring up the VM. A sandboxer that needs more standard libraries than
+        # ours should ask for them, or pass libraries=None for all of them
+        self.ex = Lua(name=name, libraries=libraries, **kw)
+
+        loaded_sandboxer = self.ex.load(
+            sandboxer,
+            desc='%s.sandboxer' % self.ex.name)
+
+        self.sandbox = loaded_sandboxer()[0]
+
+        # the loaders of the lazy libs that haven't been used yet
+        self.lazy_loaders = None
+
+        # now that the env is built, build the libs in that env too
+        if isinstance(libs, collections.Mapping):
+            self._lazy_libs(libs)
+        else:
+            for i, lib in enumerate(libs, 1):
+                loaded_lib = self.sandboxed_load(
+                    lib,
+                    desc = "%s.libs[%d]" % (self.name, i))
+                loaded_lib()
 
         # any additional envs they want available
         if env:
             for k, v in env.items():
                 self.sandbox[k] = v
 
+    def _lazy_libs(self, libs):
+        """
+        libs maps global names to code that returns the value for them, which
+        is only run the first time that a script reads that name
+        """
+        loaders = self.ex.create_table()
+
+        for lib_name, lib in libs.items():
+            loaders[lib_name] = self.sandboxed_load(
+                lib,
+                desc = "%s.libs[%s]" % (self.name, lib_name))
+
+        lazy_utils = self.ex.load(
+            LAZY_LIBS,
+            desc='%s.lazy_libs' % self.ex.name)()[0]
+        lazy_utils['lazy'](self.sandbox, loaders)
+        self.lazy_loaders = loaders
+
     def __getattr__(self, attr):
         return getattr(self.ex, attr)
 
@@ -975,26 +2342,965 @@ class SandboxedExecutor(object):
     def __setitem__(self, *a, **kw):
         return self.ex.__setitem__(*a, **kw)
 
-    @check_stack(2, 0)
     def sandboxed_load(self, *a, **kw):
         loaded = self.ex.load(*a, **kw)
+        set_env(loaded, self.sandbox)
+        return loaded
+
+    def prepare(self, code, params=(), desc=None):
+        """
+        Load `code` as a PreparedScript that takes `params` as locals, rather
+        than having its inputs set as sandbox globals before each call
+        """
+        return PreparedScript(
+            self.sandboxed_load(_prepared_code(code, params), desc=desc),
+            params)
+
+    def pure_load(self, code, desc=None, **kw):
+        """
+        Load a script that's a pure function of its arguments, and return it
+        Memoized (with `kw` as its options). The script gets a read-only
+        snapshot of the sandbox as it is now, with the nondeterministic
+        functions like os.time and math.random replaced by ones that raise
+        errors, so that the cached results can be trusted
+        """
+        loaded = self.ex.load(code, desc=desc)
+        set_env(loaded, _pure_env(self.ex, self.sandbox,
+                                  lazy=self.lazy_loaders))
+        return Memoized(loaded, **kw)
+
+
+LUA_KEYWORDS = frozenset([
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function',
+    'goto', 'if', 'in', 'local', 'nil', 'not', 'or', 'repeat', 'return',
+    'then', 'true', 'until', 'while',
+])
+LUA_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
+def _prepared_code(code, params):
+    """
+    `code` with its arguments unpacked into locals named by params. It goes on
+    the first line so that line numbers in errors still match
+    """
+    assert isinstance(code, str)
+
+    seen = set()
+    for param in params:
+        if (not isinstance(param, str)
+                or not LUA_NAME.match(param)
+                or param in LUA_KEYWORDS):
+            raise ValueError("%r isn't a valid parameter name" % (param,))
+        if param in seen:
+            raise ValueError("duplicate parameter %r" % (param,))
+        seen.add(param)
+
+    if not params:
+        return code
+
+    return 'local %s = ... %s' % (', '.join(params), code)
+
+
+class PreparedScript(object):
+    """
+    A loaded script that takes named parameters as locals. They're passed on
+    the stack like any other function arguments, so nothing is written to the
+    sandbox and calls sharing an executor can't see each other's inputs.
+    Parameters can be given positionally or by keyword, and any that aren't
+    given are nil
+    """
+
+    __slots__ = ['function', 'params', 'positions']
+
+    def __init__(self, function, params):
+        self.function = function
+        self.params = tuple(params)
+        self.positions = dict((param, i) for i, param in enumerate(params))
+
+    def _arguments(self, args, kw):
+        if len(args) > len(self.params):
+            raise TypeError("takes at most %d arguments (%d given)"
+                            % (len(self.params), len(args)))
+
+        if not kw:
+            return args
+
+        ret = list(args) + [None]*(len(self.params)-len(args))
+        for name, value in kw.iteritems():
+            try:
+                i = self.positions[name]
+            except KeyError:
+                raise TypeError("unexpected parameter %r" % (name,))
+            if i < len(args):
+                raise TypeError("got multiple values for parameter %r"
+                                % (name,))
+            ret[i] = value
+
+        return ret
+
+    def __call__(self, *args, **kw):
+        return self.function(*self._arguments(args, kw))
+
+    def call_py(self, *args, **kw):
+        return self.function.call_py(*self._arguments(args, kw))
+
+    def __repr__(self):
+        return "<%s(%s) %r>" % (self.__class__.__name__,
+                                ', '.join(self.params),
+                                self.function)
+
+
+def _pure_env(executor, env, base=None, lazy=None):
+    pure_utils = executor.load(
+        PURE_UTILS,
+        desc='%s.pure_utils' % executor.name)()[0]
+    tenant_utils = executor.load(
+        TENANT_UTILS,
+        desc='%s.tenant_utils' % executor.name)()[0]
+    return pure_utils['pure_env'](env, tenant_utils['freeze'], base, lazy)[0]
+
+
+@check_stack(2, 0)
+def _set_env(executor, loaded, env):
+    with loaded._bring_to_top():
+        env._bring_to_top(False)
+
+        if _executor.LUA_VERSION_NUM == 501:
+            ret = lua_setfenv(executor.L, -2)
+            if ret != 1:
+                raise LuaException("couldn't setfenv?")
+
+        else:
+            # this seems really magical but it it replaces the _ENV
+            # variable for this chunk (then pops the value)
+            ret = lua_setupvalue(executor.L, -2, 1)
+            if ret is None:
+                raise LuaException("couldn't set upvalue?")
+
+
+def set_env(loaded, env):
+    "Make `env` the global environment of the loaded chunk"
+    # weird argument rearranging to make @check_stack happy
+    return _set_env(loaded.executor, loaded, env)
+
+
+TENANT_UTILS = datafile("lua_utils/tenants.lua")
+
+
+class MultiTenantExecutor(object):
+    """
+    One Lua VM hosting the scripts of many tenants.
+
+    The sandbox env is built once and frozen, and each Tenant gets a cheap env
+    of their own that reads through to it. Tenants can't see each other's
+    globals or modify the shared libraries, and their memory and runtime are
+    accounted separately
+    """
+
+    def __init__(self,
+                 name=None,
+                 sandboxer=SANDBOXER,
+                 libs=(),
+                 env=None,
+                 libraries=SANDBOX_LIBRARIES,
+                 **kw):
+        # bring up the VM
+        self.ex = Lua(name=name, libraries=libraries, **kw)
+
+        loaded_sandboxer = self.ex.load(
+            sandboxer,
+            desc='%s.sandboxer' % self.ex.name)
 
-        with loaded._bring_to_top():
-            self.sandbox._bring_to_top(False)
+        base = loaded_sandboxer()[0]
+
+        # the libs and envs go into the base before we freeze it. That means
+        # named libs can't be loaded lazily like SandboxedExecutor's are
+        if isinstance(libs, collections.Mapping):
+            for lib_name, lib in libs.items():
+                loaded_lib = self.ex.load(
+                    lib,
+                    desc = "%s.libs[%s]" % (self.name, lib_name))
+                set_env(loaded_lib, base)
+                base[lib_name] = loaded_lib()[0]
+        else:
+            for i, lib in enumerate(libs, 1):
+                loaded_lib = self.ex.load(
+                    lib,
+                    desc = "%s.libs[%d]" % (self.name, i))
+                set_env(loaded_lib, base)
+                loaded_lib()
 
-            if _executor.LUA_VERSION_NUM == 501:
-                ret = lua_setfenv(self.L, -2)
-                if ret != 1:
-                    raise LuaException("couldn't setfenv?")
+        if env:
+            for k, v in env.items():
+                base[k] = v
+
+        self.tenant_utils = self.ex.load(
+            TENANT_UTILS,
+            desc='%s.tenant_utils' % self.ex.name)()[0]
+
+        self.base = self.tenant_utils['freeze'](base)[0]
+
+    def __getattr__(self, attr):
+        return getattr(self.ex, attr)
 
+    def tenant(self, name=None, max_memory=None, max_runtime=None):
+        return Tenant(self, name=name,
+                      max_memory=max_memory,
+                      max_runtime=max_runtime)
+
+
+class Tenant(object):
+    """
+    One tenant's view of a MultiTenantExecutor. Anything it loads gets its own
+    env, and runs charged against its own budgets
+    """
+
+    def __init__(self, executor, name=None, max_memory=None, max_runtime=None):
+        self.executor = executor
+        self.ex = executor.ex
+        self.name = name or "%s[%s]" % (self.__class__.__name__, id(self))
+        self.max_memory = max_memory or 0
+        self.max_runtime = max_runtime
+
+        self.ptr = None
+        ptr = new_tenant(ctypes.c_size_t(max_memory or 0))
+        if not ptr:
+            raise LuaOutOfMemoryException("couldn't allocate tenant")
+        self.ptr = ctypes.c_void_p(ptr)
+
+        # hold on to this for __del__
+        self.cleanup_cache = dict(
+            free_tenant=free_tenant,
+        )
+
+        with self.running():
+            self.sandbox = executor.tenant_utils['new_env'](executor.base)[0]
+
+    def __repr__(self):
+        return "<%s %s on %s>" % (self.__class__.__name__,
+                                  self.name,
+                                  self.executor.name)
+
+    @property
+    def memory_used(self):
+        """
+        bytes allocated while this tenant was running that haven't been freed
+        yet, whenever that happens
+        """
+        return get_tenant_memory_used(self.ptr)
+
+    @property
+    def runtime_used(self):
+        "seconds of CPU time spent running this tenant"
+        return get_tenant_runtime_used(self.ptr)
+
+    @contextlib.contextmanager
+    def running(self):
+        "Charge everything that happens inside of this block to this tenant"
+        previous = enter_tenant(self.ex.L, self.ptr)
+
+        try:
+            if self.max_runtime:
+                with self.ex.limit_runtime(self.max_runtime):
+                    yield
             else:
-                # this seems really magical but it it replaces the _ENV
-                # variable for this chunk (then pops the value)
-                ret = lua_setupvalue(self.L, -2, 1)
-                if ret is None:
-                    raise LuaException("couldn't set upvalue?")
+                yield
+        except LuaOutOfMemoryException:
+            refused = get_tenant_refused(self.ptr)
+            if not refused:
+                raise
+            # it was our own budget that ran out, not the VM's
+            raise LuaOutOfMemoryException(
+                "%s: %.2fmb > %.2fmb"
+                % (self.name,
+                   refused/1024.0/1024.0,
+                   self.max_memory/1024.0/1024.0))
+        finally:
+            exit_tenant(self.ex.L, ctypes.c_void_p(previous))
 
-        return loaded
+    def sandboxed_load(self, *a, **kw):
+        with self.running():
+            loaded = self.ex.load(*a, **kw)
+        set_env(loaded, self.sandbox)
+        return TenantFunction(self, loaded)
+
+    def prepare(self, code, params=(), desc=None):
+        "Like SandboxedExecutor.prepare, but running as this tenant"
+        return PreparedScript(
+            self.sandboxed_load(_prepared_code(code, params), desc=desc),
+            params)
+
+    def pure_load(self, code, desc=None, **kw):
+        "Like SandboxedExecutor.pure_load, but running as this tenant"
+        with self.running():
+            loaded = self.ex.load(code, desc=desc)
+            pure_env = _pure_env(self.ex, self.sandbox,
+                                 base=self.executor.base)
+        set_env(loaded, pure_env)
+        return Memoized(TenantFunction(self, loaded), **kw)
+
+    def __del__(self):
+        if self.ptr:
+            self.cleanup_cache['free_tenant'](self.ptr)
+
+
+class TenantFunction(object):
+    """
+    A function loaded by a Tenant, that runs charged to that tenant
+    """
+
+    __slots__ = ['tenant', 'function']
+
+    def __init__(self, tenant, function):
+        self.tenant = tenant
+        self.function = function
+
+    def __call__(self, *args):
+        with self.tenant.running():
+            return self.function(*args)
+
+    def call_py(self, *args):
+        with self.tenant.running():
+            return self.function.call_py(*args)
+
+    def __repr__(self):
+        return "<%s %r on %r>" % (self.__class__.__name__,
+                                  self.function,
+                                  self.tenant)
+
+
+class RuleSet(object):
+    """
+    Many small sandboxed rules evaluated against the same record.
+
+    Rather than setting the record into the sandbox and calling each rule in
+    turn (converting it again every time), evaluate() converts it once into a
+    read-only table that all of the rules share and runs them from a single
+    loop in C. Each rule receives the record as its argument (`local event =
+    ...`) and, if record_name is given, as that global. A rule that errors or
+    runs over max_runtime only fails itself. Don't combine max_runtime with an
+    enclosing limit_runtime, since each rule replaces the runtime limiter.
+
+    On luajit, which can't iterate or measure read-only proxies, the record is
+    shared as a plain table instead, so rules mustn't modify it
+    """
+
+    def __init__(self, executor,
+                 max_runtime=None,
+                 max_runtime_hz=MAX_RUNTIME_HZ_DEFAULT,
+                 record_name=None):
+        self.executor = executor
+        self.lua = executor.ex
+        self.L = self.lua.L
+        self.max_runtime = max_runtime
+        self.max_runtime_hz = max_runtime_hz
+        self.record_name = record_name
+
+        self.names = []
+        self.rules = LuaValue.from_python(self.lua, {})
+
+        self.freeze = None
+        if _executor.LUA_VERSION_NUM > 501:
+            tenant_utils = self.lua.load(
+                TENANT_UTILS,
+                desc='%s.tenant_utils' % self.lua.name)()[0]
+            self.freeze = tenant_utils['freeze']
+
+    def add(self, name, code):
+        "Load a rule into the set. Rules run in the order they were added"
+        loaded = self.executor.sandboxed_load(
+            code, desc='%s.rules[%s]' % (self.lua.name, name))
+        self.rules[len(self.names)+1] = loaded
+        self.names.append(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def evaluate(self, record, first_match=False):
+        """
+        Run the rules against `record`, returning their RuleResults. With
+        first_match we stop after the first rule to return a true value
+        """
+        if self.freeze is not None:
+            # converted once and frozen in place, without a second copy
+            frozen, = self.freeze(record)
+        else:
+            frozen = LuaValue.from_python(self.lua, record)
+
+        if self.record_name:
+            self.executor.sandbox[self.record_name] = frozen
+
+        try:
+            ran, results, errors = self._run(frozen, first_match)
+        finally:
+            if self.record_name:
+                self.executor.sandbox[self.record_name] = None
+
+        if ran < 0:
+            raise _out_of_memory(self.lua)
+
+        ret = RuleResults()
+
+        for i, name in enumerate(self.names[:ran], 1):
+            error = errors[i]
+            if error.type() != _executor.LUA_TNIL:
+                ret.errors[name] = self._exception(error)
+                continue
+
+            try:
+                ret.results[name] = results[i].to_python()
+            except Exception as e:
+                ret.errors[name] = e
+
+        return ret
+
+    @check_stack(4, 0)
+    def _run(self, frozen, first_match):
+        self.rules._bring_to_top(False)
+        frozen._bring_to_top(False)
+
+        ran = run_rules(self.lua.L,
+                        1 if first_match else 0,
+                        ctypes.c_double(self.max_runtime or 0),
+                        ctypes.c_int(self.max_runtime_hz))
+
+        # run_rules leaves the results with the errors on top
+        errors = LuaValue(self.lua)
+        results = LuaValue(self.lua)
+
+        return ran, results, errors
+
+    @check_stack(1, 0)
+    def _exception(self, error):
+        error._bring_to_top(False)
+        return LuaStateException(self.lua)
+
+    def __repr__(self):
+        return "<%s %s (%d rules)>" % (self.__class__.__name__,
+                                       self.lua.name,
+                                       len(self.names))
+
+
+class RuleResults(object):
+    """
+    What came of RuleSet.evaluate: the return value of every rule that ran
+    successfully, and the exception of every one that didn't, by name
+    """
+
+    __slots__ = ['results', 'errors']
+
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.errors = collections.OrderedDict()
+
+    @property
+    def matched(self):
+        "The names of the rules that returned a true value, in order"
+        return [name for name, result in self.results.iteritems() if result]
+
+    def __repr__(self):
+        return "<%s matched=%r errors=%r>" % (self.__class__.__name__,
+                                              self.matched,
+                                              self.errors.keys())
+
+
+class ScriptRegistry(object):
+    """
+    Named scripts that can be redeployed while they're being called.
+
+    Every version of a script is compiled into all of the registry's
+    executors (SandboxedExecutors or Tenants, usually one per thread) before
+    any of them sees it, and then it replaces the previous version for new
+    calls everywhere at once. Calls that already started finish on the version
+    that they started with, and an old version's functions are released when
+    the last of those is done.
+
+    The registry serialises its own use of each executor, but can't know about
+    anybody else's, so only call the scripts through it while a deploy might
+    be running
+    """
+
+    def __init__(self, executors):
+        if not isinstance(executors, (list, tuple)):
+            executors = [executors]
+
+        self.executors = list(executors)
+        self._indexes = dict((id(ex), i) for i, ex in enumerate(self.executors))
+        # held while the registry is using each executor. Reentrant because
+        # a script can call back into Python that calls the registry again
+        self._locks = [threading.RLock() for _ in self.executors]
+
+        # protects everything below
+        self._lock = threading.Lock()
+        self._current = {}
+        # functions of retired versions waiting for their executor to be free
+        # so that we can release them safely
+        self._released = [[] for _ in self.executors]
+
+    def deploy(self, name, code):
+        """
+        Compile `code` into every executor and make it the current version of
+        `name`, returning its version number. If it doesn't compile the
+        current version stays in place
+        """
+        functions = []
+
+        try:
+            for i, executor in enumerate(self.executors):
+                with self._locks[i]:
+                    self._flush(i)
+                    functions.append(executor.sandboxed_load(
+                        code, desc='%s.scripts[%s]' % (executor.name, name)))
+        except Exception:
+            with self._lock:
+                self._queue_release(functions)
+            # the traceback keeps this frame alive, so don't let it keep
+            # these alive too
+            del functions[:]
+            raise
+
+        version = ScriptVersion(name, functions)
+
+        with self._lock:
+            previous = self._current.get(name)
+            version.number = previous.number+1 if previous else 1
+            self._current[name] = version
+            if previous is not None:
+                self._retire(previous)
+
+        return version.number
+
+    def deploy_in_background(self, name, code):
+        """
+        Like deploy, but compile in another thread while calls carry on.
+        Returns a Deployment to wait() on
+        """
+        deployment = Deployment(self, name)
+
+        thread = threading.Thread(target=deployment._run, args=(code,))
+        thread.daemon = True
+        thread.start()
+
+        return deployment
+
+    def remove(self, name):
+        "Stop new calls to `name`. Ones already running finish normally"
+        with self._lock:
+            self._retire(self._current.pop(name))
+
+    def version(self, name):
+        "The current version number of `name`"
+        with self._lock:
+            return self._current[name].number
+
+    def __contains__(self, name):
+        return name in self._current
+
+    def __len__(self):
+        return len(self._current)
+
+    def __call__(self, executor, name, *args):
+        "Call the current version of `name` in `executor`"
+        return self._call(executor, name, args, False)
+
+    def call_py(self, executor, name, *args):
+        "Like calling us, but converting the results like LuaValue.call_py"
+        return self._call(executor, name, args, True)
+
+    def _call(self, executor, name, args, py):
+        try:
+            i = self._indexes[id(executor)]
+        except KeyError:
+            raise ValueError("%r isn't one of our executors" % (executor,))
+
+        with self._locks[i]:
+            with self._lock:
+                version = self._current[name]
+                version.users += 1
+
+            # no local for the function, because it must be released while we
+            # still hold the executor's lock
+            try:
+                if py:
+                    return version.functions[i].call_py(*args)
+                return version.functions[i](*args)
+            finally:
+                with self._lock:
+                    version.users -= 1
+                    if version.retired and not version.users:
+                        self._queue_release(version.functions)
+                        version.functions = None
+                self._flush(i)
+
+    def collect(self):
+        """
+        Release retired versions that are still waiting on executors that the
+        registry hasn't used since. Good to do when things are idle
+        """
+        for i in xrange(len(self.executors)):
+            with self._locks[i]:
+                self._flush(i)
+
+    def _retire(self, version):
+        # must hold self._lock
+        version.retired = True
+        if not version.users:
+            self._queue_release(version.functions)
+            version.functions = None
+
+    def _queue_release(self, functions):
+        # must hold self._lock
+        for i, function in enumerate(functions):
+            self._released[i].append(function)
+
+    def _flush(self, i):
+        # must hold self._locks[i]. The functions are released when this
+        # returns and `released` goes away
+        with self._lock:
+            released, self._released[i] = self._released[i], []
+
+    def __repr__(self):
+        return "<%s %r on %d executors>" % (self.__class__.__name__,
+                                            sorted(self._current),
+                                            len(self.executors))
+
+
+class ScriptVersion(object):
+    """
+    One deployed version of a ScriptRegistry's script: its compiled function
+    in each of the registry's executors and how many calls are using it
+    """
+
+    __slots__ = ['name', 'number', 'functions', 'users', 'retired']
+
+    def __init__(self, name, functions):
+        self.name = name
+        self.number = None
+        self.functions = functions
+        self.users = 0
+        self.retired = False
+
+    def __repr__(self):
+        return "<%s %s@%s users=%d>" % (self.__class__.__name__,
+                                        self.name, self.number, self.users)
+
+
+class Deployment(object):
+    "A ScriptRegistry.deploy running in the background"
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.number = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def _run(self, code):
+        try:
+            self.number = self.registry.deploy(self.name, code)
+        except Exception as e:
+            self.exception = e
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the deploy to finish, returning the new version number or
+        raising whatever it failed with
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("deployment of %s still running" % (self.name,))
+        if self.exception is not None:
+            raise self.exception
+        return self.number
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.name,
+                               'done' if self.done() else 'running')
+
+
+class Scheduler(object):
+    """
+    Interleave many invocations of Lua functions by running each as a
+    coroutine. Rather than erroring like limit_runtime, a count hook makes the
+    running Task yield every `slice_instructions` and the runnable tasks take
+    turns, so a short script never waits for a long one to finish.
+
+    Scripts can also give up their turn early by calling coroutine.yield() at
+    their top level, and calling a Capsule(returns_future=True) function
+    suspends them until the future completes while the others keep running.
+    With idle_gc, time spent waiting for futures is used to step the garbage
+    collectors of the waiting tasks' VMs (see Lua.gc_step). Not supported on
+    luajit, which can't yield from hooks
+    """
+
+    def __init__(self, slice_instructions=SCHEDULER_SLICE_DEFAULT,
+                 idle_gc=False):
+        if _executor.LUA_VERSION_NUM == 501:
+            raise LuaException("the scheduler isn't supported on luajit")
+
+        self.slice_instructions = slice_instructions
+        self.idle_gc = idle_gc
+        self.runnable = collections.deque()
+        self.waiting = []
+
+        # set by futures' done callbacks, which may run on any thread
+        self._wakeup = threading.Event()
+
+    def spawn(self, function, *args, **kw):
+        """
+        Schedule function(*args) to run, returning its Task. Takes an optional
+        max_runtime (in CPU seconds) budget for the task
+        """
+        max_runtime = kw.pop('max_runtime', None)
+        if kw:
+            raise TypeError("unexpected keyword arguments %r" % (kw.keys(),))
+
+        task = Task(function, args,
+                    max_runtime=max_runtime,
+                    slice_instructions=self.slice_instructions)
+        self.runnable.append(task)
+        return task
+
+    def run_once(self):
+        """
+        Give the next runnable Task one turn. Returns whether any are left,
+        including those waiting on futures
+        """
+        self._poll_waiting()
+
+        if self.runnable:
+            task = self.runnable.popleft()
+            if task.step():
+                pass
+            elif task.waiting_on is not None:
+                self._wait_on(task)
+            else:
+                self.runnable.append(task)
+
+        return bool(self.runnable or self.waiting)
+
+    def run(self):
+        "Run until every Task is done"
+        while True:
+            # cleared before we poll so that a future finishing any time after
+            # that wakes up the wait below
+            self._wakeup.clear()
+
+            if not self.run_once():
+                break
+
+            if not self.runnable:
+                # everybody is waiting on a future
+                if self.idle_gc:
+                    self._collect_while_idle()
+                self._wakeup.wait(SCHEDULER_POLL_INTERVAL)
+
+    def _collect_while_idle(self):
+        executors = {}
+        for task in self.waiting:
+            executors[id(task.executor)] = task.executor
+
+        for executor in executors.itervalues():
+            if self._wakeup.is_set():
+                # somebody's future finished, so get back to work
+                break
+            executor.gc_step(max_steps=None,
+                             max_time=SCHEDULER_POLL_INTERVAL/len(executors))
+
+    def _wait_on(self, task):
+        self.waiting.append(task)
+
+        add_done_callback = getattr(task.waiting_on, 'add_done_callback', None)
+        if add_done_callback is not None:
+            wakeup = self._wakeup
+            add_done_callback(lambda _future: wakeup.set())
+
+    def _poll_waiting(self):
+        still_waiting = []
+
+        for task in self.waiting:
+            if task.waiting_on.done():
+                task._wake()
+                self.runnable.append(task)
+            else:
+                still_waiting.append(task)
+
+        self.waiting = still_waiting
+
+
+class Task(object):
+    """
+    One invocation of a Lua function running as a coroutine under a Scheduler
+    """
+
+    def __init__(self, function, args,
+                 max_runtime=None,
+                 slice_instructions=SCHEDULER_SLICE_DEFAULT):
+        self.executor = function.executor
+        self.L = function.L
+        self.max_runtime = max_runtime
+        self.slice_instructions = slice_instructions
+
+        self.runtime_used = 0.0
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiting_on = None # a future, see _callable_wrapper
+
+        # the thread is a Lua value like any other, so holding on to it as a
+        # LuaValue keeps it from being collected
+        self.thread_ptr = ctypes.c_void_p(lua_newthread(self.L))
+        self.thread = LuaValue(self.executor)
+
+        self.nargs = self._push_call(function, args)
+
+    @check_stack(1, 0)
+    def _push_call(self, function, args):
+        # get the function and its arguments onto the thread's stack, ready
+        # for the first resume
+        if not lua_checkstack(self.L, 1+len(args)):
+            raise LuaOutOfMemoryException("Task.checkstack")
+        if not lua_checkstack(self.thread_ptr, 1+len(args)):
+            raise LuaOutOfMemoryException("Task.checkstack")
+
+        lua_args = [LuaValue.from_python(self.executor, x) for x in args]
+
+        function._bring_to_top(False)
+        for la in lua_args:
+            la._bring_to_top(False)
+
+        lua_xmove(self.L, self.thread_ptr, 1+len(lua_args))
+
+        return len(lua_args)
+
+    def step(self):
+        "Run one slice of the task. Returns whether it's done"
+        if self.done:
+            return True
+
+        nresults = ctypes.c_int(0)
+        started = time.clock()
+        resume_ret = resume_task(self.L, self.thread_ptr, self.nargs,
+                                 self.slice_instructions,
+                                 ctypes.byref(nresults))
+        self.runtime_used += time.clock() - started
+        self.nargs = 0
+        nresults = nresults.value
+
+        if resume_ret == _executor.LUA_YIELD:
+            # we were preempted, they yielded on purpose, or they're waiting
+            # on a future. Anything else that they yielded is meaningless to
+            # us
+            self.waiting_on = self._yielded_future(nresults)
+            # just the values they yielded, since from 5.4 on that's not
+            # the whole stack
+            lua_settop(self.thread_ptr, -nresults-1)
+
+            if self.max_runtime and self.runtime_used > self.max_runtime:
+                self._finish(exception=LuaException(
+                    "runtime quota exceeded %f>%f"
+                    % (self.runtime_used, self.max_runtime)))
+
+        elif resume_ret == _executor.LUA_OK:
+            try:
+                if not lua_checkstack(self.L, nresults):
+                    raise LuaOutOfMemoryException("Task.step.checkstack")
+                lua_xmove(self.thread_ptr, self.L, nresults)
+                result = pop_python_tuple(self.L, nresults,
+                                          ctypes.py_object(_to_python_fallback),
+                                          ctypes.py_object(self.executor))
+            except Exception as e:
+                self._finish(exception=e)
+            else:
+                self._finish(result=result)
+
+        elif resume_ret == _executor.LUA_ERRRUN:
+            lua_xmove(self.thread_ptr, self.L, 1)
+            self._finish(exception=LuaStateException(self.executor))
+
+        elif resume_ret == _executor.LUA_ERRMEM:
+            self._finish(exception=_out_of_memory(self.executor))
+
+        else:
+            self._finish(exception=LuaException(
+                "Unknown return value from lua_resume: %r" % (resume_ret,)))
+
+        return self.done
+
+    @check_stack(1, 0)
+    def _yielded_future(self, nresults):
+        if nresults != 1 or not lua_checkstack(self.thread_ptr, 1):
+            return None
+
+        lua_pushvalue(self.thread_ptr, -1)
+        lua_xmove(self.thread_ptr, self.L, 1)
+        yielded = LuaValue(self.executor)
+
+        if yielded.type() != _executor.LUA_TUSERDATA:
+            return None
+
+        try:
+            yielded = yielded.to_python()
+        except LuaException:
+            return None
+
+        if isinstance(yielded, _AwaitedFuture):
+            return yielded.future
+
+        return None
+
+    def _wake(self):
+        "Arrange to resume the script with the outcome of waiting_on"
+        future, self.waiting_on = self.waiting_on, None
+
+        try:
+            self.nargs = self._push_resume(True, future.result())
+        except Exception as e:
+            # raised from the function call in the script like any other
+            # Python exception
+            self.nargs = self._push_resume(False, Capsule(e))
+
+    @check_stack(2, 0)
+    def _push_resume(self, ok, value):
+        # see finish_awaited_call
+        if not lua_checkstack(self.thread_ptr, 2):
+            raise LuaOutOfMemoryException("Task.checkstack")
+
+        lua_args = [LuaValue.from_python(self.executor, ok),
+                    LuaValue.from_python(self.executor, value)]
+
+        for la in lua_args:
+            la._bring_to_top(False)
+
+        lua_xmove(self.L, self.thread_ptr, len(lua_args))
+
+        return len(lua_args)
+
+    def _finish(self, result=None, exception=None):
+        self.done = True
+        self.waiting_on = None
+        self.result = result
+        self.exception = exception
+
+        # let the thread (and anything on its stack) be collected
+        self.thread = self.thread_ptr = None
+
+    def get(self):
+        "The return values of the function as a tuple, or raise its exception"
+        if not self.done:
+            raise LuaException("%r isn't done yet" % (self,))
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__,
+                               self.executor.name,
+                               'done' if self.done else 'pending')
 
 
 class LuaJitMode(object):
@@ -0,0 +1,33 @@
+-- helpers for executor.py:SandboxedExecutor's lazily loaded libs
+
+local function lazy(env, loaders)
+    -- the first time that env is asked for one of the names in loaders, run
+    -- its loader and keep what it returned in env, so that later lookups are
+    -- ordinary hits that never get here
+    return setmetatable(env, {
+        __index = function(t, k)
+            local loader = loaders[k]
+            if loader == nil then
+                return nil
+            end
+
+            -- before calling it, so a lib that refers to itself while it's
+            -- loading sees nil rather than recursing forever
+            loaders[k] = nil
+
+            local ok, value = pcall(loader)
+            if not ok then
+                -- so the next lookup tries again instead of seeing nil
+                loaders[k] = loader
+                error(value, 0)
+            end
+
+            rawset(t, k, value)
+            return value
+        end,
+    })
+end
+
+return {
+    lazy = lazy,
+}
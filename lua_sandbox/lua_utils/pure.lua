@@ -0,0 +1,103 @@
+-- helpers for executor.py's pure_load
+
+-- the functions that can return something different given the same arguments
+local NONDETERMINISTIC = {
+    os = {"clock", "date", "getenv", "time"},
+    math = {"random", "randomseed"},
+}
+
+local function blocked(name)
+    return function()
+        error(name .. " isn't allowed in a pure script", 2)
+    end
+end
+
+local function snapshot(t, seen)
+    -- a copy of t and every table reachable from it, so that later changes to
+    -- the originals don't show through. Read-only proxies can't change, so
+    -- they're shared rather than copied
+    if type(t) ~= "table" or getmetatable(t) == "read-only" then
+        return t
+    end
+
+    if seen[t] then
+        return seen[t]
+    end
+
+    local copy = {}
+    seen[t] = copy
+
+    for k, v in pairs(t) do
+        copy[k] = snapshot(v, seen)
+    end
+
+    -- so that objects keep their methods
+    local mt = getmetatable(t)
+    if type(mt) == "table" then
+        setmetatable(copy, mt)
+    end
+
+    return copy
+end
+
+local function pure_env(env, freeze, base, lazy)
+    -- a frozen copy of env as it is now, where the nondeterministic functions
+    -- raise errors. Scripts can't write to it, or a call could leave something
+    -- behind that changes the result of the next one, and they don't see the
+    -- changes that other scripts make to env either.
+    --
+    -- base is the frozen env that env reads through to, if any. lazy is
+    -- SandboxedExecutor's table of libs that haven't been loaded yet, and
+    -- they're copied the first time that the script asks for them
+    local seen = {}
+    local globals = {}
+    seen[env] = globals
+
+    for k, v in pairs(env) do
+        globals[k] = snapshot(v, seen)
+    end
+
+    for lib_name, names in pairs(NONDETERMINISTIC) do
+        local lib = globals[lib_name]
+        if lib == nil and base ~= nil and type(base[lib_name]) == "table" then
+            -- base's is frozen, so it needs a copy to block things in. pairs
+            -- can only see into frozen tables from 5.2 on, so before that the
+            -- copy reads through to it instead
+            local frozen = base[lib_name]
+            lib = setmetatable({}, {__index = frozen})
+            for k, v in pairs(frozen) do
+                lib[k] = v
+            end
+            globals[lib_name] = lib
+        end
+        if type(lib) == "table" then
+            for _, name in ipairs(names) do
+                lib[name] = blocked(lib_name .. "." .. name)
+            end
+        end
+    end
+
+    local pending = {}
+    for k in pairs(lazy or {}) do
+        pending[k] = true
+    end
+
+    setmetatable(globals, {
+        __index = function(t, k)
+            if pending[k] then
+                local value = freeze(snapshot(env[k], {}))
+                pending[k] = nil
+                rawset(t, k, value)
+                return value
+            elseif base ~= nil then
+                return base[k]
+            end
+        end,
+    })
+
+    return freeze(globals)
+end
+
+return {
+    pure_env = pure_env,
+}
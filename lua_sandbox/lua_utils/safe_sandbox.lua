@@ -17,18 +17,16 @@ local sandbox_env = {
     string = {
         byte = string.byte, char = string.char, format = string.format,
         len = string.len, lower = string.lower, rep = string.rep,
-        reverse = string.reverse, upper = string.upper,
+        reverse = string.reverse, upper = string.upper, sub = string.sub,
 
-        -- note!
-        -- we include these in our example sandbox, but depending on how
-        -- much you trust your lua code you may want to disallow them. they
-        -- can be used to hang the interpreter because it's possible to
-        -- create pathological patterns like:
+        -- the real versions of these can hang the interpreter with
+        -- pathological patterns like:
         --     string.find(("a"):rep(1e4), ".-.-.-.-b$")
-        -- and the time-limiting debug hooks can't execute while they are
-        -- running
-        find = string.find, gmatch = string.gmatch, gsub = string.gsub,
-        match = string.match, sub = string.sub,
+        -- because the time-limiting debug hooks can't run while they do.
+        -- These are the same but implemented in _executormodule.c so they
+        -- check the runtime limiter themselves
+        find = pattern.find, gmatch = pattern.gmatch, gsub = pattern.gsub,
+        match = pattern.match,
     },
     table = {
         insert = table.insert, maxn = table.maxn, remove = table.remove,
@@ -43,11 +41,53 @@ local sandbox_env = {
         ldexp = math.ldexp, log = math.log, log10 = math.log10, max = math.max,
         min = math.min, modf = math.modf, pi = math.pi, pow = math.pow,
         rad = math.rad, random = math.random, sin = math.sin, sinh = math.sinh,
-        sqrt = math.sqrt, tan = math.tan, tanh = math.tanh
+        sqrt = math.sqrt, tan = math.tan, tanh = math.tanh,
+        -- integer subtypes, from 5.3 on
+        tointeger = math.tointeger, type = math.type,
     },
     os = {
         clock = os.clock, difftime = os.difftime, time = os.time
     },
+    -- helpers for TypedArrays. These are implemented in C in
+    -- _executormodule.c
+    array = {
+        dot = array.dot, max = array.max, min = array.min,
+        scale = array.scale, sum = array.sum,
+    },
+    -- also in C, and allocations count against the memory limit
+    json = {
+        decode = json.decode, encode = json.encode,
+    },
 }
 
+-- before 5.3 the table library reads and writes with rawget and rawset,
+-- which go straight past the __newindex of read-only proxies like tenants.lua
+-- makes, and would write into the proxy itself where every other script
+-- sharing it could see. So refuse to modify them
+if _VERSION == "Lua 5.1" or _VERSION == "Lua 5.2" then
+    local function refuse_read_only(name, fn)
+        return function(t, ...)
+            if getmetatable(t) == "read-only" then
+                error("attempt to modify a read-only table with table." .. name,
+                      2)
+            end
+            return fn(t, ...)
+        end
+    end
+
+    for _, name in ipairs({"insert", "remove", "sort"}) do
+        local fn = sandbox_env.table[name]
+        sandbox_env.table[name] = refuse_read_only(name, fn)
+    end
+end
+
+-- methods on strings (like ("x"):find(...)) come from their metatable rather
+-- than the env, so point that at the same functions. The metatable is shared
+-- by the whole VM, so it gets its own copy that scripts can't reach to modify
+local string_methods = {}
+for name, fn in pairs(sandbox_env.string) do
+    string_methods[name] = fn
+end
+getmetatable("").__index = string_methods
+
 return sandbox_env
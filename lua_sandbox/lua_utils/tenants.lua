@@ -0,0 +1,78 @@
+-- helpers for executor.py:MultiTenantExecutor, RuleSet and ConversionCache
+
+-- the table behind each read-only proxy
+local originals = setmetatable({}, {__mode = "k"})
+
+local function deny(_, k, _)
+    error("attempt to modify read-only field " .. tostring(k), 2)
+end
+
+local function proxy_len(proxy)
+    return #originals[proxy]
+end
+
+local function proxy_pairs(proxy)
+    return next, originals[proxy], nil
+end
+
+local function proxy_ipairs(proxy)
+    return ipairs(originals[proxy])
+end
+
+local function readonly(t)
+    -- a proxy to t that can be read through but not written to. The table
+    -- library before 5.3 writes with rawset, so safe_sandbox.lua's refuses
+    -- anything whose metatable is "read-only" like this
+    local proxy = setmetatable({}, {
+        __index = t,
+        __newindex = deny,
+        __len = proxy_len,
+        __pairs = proxy_pairs,
+        __ipairs = proxy_ipairs,
+        __metatable = "read-only",
+    })
+    originals[proxy] = t
+    return proxy
+end
+
+local function freeze(t, seen)
+    -- make a read-only proxy of t and every table reachable from it. Rather
+    -- than copying them, each table's table values are replaced in place by
+    -- their proxies, so t mustn't be used directly afterwards.
+    --
+    -- From 5.2 on the proxies can be indexed, measured with # and iterated
+    -- with pairs and ipairs. next only sees the empty proxy, and so do unpack
+    -- and table.concat before 5.3. luajit can only index them
+    if type(t) ~= "table" then
+        return t
+    end
+
+    seen = seen or {}
+
+    if seen[t] then
+        return seen[t]
+    end
+
+    local proxy = readonly(t)
+    seen[t] = proxy
+
+    for k, v in next, t do
+        if type(v) == "table" then
+            -- assigning to existing fields is allowed during a traversal
+            t[k] = freeze(v, seen)
+        end
+    end
+
+    return proxy
+end
+
+local function new_env(base)
+    -- a tenant's env. It reads through to the shared base, but anything that
+    -- the tenant writes lands in its own table
+    return setmetatable({}, {__index = base, __metatable = false})
+end
+
+return {
+    freeze = freeze,
+    new_env = new_env,
+}
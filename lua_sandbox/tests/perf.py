@@ -1,140 +1,553 @@
 """
 Measure performance of lua_sandbox under the most common conditions
 
-This is:
+Most scenarios are some variation of:
 
 1. bring up a VM
 2. load up some code in a sandbox
 3. execute that loaded code over and over with different globals set in the
    sandbox
+
+Each operation is timed on its own so we can report latency percentiles as
+well as throughput and memory. Results can be written out as JSON and compared
+against a previous run:
+
+    python -m lua_sandbox.tests.perf --json new.json --baseline old.json
+
+which exits non-zero if any scenario got slower than the baseline by more than
+--threshold. Each scenario's iterations are split into --repeat batches that
+take turns with the other scenarios', and only the best batch of each counts,
+so that a noisy neighbour slowing the machine down for a while doesn't fail
+the run. Even so, on a shared VM with one core the best batches of unchanged
+builds can be over 50% apart, so lower --threshold only where it's quieter.
+
+To see what the Lua API calls exported by _executor save over plain ctypes,
+get the baseline with LUA_SANDBOX_CTYPES_ONLY=1 set
 """
 
+import argparse
+import json
 import re
-import timeit
+import resource
+import subprocess
+import sys
+import threading
+import time
 
+from lua_sandbox import _executor
 from lua_sandbox.executor import Capsule
 from lua_sandbox.executor import SandboxedExecutor
+from lua_sandbox.executor import Schema
 
 
-def simple_test(times):
-    """
-    See how we fare with just regular code
-    """
+BODIES = [
+    # one match one not match
+    {'body': 'http://foo.com', 'other_field': {'something': 'else'}},
+    {'body': 'ooh lah lah!', 'other_field': {'something': 'else'}},
+]
 
-    lua_code = """
-        return string.find(thing.body, "http")
-    """
+SIMPLE_CODE = """
+    return string.find(thing.body, "http")
+"""
+
+SMALL_INPUT = {'body': 'http://foo.com', 'score': 1.5, 'tags': ['a', 'b']}
+SMALL_SCHEMA = Schema('Small', [('body', str), ('score', float),
+                                ('tags', [str])])
+LARGE_INPUT = dict(('key%d' % i, 'value%d' % i) for i in xrange(1000))
+
+
+def _nested(depth):
+    if depth == 0:
+        return {'leaf': True}
+    return {'child': _nested(depth-1), 'siblings': range(5)}
+
+NESTED_INPUT = _nested(9)
+
+
+# every scenario takes no arguments and returns the operation to time. They're
+# registered here in the order that they run
+SCENARIOS = []
+
+
+def scenario(fn):
+    SCENARIOS.append(fn)
+    return fn
+
+
+@scenario
+def vm_creation():
+    "Bring up a whole sandboxed VM"
+    return SandboxedExecutor
+
+
+@scenario
+def vm_creation_all_libraries():
+    "Like vm_creation but opening every standard library, like we used to"
+    return lambda: SandboxedExecutor(libraries=None)
+
+
+@scenario
+def vm_creation_lazy_libs():
+    "Bring up a VM with a user lib that nobody uses"
+    libs = {'unused': 'local t = {} for i = 1, 100 do t[i] = i end return t'}
+    return lambda: SandboxedExecutor(libs=libs)
+
+
+@scenario
+def import_executor():
+    "Import lua_sandbox.executor in a fresh interpreter"
+    argv = [sys.executable, '-c', 'import lua_sandbox.executor']
+    return lambda: subprocess.check_call(argv)
+
+
+@scenario
+def sandboxed_load():
+    "Compile a small script into the sandbox"
+    lua = SandboxedExecutor()
+    return lambda: lua.sandboxed_load(SIMPLE_CODE)
+
+
+@scenario
+def table_access():
+    "Read and write a table field through LuaValues, mostly Lua API calls"
+    lua = SandboxedExecutor()
+    t = lua.create_table()
+
+    def the_test():
+        t['x'] = 1
+        t['x'].is_nil()
+
+    return the_test
+
+
+def _convert(value):
     lua = SandboxedExecutor()
-    loaded = lua.sandboxed_load(lua_code)
-    bodies = [
-        # one match one not match
-        {'body': 'http://foo.com', 'other_field': {'something': 'else'}},
-        {'body': 'ooh lah lah!', 'other_field': {'something': 'else'}},
-    ]
 
     def the_test():
-        for x in bodies:
+        lua.sandbox['thing'] = value
+        lua.sandbox['thing'] = None
+
+    return the_test
+
+
+@scenario
+def convert_small():
+    "Convert a small flat dict into a Lua table"
+    return _convert(SMALL_INPUT)
+
+
+@scenario
+def convert_small_schema():
+    "Like convert_small, but with a compiled Schema"
+    lua = SandboxedExecutor()
+    converter = lua.compile_schema(SMALL_SCHEMA)
+
+    def the_test():
+        lua.sandbox['thing'] = converter.to_lua(SMALL_INPUT)
+        lua.sandbox['thing'] = None
+
+    return the_test
+
+
+@scenario
+def convert_large():
+    "Convert a dict with 1000 keys into a Lua table"
+    return _convert(LARGE_INPUT)
+
+
+@scenario
+def convert_nested():
+    "Convert a deeply nested dict into Lua tables"
+    return _convert(NESTED_INPUT)
+
+
+@scenario
+def simple():
+    "See how we fare with just regular code"
+    lua = SandboxedExecutor()
+    loaded = lua.sandboxed_load(SIMPLE_CODE)
+
+    def the_test():
+        for x in BODIES:
             lua.sandbox['thing'] = x
             loaded()
             lua.sandbox['thing'] = None
 
-    ti = timeit.Timer(the_test)
-    print 'simple_test', ti.timeit(number=times)
+    return the_test
 
 
-def limiter_test(times):
+@scenario
+def limiter():
     """
     See how we fare with the runtime limiter enabled
 
     luajit suffers particularly under this one
     """
-
-    lua_code = """
-        return string.find(thing.body, "http")
-    """
     lua = SandboxedExecutor()
-    loaded = lua.sandboxed_load(lua_code)
-    bodies = [
-        # one match one not match
-        {'body': 'http://foo.com', 'other_field': {'something': 'else'}},
-        {'body': 'ooh lah lah!', 'other_field': {'something': 'else'}},
-    ]
+    loaded = lua.sandboxed_load(SIMPLE_CODE)
 
     def the_test():
-        for x in bodies:
+        for x in BODIES:
             lua.sandbox['thing'] = x
             with lua.limit_runtime(5.0):
                 loaded()
             lua.sandbox['thing'] = None
 
-    ti = timeit.Timer(the_test)
-    print 'limiter_test', ti.timeit(number=times)
+    return the_test
 
 
-def re_test(times):
-    """
-    See how we fare with calling Python functions
-    """
-
-    lua_code = """
-        return re.match("^http[s]", thing.body)
-    """
+@scenario
+def callback():
+    "See how we fare with calling Python functions"
     lua = SandboxedExecutor()
-    loaded = lua.sandboxed_load(lua_code)
+    loaded = lua.sandboxed_load("""
+        return re.match("^http[s]", thing.body)
+    """)
     lua.sandbox['re'] = {'match': re.match}
-    bodies = [
-        # one match one not match
-        {'body': 'http://foo.com', 'other_field': {'something': 'else'}},
-        {'body': 'ooh lah lah!', 'other_field': {'something': 'else'}},
-    ]
 
     def the_test():
-        for x in bodies:
+        for x in BODIES:
             lua.sandbox['thing'] = x
             loaded()
             lua.sandbox['thing'] = None
 
-    ti = timeit.Timer(the_test)
-    print 're_test', ti.timeit(number=times)
+    return the_test
 
 
-def capsule_test(times):
+@scenario
+def callback_raw_args():
     """
-    See how we fare with using Capsules
+    Like callback but with raw_lua_args, which still goes through
+    _callable_wrapper rather than converting in C
     """
+    lua = SandboxedExecutor()
+    loaded = lua.sandboxed_load("""
+        return re.match("^http[s]", thing.body)
+    """)
+    lua.sandbox['re'] = {
+        'match': Capsule(lambda pat, s: re.match(pat.to_python(),
+                                                 s.to_python()),
+                         raw_lua_args=True),
+    }
 
-    lua_code = """
-        return string.find(thing.body, "http")
-    """
+    def the_test():
+        for x in BODIES:
+            lua.sandbox['thing'] = x
+            loaded()
+            lua.sandbox['thing'] = None
+
+    return the_test
+
+
+@scenario
+def capsule():
+    "See how we fare with using Capsules"
     lua = SandboxedExecutor()
-    loaded = lua.sandboxed_load(lua_code)
-    lua.sandbox['re'] = {'match': re.match}
-    bodies = [
-        # one match one not match
-        {'body': 'http://foo.com', 'other_field': {'something': 'else'}},
-        {'body': 'ooh lah lah!', 'other_field': {'something': 'else'}},
-    ]
+    loaded = lua.sandboxed_load(SIMPLE_CODE)
 
     def the_test():
-        for x in bodies:
+        for x in BODIES:
             lua.sandbox['thing'] = Capsule(x)
             loaded()
             lua.sandbox['thing'] = None
 
-    ti = timeit.Timer(the_test)
-    print 'capsule_test', ti.timeit(number=times)
+    return the_test
+
+
+_RESULTS_CODE = """
+    local t = {}
+    for i = 1, 100 do
+        t[i] = {id = i, name = "item" .. i}
+    end
+    return t, "done", 42
+"""
+
+
+@scenario
+def result_extraction():
+    "Get a table of results back out as Python values"
+    lua = SandboxedExecutor()
+    loaded = lua.sandboxed_load(_RESULTS_CODE)
+    return lambda: [x.to_python() for x in loaded()]
+
+
+@scenario
+def result_extraction_call_py():
+    "Like result_extraction but converting in C"
+    lua = SandboxedExecutor()
+    loaded = lua.sandboxed_load(_RESULTS_CODE)
+    return lambda: loaded.call_py()
+
+
+def percentile(ordered, pct):
+    "The pct percentile of an already sorted list (nearest rank)"
+    if not ordered:
+        return None
+    idx = int(round(pct/100.0 * (len(ordered)-1)))
+    return ordered[idx]
+
+
+def max_rss_kb():
+    # kilobytes on Linux but bytes on OS X, which is fine since we only ever
+    # compare it to itself
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_batch(op, times):
+    "Run op `times` times, returning the seconds it took and sorted latencies"
+    timer = time.time
+    latencies = []
+
+    started = timer()
+    for _ in xrange(times):
+        op_started = timer()
+        op()
+        latencies.append(timer()-op_started)
+    elapsed = timer()-started
+
+    latencies.sort()
+    return elapsed, latencies
+
+
+def time_threads(ops, times):
+    """
+    Run each of ops `times` times in a thread of its own, all at once, and
+    return the seconds that took
+    """
+    barrier = threading.Event()
+
+    def _run(op):
+        barrier.wait()
+        for _ in xrange(times):
+            op()
+
+    threads = [threading.Thread(target=_run, args=(op,)) for op in ops]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    started = time.time()
+    barrier.set()
+    for t in threads:
+        t.join()
+    return time.time()-started
+
+
+class Measurement(object):
+    """
+    The batches run so far of one scenario. Each batch runs `times`
+    operations, and compare() goes by the best of them so that a run isn't
+    failed because something else on the machine slowed some of it down
+    """
+
+    def __init__(self, name, op, times, nthreads=None):
+        self.name = name
+        self.op = op
+        self.times = times
+        self.nthreads = nthreads
+        self.batches = []
+        self.latencies = []
+        self.rss_growth_kb = 0
+        self.vm_memory_used = None
+
+    def warm_up(self, warmup):
+        for _ in xrange(warmup):
+            ret = self.op()
 
+        # for the VM creation scenarios, how big a fresh one is
+        memory_used = getattr(ret, 'memory_used', None)
+        if isinstance(memory_used, (int, long)):
+            self.vm_memory_used = memory_used
 
-def main(times=100000):
-    tests = {
-        'simple_test': simple_test,
-        're_test': re_test,
-        'capsule_test': capsule_test,
-        'limiter_test': limiter_test,
+    def run_batch(self):
+        if self.nthreads:
+            self.batches.append({
+                'seconds': time_threads(self.op, self.times),
+            })
+            return
+
+        rss_before = max_rss_kb()
+        elapsed, latencies = time_batch(self.op, self.times)
+        self.rss_growth_kb += max_rss_kb()-rss_before
+
+        self.batches.append({
+            'seconds': elapsed,
+            'p50': percentile(latencies, 50),
+        })
+        self.latencies.extend(latencies)
+
+    def result(self):
+        # per batch
+        ops = self.times*(self.nthreads or 1)
+        total = ops*len(self.batches)
+        elapsed = sum(batch['seconds'] for batch in self.batches)
+        fastest = min(batch['seconds'] for batch in self.batches)
+
+        result = {
+            'name': self.name,
+            'ops': total,
+            'seconds': elapsed,
+            'ops_per_second': total/elapsed if elapsed else None,
+            'best_ops_per_second': ops/fastest if fastest else None,
+        }
+
+        if self.nthreads:
+            return result
+
+        latencies = sorted(self.latencies)
+        result.update({
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+            'best_p50': min(batch['p50'] for batch in self.batches),
+            'max_rss_growth_kb': self.rss_growth_kb,
+        })
+        if self.vm_memory_used is not None:
+            result['vm_memory_used'] = self.vm_memory_used
+
+        return result
+
+
+def run(times, only=None, threads=(1, 2, 4), repeat=1):
+    measurements = []
+
+    for fn in SCENARIOS:
+        name = fn.__name__
+        if only and name not in only:
+            continue
+        # VM creation and imports are so much slower than everything else that
+        # they get fewer iterations
+        slow = name.startswith('vm_creation') or name == 'import_executor'
+        n = max(1, times/100) if slow else times
+        measurement = Measurement(name, fn(), max(1, n/repeat))
+        measurement.warm_up(max(1, n/10))
+        measurements.append(measurement)
+
+    for nthreads in threads:
+        name = 'threads_%d' % nthreads
+        if only and name not in only:
+            continue
+        # multi-threaded scaling: each thread runs the simple scenario in its
+        # own VM
+        measurements.append(Measurement(
+            name,
+            [simple() for _ in xrange(nthreads)],
+            max(1, times/nthreads/repeat),
+            nthreads=nthreads))
+
+    # the scenarios take turns running a batch each, so that if the machine is
+    # slower for a while it costs every scenario one batch rather than all of
+    # the batches of the few that happened to be running
+    for _ in xrange(repeat):
+        for measurement in measurements:
+            measurement.run_batch()
+
+    results = []
+    for measurement in measurements:
+        result = measurement.result()
+        results.append(result)
+        _print_result(result)
+
+    return {
+        'lua_version_num': _executor.LUA_VERSION_NUM,
+        'times': times,
+        'repeat': repeat,
+        'results': results,
     }
 
-    for name, fn in sorted(tests.items()):
-        fn(times=times)
+
+def _print_result(result):
+    line = '%-28s %10.1f ops/s' % (result['name'],
+                                    result['ops_per_second'] or 0)
+    if 'p50' in result:
+        line += '  p50 %8.1fus  p99 %8.1fus  rss +%dkb' % (
+            result['p50']*1e6, result['p99']*1e6, result['max_rss_growth_kb'])
+    if 'vm_memory_used' in result:
+        line += '  vm %dkb' % (result['vm_memory_used']/1024,)
+    print line
+
+
+def compare(report, baseline, threshold):
+    """
+    The regressions in `report` against `baseline` as a list of messages.
+    Scenarios are compared by the best of their batches: p50 latency where we
+    have it, otherwise throughput. Raises ValueError if the two weren't
+    measured the same way, since then their numbers aren't comparable
+    """
+    for key in ('times', 'repeat'):
+        if report.get(key) != baseline.get(key):
+            raise ValueError("the baseline was run with --%s %s, not %s"
+                             % (key, baseline.get(key), report.get(key)))
+
+    regressions = []
+    old_results = dict((r['name'], r) for r in baseline['results'])
+
+    for new in report['results']:
+        old = old_results.get(new['name'])
+        if old is None:
+            continue
+
+        if new.get('best_p50') and old.get('best_p50'):
+            change = new['best_p50']/old['best_p50'] - 1
+            what = 'p50 latency'
+        elif new.get('best_ops_per_second') and old.get('best_ops_per_second'):
+            change = old['best_ops_per_second']/new['best_ops_per_second'] - 1
+            what = 'throughput'
+        else:
+            continue
+
+        if change > threshold:
+            regressions.append('%s: %s regressed by %.1f%%'
+                               % (new['name'], what, change*100))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--times', type=int, default=10000,
+                        help='iterations of each scenario')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='split the iterations into this many batches '
+                             '(default: %(default)s)')
+    parser.add_argument('--only', action='append',
+                        help='run just this scenario (may be repeated)')
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.6,
+                        help='fail if anything is this much slower than the '
+                             'baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    print 'LUA_VERSION_NUM', _executor.LUA_VERSION_NUM
+
+    report = run(args.times, only=args.only, repeat=args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline.get('lua_version_num') != report['lua_version_num']:
+            print 'warning: baseline is from LUA_VERSION_NUM %s' % (
+                baseline.get('lua_version_num'),)
+
+        try:
+            regressions = compare(report, baseline, args.threshold)
+        except ValueError as e:
+            print 'error: %s' % (e,)
+            return 2
+        for regression in regressions:
+            print 'REGRESSION', regression
+        if regressions:
+            return 1
+
+    return 0
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
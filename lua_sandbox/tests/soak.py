@@ -0,0 +1,247 @@
+"""
+Soak test lua_sandbox for slow leaks
+
+Drives a mix of representative workloads for a long time (hours, ideally),
+periodically sampling:
+
+* the process's RSS
+* the VM's memory_used
+* len(references), the Python objects that Lua is holding on to
+* the length of the Lua registry, where LuaValues keep their refs
+* the number of objects tracked by Python's garbage collector
+
+At the end it fits a line through each of them and fails if any grew faster
+than its threshold (per million calls):
+
+    python -m lua_sandbox.tests.soak --duration 3600 --json soak.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import re
+import resource
+import sys
+import time
+
+from lua_sandbox import _executor
+from lua_sandbox.executor import Cached
+from lua_sandbox.executor import Capsule
+from lua_sandbox.executor import LuaException
+from lua_sandbox.executor import RuleSet
+from lua_sandbox.executor import SANDBOX_LIBRARIES
+from lua_sandbox.executor import SandboxedExecutor
+
+
+# how much each metric may grow per million calls before we call it a leak
+DEFAULT_MAX_SLOPES = {
+    'rss_kb': 10*1024,
+    'memory_used': 1024*1024,
+    'references': 10,
+    'registry_length': 100,
+    'python_objects': 1000,
+}
+
+REGISTRY_LENGTH = """
+    return #debug.getregistry()
+"""
+
+CONFIG = {'threshold': 10, 'names': ['a', 'b', 'c']}
+
+
+class Workloads(object):
+    "One VM with a bit of everything that we do in production"
+
+    def __init__(self):
+        # debug is for registry_length
+        self.ex = SandboxedExecutor(name='soak',
+                                    libraries=SANDBOX_LIBRARIES+('debug',))
+        self.lua = self.ex.ex
+
+        self.plain = self.ex.sandboxed_load("""
+            return string.find(thing.body, "http") ~= nil, #thing.tags
+        """)
+        self.callback = self.ex.sandboxed_load("""
+            return re.match("^http[s]", thing.body) ~= nil
+        """)
+        self.ex.sandbox['re'] = {'match': re.match}
+        self.capsule = self.ex.sandboxed_load("""
+            return thing.body
+        """)
+        self.failing = self.ex.sandboxed_load("""
+            return explode(thing.body)
+        """)
+        self.ex.sandbox['explode'] = self._explode
+        self.cached = self.ex.sandboxed_load("""
+            return #config.names > config.threshold
+        """)
+
+        self.rules = RuleSet(self.ex)
+        self.rules.add('http', 'return string.find((...).body, "http")')
+        self.rules.add('tagged', 'return #(...).tags > 1')
+
+        self.registry_length = self.lua.load(REGISTRY_LENGTH)
+
+        self.calls = 0
+
+    @staticmethod
+    def _explode(body):
+        raise ValueError(body)
+
+    def run_once(self, i):
+        thing = {'body': 'http://foo.com/%d' % i, 'tags': ['x', 'y']}
+
+        self.ex.sandbox['thing'] = thing
+        self.plain()
+        self.callback.call_py()
+
+        with self.lua.scope():
+            self.ex.sandbox['thing'] = Capsule(thing)
+            self.capsule()
+
+        self.ex.sandbox['thing'] = thing
+        try:
+            self.failing()
+        except LuaException:
+            pass
+
+        self.ex.sandbox['config'] = Cached(CONFIG)
+        self.cached.call_py()
+
+        self.rules.evaluate(thing)
+
+        self.ex.sandbox['thing'] = None
+        self.calls += 7
+
+
+def current_rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+    except (IOError, OSError):
+        # not Linux, so the high water mark will have to do. It's bytes on OS
+        # X, but we only compare it to itself
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def sample(workloads, started):
+    gc.collect()
+    workloads.lua.gc()
+
+    return {
+        'elapsed': time.time()-started,
+        'calls': workloads.calls,
+        'rss_kb': current_rss_kb(),
+        'memory_used': workloads.lua.memory_used,
+        'references': len(workloads.lua.references),
+        'registry_length': workloads.registry_length.call_py()[0],
+        'python_objects': len(gc.get_objects()),
+    }
+
+
+def slope(xs, ys):
+    "Least squares slope of ys against xs"
+    n = float(len(xs))
+    if n < 2:
+        return 0.0
+    mean_x = sum(xs)/n
+    mean_y = sum(ys)/n
+    var = sum((x-mean_x)**2 for x in xs)
+    if not var:
+        return 0.0
+    return sum((x-mean_x)*(y-mean_y) for x, y in zip(xs, ys))/var
+
+
+def analyse(samples, max_slopes):
+    """
+    The growth of each metric per million calls and whether it's acceptable.
+    The first sample is taken after a warmup, so caches filling up don't count
+    """
+    calls = [s['calls'] for s in samples]
+    report = {}
+
+    for metric, max_slope in sorted(max_slopes.items()):
+        per_million = slope(calls, [s[metric] for s in samples]) * 1e6
+        report[metric] = {
+            'first': samples[0][metric],
+            'last': samples[-1][metric],
+            'slope_per_million_calls': per_million,
+            'max_slope': max_slope,
+            'ok': per_million <= max_slope,
+        }
+
+    return report
+
+
+def run(duration, interval, warmup, max_slopes):
+    workloads = Workloads()
+
+    for i in xrange(warmup):
+        workloads.run_once(i)
+
+    started = time.time()
+    samples = [sample(workloads, started)]
+    print 'warmed up', samples[0]
+
+    i = warmup
+    next_sample = started + interval
+    while time.time()-started < duration:
+        workloads.run_once(i)
+        i += 1
+
+        if time.time() >= next_sample:
+            samples.append(sample(workloads, started))
+            print samples[-1]
+            next_sample += interval
+
+    samples.append(sample(workloads, started))
+
+    return {
+        'lua_version_num': _executor.LUA_VERSION_NUM,
+        'samples': samples,
+        'analysis': analyse(samples, max_slopes),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--duration', type=float, default=600,
+                        help='seconds to run for (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between samples (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=10000,
+                        help='iterations before the first sample')
+    parser.add_argument('--max-slope', action='append', default=[],
+                        metavar='METRIC=VALUE',
+                        help='override the allowed growth per million calls')
+    parser.add_argument('--json', help='write the samples and analysis here')
+    args = parser.parse_args(argv)
+
+    max_slopes = dict(DEFAULT_MAX_SLOPES)
+    for override in args.max_slope:
+        metric, _, value = override.partition('=')
+        if metric not in max_slopes:
+            parser.error('unknown metric %r' % (metric,))
+        max_slopes[metric] = float(value)
+
+    report = run(args.duration, args.interval, args.warmup, max_slopes)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    failed = False
+    for metric, result in sorted(report['analysis'].items()):
+        print '%-16s %12s -> %-12s %+14.1f/Mcalls  %s' % (
+            metric, result['first'], result['last'],
+            result['slope_per_million_calls'],
+            'ok' if result['ok'] else 'FAIL (max %s)' % result['max_slope'])
+        failed = failed or not result['ok']
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())